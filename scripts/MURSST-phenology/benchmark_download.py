@@ -0,0 +1,170 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Benchmark subset_dataset.download_data against a local stand-in for the
+PO.DAAC granule search and OPeNDAP servers.  Every request is answered
+after an artificial latency with a small fake granule, so the timings show
+how well the download engine hides per-request latency.
+
+% python benchmark_download.py -n 60 -l 0.2 -w 1 4 8
+"""
+
+import sys, os
+import time
+import shutil
+import tempfile
+import threading
+import datetime
+from optparse import OptionParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from netCDF4 import Dataset
+import numpy as np
+
+import subset_dataset
+
+################################################################################################
+
+NLAT = 180
+NLON = 360
+
+DDX = """<?xml version="1.0" encoding="UTF-8"?>
+<Dataset name="fake_granule.nc">
+  <Attribute name="NC_GLOBAL" type="Container">
+    <Attribute name="southernmost_latitude" type="Float32"><value>-90.0</value></Attribute>
+    <Attribute name="northernmost_latitude" type="Float32"><value>90.0</value></Attribute>
+    <Attribute name="westernmost_longitude" type="Float32"><value>-180.0</value></Attribute>
+    <Attribute name="easternmost_longitude" type="Float32"><value>180.0</value></Attribute>
+  </Attribute>
+  <Grid name="analysed_sst">
+    <Array name="analysed_sst"><Float32/><dimension name="time" size="1"/><dimension name="lat" size="%(nlat)d"/><dimension name="lon" size="%(nlon)d"/></Array>
+    <Map name="time"><Int32/><dimension name="time" size="1"/></Map>
+    <Map name="lat"><Attribute name="axis" type="String"><value>Y</value></Attribute><Float32/><dimension name="lat" size="%(nlat)d"/></Map>
+    <Map name="lon"><Attribute name="axis" type="String"><value>X</value></Attribute><Float32/><dimension name="lon" size="%(nlon)d"/></Map>
+  </Grid>
+</Dataset>
+""" % {'nlat': NLAT, 'nlon': NLON}
+
+def parseoptions():
+  usage = "Usage: %prog [options]"
+  parser = OptionParser(usage)
+  parser.add_option("-n", "--granules", help="number of fake granules", dest="granules", type="int", default=60)
+  parser.add_option("-l", "--latency", help="artificial latency per request in seconds", dest="latency", type="float", default=0.2)
+  parser.add_option("-p", "--page", help="granules per search page", dest="page", type="int", default=400)
+  parser.add_option("-w", "--workers", help="Max_Concurrency values to compare, e.g. -w 1 4 8", dest="workers", default="1 4 8")
+
+  # Parse command line arguments
+  (options, args) = parser.parse_args()
+  options.workers = [int(w) for w in (options.workers.split() + args)]
+
+  return( options )
+
+def fake_granule():
+  """A small L4-like netCDF granule, returned as bytes"""
+  tmpdir = tempfile.mkdtemp()
+  filename = tmpdir + '/fake_granule.nc'
+  fid = Dataset(filename, 'w')
+  fid.createDimension('time', 1)
+  fid.createDimension('lat', NLAT)
+  fid.createDimension('lon', NLON)
+  fid.createVariable('lat', 'f4', ('lat'))[:] = np.linspace(-89.5, 89.5, NLAT)
+  fid.createVariable('lon', 'f4', ('lon'))[:] = np.linspace(-179.5, 179.5, NLON)
+  fid.createVariable('analysed_sst', 'f4', ('time', 'lat', 'lon'), zlib=True)[:] = 285.0 + np.random.rand(1, NLAT, NLON)
+  fid.createVariable('mask', 'i1', ('time', 'lat', 'lon'), zlib=True)[:] = 1
+  fid.close()
+  with open(filename, 'rb') as f:
+    data = f.read()
+  shutil.rmtree(tmpdir)
+  return data
+
+def granule_names(ngranules):
+  day0 = datetime.date(2010, 1, 1)
+  names = []
+  for i in range(ngranules):
+    day = day0 + datetime.timedelta(days=i)
+    names.append('%04d/%03d/%s090000-FAKE-L4-GLOB-v1.0.nc' % (day.year, day.timetuple().tm_yday, day.strftime('%Y%m%d')))
+  return names
+
+def make_handler(names, granule, latency):
+
+  class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+      pass
+
+    def reply(self, body, ctype):
+      time.sleep(latency)
+      self.send_response(200)
+      self.send_header('Content-Type', ctype)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      url = urlparse(self.path)
+      if url.path.startswith('/ws/search/granule'):
+        query = parse_qs(url.query)
+        nitems = int(query.get('itemsPerPage', ['10'])[0])
+        first = int(query.get('startIndex', ['0'])[0])
+        entries = ''
+        for name in names[first:first+nitems]:
+          entries += '<entry><title>%s</title><updated>2011-01-01T00:00:00Z</updated><link title="OPeNDAP URL" href="http://%s/opendap/%s.html"/></entry>\n' % (os.path.basename(name), self.headers['Host'], name)
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n%s</feed>\n' % entries
+        self.reply(body.encode(), 'application/atom+xml')
+      elif url.path.endswith('.ddx'):
+        self.reply(DDX.encode(), 'text/xml')
+      elif url.path.startswith('/opendap/'):
+        self.reply(granule, 'application/x-netcdf')
+      else:
+        self.send_error(404)
+
+  return StandInHandler
+
+def standalone_main():
+
+  options = parseoptions()
+
+  server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(granule_names(options.granules), fake_granule(), options.latency))
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  subset_dataset.PODAAC_WEB = 'http://127.0.0.1:%d' % server.server_address[1]
+  cachedir = tempfile.mkdtemp()
+  subset_dataset.metadataCache = cachedir + '/opendap_metadata.json'
+
+  results = []
+  for workers in options.workers:
+    rootdir = tempfile.mkdtemp()
+    start = time.time()
+    subset_dataset.download_data('2010', '1', '1', '2011', '1', '1', 35.0, 50.0, -80.0, -55.0, 1, 'FAKE-L4-GLOB-v1.0', rootdir, workers, options.page)
+    seconds = time.time() - start
+    # a second run finds every granule in the download manifest
+    start = time.time()
+    subset_dataset.download_data('2010', '1', '1', '2011', '1', '1', 35.0, 50.0, -80.0, -55.0, 1, 'FAKE-L4-GLOB-v1.0', rootdir, workers, options.page)
+    results.append((workers, seconds, time.time() - start))
+    shutil.rmtree(rootdir)
+
+  server.shutdown()
+  shutil.rmtree(cachedir)
+
+  print('\n%d granules, %.3f s latency per request' % (options.granules, options.latency))
+  print('Max_Concurrency   seconds   granules/s   rerun seconds')
+  for workers, seconds, rerun in results:
+    print('%15d %9.2f %12.1f %15.2f' % (workers, seconds, options.granules / seconds, rerun))
+
+################################################################################################
+
+if __name__ == "__main__":
+        standalone_main()
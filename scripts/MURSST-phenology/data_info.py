@@ -30,6 +30,8 @@ import datetime
 import calendar
 from pathlib import Path
 
+import file_catalog
+
 ################################################################################################   
 def createdir(dirname):
   if not os.path.exists(dirname):
@@ -47,6 +49,18 @@ def podaac_dataset_shorname(dataset_name):
     else:
        return null
 
+def data_dirname(config_input, dataset_name):
+  """Input of the analysis steps: Root_Name, or Root_Name/Data_Cube when a cube is configured"""
+  rootdir = config_input.get(dataset_name, 'Root_Name')
+  cubename = config_input.get(dataset_name, 'Data_Cube', fallback=None)
+  if cubename and os.path.isfile(rootdir + "/" + cubename):
+    return rootdir + "/" + cubename
+  return rootdir
+
+def box_index_filename(output_dir, variablename, dataset_name, lat_boxsize):
+  """Box index file of a dataset written by phenologyalg.indexProcessing"""
+  return output_dir+'/'+variablename+'_'+dataset_name+'_'+str(lat_boxsize)+'_degree_box.nc'
+
 def latloninfo(rootdir, shortname):
     ncin = Dataset(rootdir+"/"+shortname+"_info.nc", 'r')
     lons = ncin.variables['lon'][:]
@@ -57,8 +71,11 @@ def latloninfo(rootdir, shortname):
 def latloninfo_seawifs(rootdir, startY):
     # read sample file to get dataset infro
     bfound = False
+    catalog = file_catalog.get_catalog(rootdir)
     for j in range(1, 367):
-       for filename in glob.glob(rootdir+"/"+"{0:0>4}".format(startY)+"/"+"{0:0>3}".format(j)+"/S"+"{0:0>4}".format(startY)+"{0:0>3}".format(j)+'*.nc'):
+       for filename in catalog.day_files(startY, j):
+         if not os.path.basename(filename).startswith("S"+"{0:0>4}".format(startY)+"{0:0>3}".format(j)):
+           continue
          ncin = Dataset(filename, 'r')
          lons = ncin.variables['lon'][:]
          lats = ncin.variables['lat'][:]
@@ -0,0 +1,378 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Daily data cube: one chunked, compressed netCDF4 file per dataset holding
+every daily granule as a (time, lat, lon) slab, keyed by a "date"
+(yyyymmdd) variable instead of the Root_Name/YYYY/DDD/*.nc directory tree.
+
+Gridded variables are stored with the dtype, packing attributes and fill
+value of the source granules, so reading them back with netCDF4 gives the
+same values as reading the daily files.
+
+Package an existing Root_Name tree into a cube:
+
+% python datacube.py -r CMC -o CMC/cmc_cube.nc
+"""
+
+import sys, os
+import atexit
+import time
+import datetime
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+from netCDF4 import Dataset, default_fillvals
+import numpy as np
+
+import file_catalog
+
+#####################
+# Global Parameters #
+#####################
+
+chunkShape = (128, 32, 32)        # (time, lat, lon), long time series per chunk
+chunkCache = 256*1024*1024        # HDF5 chunk cache per variable in bytes
+prefetchPool = None               # (size, pool) shared by every iter_daily_fields call of this process
+
+###############
+# subroutines #
+###############
+def date_key(day):
+  """yyyymmdd integer of a datetime.date"""
+  return day.year*10000 + day.month*100 + day.day
+
+def key_date(key):
+  return datetime.date(key//10000, (key//100)%100, key%100)
+
+def grid_variables(ncin):
+  """Names of the (time, lat, lon) variables of a granule or cube"""
+  names = []
+  for name, var in ncin.variables.items():
+    if len(var.dimensions) == 3 and var.dimensions[1] in ('lat', 'latitude') and var.dimensions[2] in ('lon', 'longitude'):
+      names.append(name)
+  return names
+
+def create_cube(cubefile, ncin, lat_slice=slice(None), lon_slice=slice(None)):
+  """Create an empty cube with the grid and gridded variables of granule ncin"""
+  lats = ncin.variables['lat'][lat_slice]
+  lons = ncin.variables['lon'][lon_slice]
+  chunks = (chunkShape[0], min(chunkShape[1], lats.size), min(chunkShape[2], lons.size))
+
+  fid = Dataset(cubefile, 'w')
+  fid.createDimension('time', None)
+  fid.createDimension('lat', lats.size)
+  fid.createDimension('lon', lons.size)
+
+  fid.createVariable('lat', 'f8', ('lat'), zlib=True)
+  fid.variables['lat'][:] = lats
+  fid.variables['lat'].standard_name='latitude'
+  fid.variables['lat'].long_name='latitude'
+  fid.variables['lat'].axis='Y'
+  fid.variables['lat'].units='degrees_north'
+
+  fid.createVariable('lon', 'f8', ('lon'), zlib=True)
+  fid.variables['lon'][:] = lons
+  fid.variables['lon'].standard_name='longitude'
+  fid.variables['lon'].long_name='longitude'
+  fid.variables['lon'].units='degrees_east'
+  fid.variables['lon'].axis='X'
+
+  fid.createVariable('date', 'i4', ('time'), chunksizes=(1024,))
+  fid.variables['date'].long_name='granule date'
+  fid.variables['date'].units='yyyymmdd'
+
+  for name in grid_variables(ncin):
+    var = ncin.variables[name]
+    fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+    out = fid.createVariable(name, var.dtype, ('time', 'lat', 'lon'), zlib=True, chunksizes=chunks, fill_value=fill)
+    out.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+
+  for att in ('title', 'source', 'institution', 'references'):
+    if att in ncin.ncattrs():
+      fid.setncattr(att, ncin.getncattr(att))
+  fid.cdm_data_type = "Grid"
+  return fid
+
+class CubeWriter(object):
+  """Append daily granules to a cube file, keyed by date
+
+  A date that is already in the cube is overwritten in place, so
+  re-ingesting a granule never duplicates it.  A row is reserved with
+  date 0 before its fields are written and gets its date last, so rows
+  left by a killed run (date 0 or masked) are never read and are reused
+  by the next appends.  Not thread-safe; callers
+  serialize access (the netCDF/HDF5 library is not thread-safe either).
+  """
+
+  def __init__(self, cubefile):
+    self.cubefile = cubefile
+    self.fid = None
+    self.dates = {}
+    self.free = []
+    if os.path.exists(cubefile):
+      self._open(Dataset(cubefile, 'a'))
+      for index, key in enumerate(np.ma.filled(self.fid.variables['date'][:], 0)):
+        if key > 0:
+          self.dates[int(key)] = index
+        else:
+          self.free.append(index)
+
+  def _open(self, fid):
+    self.fid = fid
+    for name in grid_variables(fid):
+      fid.variables[name].set_auto_maskandscale(False)
+      fid.variables[name].set_var_chunk_cache(size=chunkCache)
+
+  def has(self, day):
+    return date_key(day) in self.dates
+
+  def append(self, ncin, day, lat_slice=slice(None), lon_slice=slice(None)):
+    """Write the gridded variables of granule ncin (one time step) for day"""
+    if self.fid is None:
+      dirname = os.path.dirname(self.cubefile)
+      if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+      self._open(create_cube(self.cubefile, ncin, lat_slice, lon_slice))
+
+    key = date_key(day)
+    index = self.dates.get(key)
+    if index is None:
+      index = self.free.pop(0) if self.free else len(self.fid.dimensions['time'])
+    self.fid.variables['date'][index] = 0
+    for name in grid_variables(self.fid):
+      if name not in ncin.variables:
+        continue
+      var = ncin.variables[name]
+      var.set_auto_maskandscale(False)
+      self.fid.variables[name][index,:,:] = var[0, lat_slice, lon_slice]
+    self.fid.variables['date'][index] = key
+    self.dates[key] = index
+    return index
+
+  def append_bytes(self, data, day, lat_slice=slice(None), lon_slice=slice(None)):
+    """Decode a downloaded granule held in memory and append it"""
+    ncin = Dataset('granule.nc', memory=data)
+    try:
+      return self.append(ncin, day, lat_slice, lon_slice)
+    finally:
+      ncin.close()
+
+  def grid(self):
+    """lat, lon of the cube"""
+    return self.fid.variables['lat'][:], self.fid.variables['lon'][:]
+
+  def close(self):
+    if self.fid is not None:
+      self.fid.close()
+      self.fid = None
+
+def convert_tree(rootdir, cubefile, startY=None, endY=None):
+  """Package the daily files of a Root_Name/YYYY/DDD/*.nc tree into a cube"""
+  years = sorted(int(name) for name in os.listdir(rootdir) if name.isdigit() and len(name) == 4)
+  if startY is not None:
+    years = [year for year in years if year >= startY]
+  if endY is not None:
+    years = [year for year in years if year <= endY]
+
+  catalog = file_catalog.get_catalog(rootdir)
+  writer = CubeWriter(cubefile)
+  ndays = 0
+  try:
+    for year in years:
+      print("Packaging Year = " + str(year))
+      for j in range(1, 367):
+        for filename in catalog.day_files(year, j):
+          day = datetime.date(year, 1, 1) + datetime.timedelta(days=j-1)
+          ncin = Dataset(filename, 'r')
+          writer.append(ncin, day)
+          ncin.close()
+          ndays = ndays + 1
+  finally:
+    writer.close()
+  print(str(ndays) + ' daily files packaged into ' + cubefile)
+
+def is_cube(dirname):
+  """True if an analysis input names a cube file rather than a Root_Name tree"""
+  return dirname.endswith('.nc') and os.path.isfile(dirname)
+
+def read_hyperslab(var, index):
+  """var[index] unpacked to float64, NaN at the fill value or outside the valid range
+
+  Reads with netCDF4 auto masking and scaling off and applies
+  _FillValue/missing_value, valid_min/valid_max/valid_range and
+  scale_factor/add_offset here, giving a plain array instead of a masked
+  one for the analysis steps, which apply their own validity thresholds.
+  """
+  var.set_auto_maskandscale(False)
+  raw = var[index]
+  attrs = var.ncattrs()
+  if '_FillValue' in attrs:
+    invalid = raw == var.getncattr('_FillValue')
+  elif raw.dtype.itemsize > 1 and raw.dtype.str[1:] in default_fillvals:
+    invalid = raw == default_fillvals[raw.dtype.str[1:]]
+  else:
+    invalid = np.zeros(raw.shape, dtype=bool)
+  if 'missing_value' in attrs:
+    invalid |= np.isin(raw, np.atleast_1d(var.getncattr('missing_value')))
+  if 'valid_range' in attrs:
+    invalid |= (raw < var.valid_range[0]) | (raw > var.valid_range[1])
+  if 'valid_min' in attrs:
+    invalid |= raw < var.valid_min
+  if 'valid_max' in attrs:
+    invalid |= raw > var.valid_max
+
+  data = raw.astype(np.float64)
+  if 'scale_factor' in attrs:
+    data = data*var.scale_factor
+  if 'add_offset' in attrs:
+    data = data + var.add_offset
+  data[invalid] = np.nan
+  return data
+
+def read_granule(filename, variables, window, day):
+  """fields and start_time of one daily file, as yielded by iter_daily_fields()"""
+  lat_slice, lon_slice = window
+  ncin = Dataset(filename, 'r')
+  fields = {}
+  for name in variables:
+    var = ncin.variables[name]
+    fields[name] = read_hyperslab(var, (0,lat_slice,lon_slice) if var.ndim == 3 else (lat_slice,lon_slice))
+  start_time = None
+  for att,val in ncin.__dict__.items():
+    if att.find('start_time') != -1:
+      start_time = val
+  ncin.close()
+  if start_time is None:
+    start_time = day.strftime('%Y%m%dT000000Z')
+  return fields, start_time
+
+def prefetch_pool(prefetch):
+  """Process pool of prefetch workers, started once and reused by every step of this process"""
+  global prefetchPool
+  if prefetchPool is None or prefetchPool[0] != prefetch:
+    close_prefetch_pool()
+    prefetchPool = (prefetch, ProcessPoolExecutor(max_workers=prefetch))
+  return prefetchPool[1]
+
+def close_prefetch_pool():
+  global prefetchPool
+  if prefetchPool is not None:
+    prefetchPool[1].shutdown()
+    prefetchPool = None
+
+atexit.register(close_prefetch_pool)
+
+def iter_daily_fields(dirname, year, variables, window=None, prefetch=0):
+  """Yield (day number, fields, start_time) for every granule of a year
+
+  dirname is a Root_Name directory tree of daily files or a cube file.
+  fields maps each name in variables to its 2-D (lat, lon) float array
+  from read_hyperslab(), NaN where there is no valid value; start_time is
+  the granule start time as yyyymmddTHHMMSSZ.  Days come in day number
+  order.  window = (lat slice, lon slice) reads only that part of the
+  grid, and only the listed variables are read.
+
+  With prefetch > 0 the daily files are opened and decompressed by the
+  prefetch worker processes of prefetch_pool(), up to 2*prefetch granules
+  ahead of the caller, so decoding overlaps the caller's work.  Processes
+  rather than threads: the netCDF/HDF5 library is not thread-safe.  A cube
+  is read a year at a time and needs no prefetching.
+  """
+  if window is None:
+    window = (slice(None), slice(None))
+  lat_slice, lon_slice = window
+  if not is_cube(dirname):
+    catalog = file_catalog.get_catalog(dirname)
+    granules = []
+    for j in range(1, 367):
+      day = datetime.date(year, 1, 1) + datetime.timedelta(days=j-1)
+      for filename in catalog.day_files(year, j):
+        granules.append((j, filename, day))
+    if prefetch <= 0 or len(granules) <= 1:
+      for j, filename, day in granules:
+        fields, start_time = read_granule(filename, variables, window, day)
+        yield j, fields, start_time
+      return
+
+    pool = prefetch_pool(prefetch)
+    pending = collections.deque()
+    for j, filename, day in granules:
+      pending.append((j, pool.submit(read_granule, filename, variables, window, day)))
+      if len(pending) >= 2*prefetch:
+        j, future = pending.popleft()
+        fields, start_time = future.result()
+        yield j, fields, start_time
+    while pending:
+      j, future = pending.popleft()
+      fields, start_time = future.result()
+      yield j, fields, start_time
+    return
+
+  ncin = Dataset(dirname, 'r')
+  # rows of an interrupted append have date 0 or masked, never a year
+  keys = np.ma.filled(ncin.variables['date'][:], 0)
+  index = np.where(keys//10000 == year)[0]
+  index = index[np.argsort(keys[index])]
+  if index.size == 0:
+    ncin.close()
+    return
+
+  # read the year in one go, the cube is chunked along time for this
+  t0 = index.min()
+  t1 = index.max() + 1
+  slabs = {}
+  if t1 - t0 <= 2*index.size:
+    for name in variables:
+      slabs[name] = read_hyperslab(ncin.variables[name], (slice(t0,t1),lat_slice,lon_slice))
+    rows = index - t0
+  else:
+    rows = np.argsort(np.argsort(index))
+    for name in variables:
+      slabs[name] = read_hyperslab(ncin.variables[name], (np.sort(index),lat_slice,lon_slice))
+  ncin.close()
+
+  for t, row in zip(index, rows):
+    day = key_date(int(keys[t]))
+    yield day.timetuple().tm_yday, {name: slabs[name][row] for name in variables}, day.strftime('%Y%m%dT000000Z')
+
+def parseoptions():
+  usage = "Usage: %prog [options]"
+  parser = OptionParser(usage)
+  parser.add_option("-r", "--root", help="Root_Name directory of the daily files", dest="root")
+  parser.add_option("-o", "--output", help="cube filename", dest="output")
+  parser.add_option("-s", "--start", help="first year", dest="start", type="int")
+  parser.add_option("-e", "--end", help="last year", dest="end", type="int")
+
+  # Parse command line arguments
+  (options, args) = parser.parse_args()
+
+  if options.root == None or options.output == None:
+    print('\nRoot_Name directory and cube filename are required !\nProgram will exit now !\n')
+    parser.print_help()
+    exit(-1)
+
+  return( options )
+
+def standalone_main():
+
+  options = parseoptions()
+
+  start = time.time()
+  convert_tree(options.root, options.output, options.start, options.end)
+  end = time.time()
+  print (' Time spend = ' + str(end - start) + ' seconds')
+
+################################################################################################
+
+if __name__ == "__main__":
+        standalone_main()
@@ -141,6 +141,7 @@ def standalone_main():
    print("*** 5. Phenology Matrics: Spring Start Calculation")
    print("*** 6. Phenology Matrics: Summer Start/End Calculation")
    print("*** 7. Plotting")
+   print("*** 8. Phenology Matrics: Spring Start and Summer Start/End in one pass")
    print("*** -1. Quit\n")
   
    aselection = input('Please make your selection: ')
@@ -163,7 +164,10 @@ def standalone_main():
                                  float(config_input.get('DEFAULT', 'Lon_Min')),
                                  float(config_input.get('DEFAULT', 'Lon_Max')),
                                  int(config_input.get(dataset_name, 'Grid_Skip')),
-                                 shortname, config_input.get(dataset_name, 'Root_Name'))
+                                 shortname, config_input.get(dataset_name, 'Root_Name'),
+                                 int(config_input.get(dataset_name, 'Max_Concurrency', fallback=subset_dataset.maxConcurrency)),
+                                 int(config_input.get(dataset_name, 'Items_Per_Page', fallback=subset_dataset.itemsPerPage)),
+                                 config_input.get(dataset_name, 'Data_Cube', fallback=None) or None)
     userselection = 0
    elif(userselection == 1 and data_type == "Chlor" and dataset_name == "SeaWiFS"):
     subset_dataset.download_data_seawifs(config_input.get(dataset_name, 'Start_Year'),
@@ -177,7 +181,8 @@ def standalone_main():
                                  float(config_input.get('DEFAULT', 'Lon_Min')),
                                  float(config_input.get('DEFAULT', 'Lon_Max')),
                                  int(config_input.get(dataset_name, 'Grid_Skip')),
-                                 config_input.get(dataset_name, 'Root_Name'))
+                                 config_input.get(dataset_name, 'Root_Name'),
+                                 int(config_input.get(dataset_name, 'Max_Concurrency', fallback=subset_dataset.maxConcurrency)))
     userselection = 0
    elif(userselection == 1 and data_type == "Chlor" and dataset_name == "MODIS_Aqua_Chlor"):
     subset_dataset.download_data_modis(config_input.get(dataset_name, 'Start_Year'),
@@ -191,7 +196,8 @@ def standalone_main():
                                  float(config_input.get('DEFAULT', 'Lon_Min')),
                                  float(config_input.get('DEFAULT', 'Lon_Max')),
                                  int(config_input.get(dataset_name, 'Grid_Skip')),
-                                 config_input.get(dataset_name, 'Root_Name'))
+                                 config_input.get(dataset_name, 'Root_Name'),
+                                 int(config_input.get(dataset_name, 'Max_Concurrency', fallback=subset_dataset.maxConcurrency)))
     userselection = 0
    elif(userselection == 2 and data_type == "SST"):
     lats, lons = data_info.latloninfo(config_input.get(dataset_name, 'Root_Name'), shortname)
@@ -203,7 +209,9 @@ def standalone_main():
                 config_input.get(dataset_name, 'Parameter_Name'), 
 		config_input.get(dataset_name, 'Root_Name'),
 		config_input.get(dataset_name, 'Climatology_File'), 
-		config_input.get(dataset_name, 'Root_Name'))
+		data_info.data_dirname(config_input, dataset_name),
+		int(config_input.get(dataset_name, 'Tile_Size', fallback=0)),
+		int(config_input.get(dataset_name, 'Prefetch', fallback=0)))
     userselection = 0
    elif(userselection == 2 and data_type == "Chlor"):
     lats, lons = data_info.latloninfo_seawifs(config_input.get(dataset_name, 'Root_Name'), int(config_input.get(dataset_name, 'Start_Year')))
@@ -262,8 +270,10 @@ def standalone_main():
                     config_input.get(dataset_name, 'Parameter_Name'), 
                     config_input.get(dataset_name, 'Parameter_Error_Name'), 
 		    config_input.get(dataset_name, 'Root_Name')+"/"+config_input.get(dataset_name, 'Climatology_File_Box'), 
-		    config_input.get(dataset_name, 'Root_Name'),
-		    config_input.get(dataset_name, 'Root_Name') + "/" + config_input.get(dataset_name, 'Output_Dir') )
+		    data_info.data_dirname(config_input, dataset_name),
+		    config_input.get(dataset_name, 'Root_Name') + "/" + config_input.get(dataset_name, 'Output_Dir'),
+		    config_input.getboolean(dataset_name, 'Box_Cubes', fallback=True),
+		    prefetch=int(config_input.get(dataset_name, 'Prefetch', fallback=0)) )
     userselection = 0
    elif(userselection == 5):
     lats, lons = data_info.latloninfo(config_input.get(dataset_name, 'Root_Name'), shortname)
@@ -275,7 +285,11 @@ def standalone_main():
 		config_input.get(dataset_name, 'Root_Name')+"/"+config_input.get(dataset_name, 'Metric_Dir'), 
 		config_input.get(dataset_name, 'Metric_Spring_File'), 
 		config_input.get(dataset_name, 'Root_Name')+"/"+config_input.get(dataset_name, 'Climatology_File'), 
-		config_input.get(dataset_name, 'Root_Name'))
+		data_info.data_dirname(config_input, dataset_name),
+		config_input.get(dataset_name, 'Trend_Method', fallback='ols'),
+		int(config_input.get(dataset_name, 'Workers', fallback=1)),
+		int(config_input.get(dataset_name, 'Tile_Size', fallback=0)),
+		int(config_input.get(dataset_name, 'Prefetch', fallback=0)))
     userselection = 0
    elif(userselection == 6):
     lats, lons = data_info.latloninfo(config_input.get(dataset_name, 'Root_Name'), shortname)
@@ -286,7 +300,29 @@ def standalone_main():
 		config_input.get(dataset_name, 'Root_Name')+"/"+config_input.get(dataset_name, 'Metric_Dir'), 
 		config_input.get(dataset_name, 'Metric_Summer_File'), 
 		config_input.get(dataset_name, 'Root_Name')+"/"+config_input.get(dataset_name, 'Climatology_File'), 
-		config_input.get(dataset_name, 'Root_Name'))
+		data_info.data_dirname(config_input, dataset_name),
+		config_input.get(dataset_name, 'Trend_Method', fallback='ols'),
+		int(config_input.get(dataset_name, 'Workers', fallback=1)),
+		int(config_input.get(dataset_name, 'Tile_Size', fallback=0)),
+		int(config_input.get(dataset_name, 'Prefetch', fallback=0)))
+    userselection = 0
+   elif(userselection == 8):
+    lats, lons = data_info.latloninfo(config_input.get(dataset_name, 'Root_Name'), shortname)
+    phenologyalg.metric_spring_summer(lats, lons, int(config_input.get(dataset_name, 'Start_Year')), 
+                int(config_input.get(dataset_name, 'End_Year')), 
+                float(config_input.get('DEFAULT', 'Thresh_Spring1')), 
+                float(config_input.get('DEFAULT', 'Thresh_Spring2')), 
+                float(config_input.get('DEFAULT', 'Thresh_Offset_Summer')), 
+                config_input.get(dataset_name, 'Parameter_Name'), 
+		config_input.get(dataset_name, 'Root_Name')+"/"+config_input.get(dataset_name, 'Metric_Dir'), 
+		config_input.get(dataset_name, 'Metric_Spring_File'), 
+		config_input.get(dataset_name, 'Metric_Summer_File'), 
+		config_input.get(dataset_name, 'Root_Name')+"/"+config_input.get(dataset_name, 'Climatology_File'), 
+		data_info.data_dirname(config_input, dataset_name),
+		config_input.get(dataset_name, 'Trend_Method', fallback='ols'),
+		int(config_input.get(dataset_name, 'Workers', fallback=1)),
+		int(config_input.get(dataset_name, 'Tile_Size', fallback=0)),
+		int(config_input.get(dataset_name, 'Prefetch', fallback=0)))
     userselection = 0
    elif(userselection == 7):
      aselection = 0 
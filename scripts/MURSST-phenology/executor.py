@@ -0,0 +1,121 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Year-parallel executor for the analysis steps.
+
+The output arrays of a step are allocated in shared memory and every
+worker process attaches to them once, so a year's task only receives the
+year number and writes its slice of the outputs in place; no large array
+is pickled in either direction.
+
+  arrays = executor.SharedArrays(workers)
+  out = arrays.create('day_min', (nlat, nlon, ny))
+  executor.map_years(yearly_function, years, arrays, context, workers)
+  ...
+  arrays.close()
+
+yearly_function(year, arrays, context) must be a module-level function;
+arrays maps names to the shared numpy arrays and context holds the small
+read-only inputs.  With workers <= 1 everything runs in this process on
+ordinary numpy arrays.
+"""
+
+import sys, os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+#####################
+# Global Parameters #
+#####################
+
+_arrays = {}
+_blocks = []
+_context = None
+
+###############
+# subroutines #
+###############
+class SharedArrays(object):
+  """Named numpy arrays, in shared memory when more than one worker is used"""
+
+  def __init__(self, workers=1):
+    self.shared = workers > 1
+    self.arrays = {}
+    self.blocks = {}
+
+  def create(self, name, shape, fill=np.nan, dtype=np.float64):
+    if self.shared:
+      nbytes = max(1, int(np.prod(shape))*np.dtype(dtype).itemsize)
+      block = shared_memory.SharedMemory(create=True, size=nbytes)
+      array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+      self.blocks[name] = block
+    else:
+      array = np.empty(shape, dtype=dtype)
+    array[...] = fill
+    self.arrays[name] = array
+    return array
+
+  def spec(self):
+    return {name: (self.blocks[name].name, array.shape, array.dtype.str) for name, array in self.arrays.items()}
+
+  def copy(self, name):
+    """Private copy of an array, valid after close()"""
+    return np.array(self.arrays[name])
+
+  def close(self):
+    self.arrays = {}
+    for block in self.blocks.values():
+      block.close()
+      block.unlink()
+    self.blocks = {}
+
+def tile_windows(nlat, nlon, tile_size=0):
+  """(lat slice, lon slice) of every tile of a grid, row by row
+
+  Tiles are tile_size x tile_size grid points (smaller at the edges);
+  tile_size <= 0 gives one window over the whole grid.
+  """
+  if tile_size <= 0:
+    return [(slice(0, nlat), slice(0, nlon))]
+  windows = []
+  for i0 in range(0, nlat, tile_size):
+    for j0 in range(0, nlon, tile_size):
+      windows.append((slice(i0, min(i0+tile_size, nlat)), slice(j0, min(j0+tile_size, nlon))))
+  return windows
+
+def window_shape(window):
+  return (window[0].stop - window[0].start, window[1].stop - window[1].start)
+
+def _attach(spec, context):
+  global _context
+  for name, (blockname, shape, dtype) in spec.items():
+    block = shared_memory.SharedMemory(name=blockname)
+    _blocks.append(block)
+    _arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+  _context = context
+
+def _run(func, year):
+  func(year, _arrays, _context)
+  return year
+
+def map_years(func, years, arrays, context, workers=1):
+  """Call func(year, arrays, context) for every year, on up to workers processes"""
+  years = list(years)
+  if workers <= 1 or not arrays.shared or len(years) <= 1:
+    for year in years:
+      func(year, arrays.arrays, context)
+    return
+  with ProcessPoolExecutor(max_workers=min(workers, len(years)), initializer=_attach, initargs=(arrays.spec(), context)) as pool:
+    for year in pool.map(_run, [func]*len(years), years):
+      pass
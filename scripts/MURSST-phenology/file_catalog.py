@@ -0,0 +1,164 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Catalog of the daily files under a Root_Name/YYYY/DDD/ tree.
+
+The catalog is kept in Root_Name/file_catalog.json with one record per
+file (date, variables, shape, mtime, size) and the mtime of every day
+directory.  It is built the first time a tree is used and afterwards only
+day directories whose mtime changed are listed again, so the analysis
+steps look their input files up per day instead of globbing 366
+directories per year.
+"""
+
+import sys, os
+import json
+import datetime
+from netCDF4 import Dataset
+
+#####################
+# Global Parameters #
+#####################
+
+catalogName = 'file_catalog.json'
+
+_catalogs = {}
+
+###############
+# subroutines #
+###############
+def _isyear(name):
+  return len(name) == 4 and name.isdigit()
+
+def _isday(name):
+  return len(name) == 3 and name.isdigit()
+
+class Catalog(object):
+  """Daily files of one Root_Name tree, indexed by (year, day number)"""
+
+  def __init__(self, rootdir):
+    self.rootdir = rootdir
+    self.filename = rootdir + '/' + catalogName
+    self.dirs = {}
+    self.files = {}
+    if os.path.exists(self.filename):
+      try:
+        with open(self.filename) as f:
+          data = json.load(f)
+        self.dirs = data['dirs']
+        self.files = data['files']
+      except (ValueError, KeyError):
+        self.dirs = {}
+        self.files = {}
+    self._index()
+
+  def _index(self):
+    self.days = {}
+    for relpath in self.files:
+      year, day, name = relpath.split('/')
+      self.days.setdefault((int(year), int(day)), []).append(relpath)
+    for relpaths in self.days.values():
+      relpaths.sort()
+
+  def _describe(self, relpath, entry, day):
+    """Catalog record of one daily file"""
+    ncin = Dataset(self.rootdir + '/' + relpath, 'r')
+    variables = {}
+    for name, var in ncin.variables.items():
+      variables[name] = list(var.shape)
+    ncin.close()
+    stat = entry.stat()
+    return {'date': day.strftime('%Y%m%d'), 'variables': variables,
+            'mtime': stat.st_mtime, 'size': stat.st_size}
+
+  def update(self):
+    """Rescan the day directories that changed since the catalog was saved"""
+    if not os.path.isdir(self.rootdir):
+      return
+    changed = False
+    seen = set()
+    for yentry in os.scandir(self.rootdir):
+      if not (yentry.is_dir() and _isyear(yentry.name)):
+        continue
+      for dentry in os.scandir(yentry.path):
+        if not (dentry.is_dir() and _isday(dentry.name)):
+          continue
+        reldir = yentry.name + '/' + dentry.name
+        seen.add(reldir)
+        mtime = dentry.stat().st_mtime
+        if self.dirs.get(reldir) == mtime:
+          continue
+
+        # list the changed day directory and describe new or modified files
+        day = datetime.date(int(yentry.name), 1, 1) + datetime.timedelta(days=int(dentry.name)-1)
+        present = set()
+        skipped = False
+        for fentry in os.scandir(dentry.path):
+          if not (fentry.is_file() and fentry.name.endswith('.nc')):
+            continue
+          relpath = reldir + '/' + fentry.name
+          present.add(relpath)
+          stat = fentry.stat()
+          old = self.files.get(relpath)
+          if old is None or old['mtime'] != stat.st_mtime or old['size'] != stat.st_size:
+            try:
+              self.files[relpath] = self._describe(relpath, fentry, day)
+            except (IOError, OSError):
+              present.discard(relpath)  # unreadable, e.g. still being written
+              self.files.pop(relpath, None)
+              skipped = True
+              continue
+        for relpath in self.days.get((day.year, int(dentry.name)), []):
+          if relpath not in present:
+            self.files.pop(relpath, None)
+        # a skipped file may not touch the directory again when it is
+        # complete, so leave the directory marked for the next rescan
+        self.dirs[reldir] = None if skipped else mtime
+        changed = True
+
+    for reldir in [d for d in self.dirs if d not in seen]:
+      year, day = reldir.split('/')
+      for relpath in self.days.get((int(year), int(day)), []):
+        self.files.pop(relpath, None)
+      del self.dirs[reldir]
+      changed = True
+
+    if changed:
+      self._index()
+      self.save()
+
+  def save(self):
+    tmpfile = self.filename + '.%d.tmp' % os.getpid()
+    with open(tmpfile, 'w') as f:
+      json.dump({'dirs': self.dirs, 'files': self.files}, f)
+    os.replace(tmpfile, self.filename)
+
+  def day_files(self, year, day):
+    """Paths of the files of a day number, sorted by name"""
+    return [self.rootdir + '/' + relpath for relpath in self.days.get((year, day), [])]
+
+  def years(self):
+    return sorted(set(year for year, day in self.days))
+
+def get_catalog(rootdir):
+  """The catalog of rootdir, brought up to date on first use in a process"""
+  key = os.path.abspath(rootdir)
+  if key not in _catalogs:
+    catalog = Catalog(rootdir)
+    catalog.update()
+    _catalogs[key] = catalog
+  return _catalogs[key]
+
+def invalidate(rootdir):
+  """Make the next get_catalog(rootdir) rescan, call after writing into the tree"""
+  _catalogs.pop(os.path.abspath(rootdir), None)
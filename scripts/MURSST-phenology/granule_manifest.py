@@ -0,0 +1,151 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Download manifest for resumable, idempotent granule downloads.
+
+Every granule written under Root_Name is recorded in
+Root_Name/download_manifest.jsonl, one JSON record per line:
+
+  {"file": "2010/001/20100101..._subset.nc", "url": "...", "updated": "...",
+   "size": 123456, "md5": "...", "status": "done", "time": "..."}
+
+The file is append-only and the last record of a file wins, so a crash
+never corrupts earlier entries.  On a rerun only granules that are
+missing, failed, or changed (different request URL, a newer "updated"
+stamp from the granule search, or a local file whose size or md5 no
+longer matches) are fetched again.  Interrupted transfers are kept as
+<file>.part and resumed with an HTTP Range request.
+"""
+
+import sys, os
+import json
+import time
+import hashlib
+import threading
+
+import http_pool
+
+#####################
+# Global Parameters #
+#####################
+
+manifestName = 'download_manifest.jsonl'
+
+###############
+# subroutines #
+###############
+def file_checksum(filename):
+  """md5 of a file, read in blocks"""
+  md5 = hashlib.md5()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(http_pool.blockSize), b''):
+      md5.update(block)
+  return md5.hexdigest()
+
+class Manifest(object):
+  """Thread-safe view of Root_Name/download_manifest.jsonl
+
+  With verify (the default) a local file only counts as current when its
+  md5 matches the recorded one; verify=False checks the size only.
+  """
+
+  def __init__(self, rootdir, verify=True):
+    self.rootdir = rootdir
+    self.verify = verify
+    self.filename = rootdir + '/' + manifestName
+    self.entries = {}
+    self._lock = threading.Lock()
+    if os.path.exists(self.filename):
+      with open(self.filename) as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue  # a line cut short by a crash
+          self.entries[entry['file']] = entry
+
+  def key(self, outfile):
+    return os.path.relpath(outfile, self.rootdir)
+
+  def get(self, outfile):
+    with self._lock:
+      return self.entries.get(self.key(outfile))
+
+  def record(self, outfile, url, status, updated=None, size=None, md5=None):
+    entry = {'file': self.key(outfile), 'url': url, 'updated': updated,
+             'size': size, 'md5': md5, 'status': status,
+             'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    with self._lock:
+      self.entries[entry['file']] = entry
+      if not os.path.exists(self.rootdir):
+        os.makedirs(self.rootdir)
+      with open(self.filename, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+  def is_current(self, outfile, url, updated=None):
+    """True if outfile is complete and was downloaded from the same request"""
+    entry = self.get(outfile)
+    if entry is None or entry['status'] != 'done':
+      return False
+    if entry['url'] != url or entry.get('updated') != updated:
+      return False
+    if not (os.path.exists(outfile) and os.path.getsize(outfile) == entry['size']):
+      return False
+    if self.verify and entry.get('md5'):
+      return file_checksum(outfile) == entry['md5']
+    return True
+
+  def fetch(self, url, outfile, updated=None, minsize=0):
+    """Download url to outfile unless it is already current
+
+    Returns True if outfile holds the granule afterwards.  Transfers that
+    were interrupted or cut short earlier are recorded as failed and
+    resume from outfile.part on the next call, and responses smaller
+    than minsize bytes (error pages) are discarded and recorded as failed.
+    """
+    if self.is_current(outfile, url, updated):
+      print (outfile + ' is up to date, skipped !')
+      return True
+
+    partfile = outfile + '.part'
+    offset = 0
+    entry = self.get(outfile)
+    if os.path.exists(partfile):
+      if entry is not None and entry['url'] == url and entry.get('updated') == updated:
+        offset = os.path.getsize(partfile)
+      else:
+        os.remove(partfile)
+
+    self.record(outfile, url, 'started', updated)
+    try:
+      size = http_pool.download(url, partfile, offset=offset)
+    except http_pool.IncompleteDownload as e:
+      # keep outfile.part, the next run asks for the rest
+      print (e)
+      self.record(outfile, url, 'failed', updated, e.nbytes)
+      return False
+    except Exception as e:
+      print (e)
+      self.record(outfile, url, 'failed', updated)
+      return False
+
+    if size < minsize:
+      os.remove(partfile)
+      self.record(outfile, url, 'failed', updated, size)
+      return False
+
+    os.replace(partfile, outfile)
+    self.record(outfile, url, 'done', updated, size, file_checksum(outfile))
+    print (outfile + ' download finished !')
+    return True
@@ -0,0 +1,233 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Shared in-process HTTP transport for the download module.
+
+Connections are kept alive and pooled per (scheme, host, port), so the
+thousands of daily requests sent to podaac.jpl.nasa.gov or
+oceandata.sci.gsfc.nasa.gov reuse a handful of TLS sessions instead of
+starting a new curl process and handshake for every file.  All functions
+are safe to call from the download worker threads.
+"""
+
+import sys, os
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+
+#####################
+# Global Parameters #
+#####################
+
+maxRedirects = 5
+maxIdle = 16             # idle connections kept per host
+blockSize = 1024*1024    # streaming block size in bytes
+timeout = 300            # socket timeout in seconds
+userAgent = 'podaac-phenology/1.0'
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+class HTTPError(IOError):
+  def __init__(self, url, status, reason):
+    IOError.__init__(self, 'HTTP %d %s: %s' % (status, reason, url))
+    self.url = url
+    self.status = status
+
+class IncompleteDownload(IOError):
+  """The connection closed before the announced size of the body arrived"""
+  def __init__(self, url, nbytes, expected):
+    IOError.__init__(self, 'incomplete download, %d of %d bytes: %s' % (nbytes, expected, url))
+    self.url = url
+    self.nbytes = nbytes
+    self.expected = expected
+
+###############
+# subroutines #
+###############
+def _hostkey(url):
+  parts = urlsplit(url)
+  port = parts.port
+  if port is None:
+    port = 443 if parts.scheme == 'https' else 80
+  return (parts.scheme, parts.hostname, port)
+
+def _connect(key):
+  scheme, host, port = key
+  if scheme == 'https':
+    return http.client.HTTPSConnection(host, port, timeout=timeout)
+  return http.client.HTTPConnection(host, port, timeout=timeout)
+
+def _acquire(key):
+  with _pools_lock:
+    idle = _pools.setdefault(key, [])
+    if idle:
+      return idle.pop(), True
+  return _connect(key), False
+
+def _release(key, conn):
+  with _pools_lock:
+    idle = _pools.setdefault(key, [])
+    if len(idle) < maxIdle:
+      idle.append(conn)
+      return
+  conn.close()
+
+def close_all():
+  """Close every pooled connection"""
+  with _pools_lock:
+    for idle in _pools.values():
+      for conn in idle:
+        conn.close()
+    _pools.clear()
+
+def _selector(url):
+  parts = urlsplit(url)
+  path = parts.path or '/'
+  if parts.query:
+    path = path + '?' + parts.query
+  return path
+
+class Response(object):
+  """An open response; the connection goes back to the pool on close()"""
+
+  def __init__(self, url, key, conn, resp):
+    self.url = url
+    self.status = resp.status
+    self.headers = resp.msg
+    self._key = key
+    self._conn = conn
+    self._resp = resp
+
+  def read(self, amt=None):
+    return self._resp.read(amt)
+
+  def __iter__(self):
+    while True:
+      block = self._resp.read(blockSize)
+      if not block:
+        break
+      yield block
+
+  def close(self):
+    if self._conn is None:
+      return
+    if self._resp.isclosed() and not self._resp.will_close:
+      _release(self._key, self._conn)
+    else:
+      self._conn.close()
+    self._conn = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def urlopen(url, headers=None):
+  """Send a GET request and return an open Response, following redirects"""
+  sendheaders = {'User-Agent': userAgent, 'Accept-Encoding': 'identity'}
+  if headers:
+    sendheaders.update(headers)
+
+  for redirect in range(maxRedirects+1):
+    key = _hostkey(url)
+    conn, reused = _acquire(key)
+    try:
+      conn.request('GET', _selector(url), headers=sendheaders)
+      resp = conn.getresponse()
+    except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+      # the server dropped an idle keep-alive connection, retry on a new one
+      conn.close()
+      if not reused:
+        raise
+      conn = _connect(key)
+      try:
+        conn.request('GET', _selector(url), headers=sendheaders)
+        resp = conn.getresponse()
+      except:
+        conn.close()
+        raise
+    except:
+      conn.close()
+      raise
+
+    if resp.status in (301, 302, 303, 307, 308):
+      location = resp.getheader('Location')
+      resp.read()
+      Response(url, key, conn, resp).close()
+      if location is None:
+        raise HTTPError(url, resp.status, resp.reason)
+      url = urljoin(url, location)
+      continue
+    if resp.status >= 400:
+      resp.read()
+      Response(url, key, conn, resp).close()
+      raise HTTPError(url, resp.status, resp.reason)
+    return Response(url, key, conn, resp)
+
+  raise HTTPError(url, resp.status, 'too many redirects')
+
+def fetch(url, headers=None):
+  """Return the body of url as bytes"""
+  with urlopen(url, headers) as resp:
+    return resp.read()
+
+def _expected_size(resp, offset):
+  """Final file size announced by Content-Range or Content-Length, None if unknown"""
+  if resp.status == 206:
+    content_range = resp.headers.get('Content-Range', '')
+    total = content_range.rsplit('/', 1)[-1]
+    if total.isdigit():
+      return int(total)
+  length = resp.headers.get('Content-Length')
+  if length is None or not length.isdigit():
+    return None
+  return int(length) + (offset if resp.status == 206 else 0)
+
+def download(url, outfile, headers=None, offset=0):
+  """Stream the body of url into outfile, returns the size of outfile
+
+  With offset > 0 the transfer resumes with an HTTP Range request and the
+  remaining bytes are appended to outfile; servers that ignore the range
+  send the whole body again and outfile is rewritten from the start.
+  Raises IncompleteDownload if the connection closes before the size
+  announced by the server is reached; outfile keeps the bytes received.
+  """
+  sendheaders = dict(headers or {})
+  if offset > 0:
+    sendheaders['Range'] = 'bytes=%d-' % offset
+  try:
+    resp = urlopen(url, sendheaders)
+  except HTTPError as e:
+    if e.status != 416 or offset == 0:
+      raise
+    # the range is past the end of the file, start over
+    return download(url, outfile, headers)
+
+  with resp:
+    if offset > 0 and resp.status == 206:
+      mode = 'ab'
+      nbytes = offset
+    else:
+      mode = 'wb'
+      nbytes = 0
+    expected = _expected_size(resp, nbytes)
+    with open(outfile, mode) as f:
+      for block in resp:
+        f.write(block)
+        nbytes = nbytes + len(block)
+  # a body cut short ends like a complete one, only the size tells
+  if expected is not None and nbytes < expected:
+    raise IncompleteDownload(url, nbytes, expected)
+  return nbytes
@@ -33,6 +33,10 @@ from sklearn import linear_model, datasets
 from pathlib import Path
 
 import data_info
+import datacube
+import file_catalog
+import trend
+import executor
 
 ################################################################################################   
 def moving_average(a, n=15):
@@ -45,6 +49,202 @@ def moving_average(a, n=15):
     ret[a.mask] = np.nan
     return ret
 
+def moving_average_nd(a, n=15):
+    """Moving Average along the last axis of a, NaN-aware
+
+    Same trailing window as moving_average() for every 1-D series of a at
+    once: NaN days are left out of the mean and stay NaN.
+    """
+    missing = np.isnan(a)
+    ret = np.cumsum(np.where(missing, 0.0, a), axis=-1)
+    ret[...,n:] = ret[...,n:] - ret[...,:-n]
+    counts = np.cumsum(~missing, axis=-1)
+    counts[...,n:] = counts[...,n:] - counts[...,:-n]
+    out = np.full(ret.shape, np.nan)
+    np.divide(ret, counts, out=out, where=~missing)
+    return out
+
+def extrema_days(smooth):
+    """Day and value of the minimum and maximum along the last axis, NaN-aware
+
+    Returns day_min, data_min, day_max, data_max; series that are all NaN
+    get NaN, and a minimum after day 300 is not counted as the coldest day.
+    """
+    empty = np.isnan(smooth).all(axis=-1)
+    day_min = np.argmin(np.where(np.isnan(smooth), np.inf, smooth), axis=-1).astype(float)
+    day_max = np.argmax(np.where(np.isnan(smooth), -np.inf, smooth), axis=-1).astype(float)
+    data_min = np.take_along_axis(smooth, day_min.astype(int)[...,None], axis=-1)[...,0]
+    data_max = np.take_along_axis(smooth, day_max.astype(int)[...,None], axis=-1)[...,0]
+    day_min[day_min > 300] = np.nan
+    for field in (day_min, data_min, day_max, data_max):
+        field[empty] = np.nan
+    return day_min, data_min, day_max, data_max
+
+def first_crossing(series, start, thresholds, stop=None, below=False, inclusive=False):
+    """First day at or after start on which series crosses each threshold
+
+    series is (..., nd) with NaN for missing days, start is the per-pixel
+    first day to search (NaN: no search) and stop the end of the search
+    (default nd).  thresholds is a list of scalars or per-pixel arrays;
+    the result is stacked as (len(thresholds), ...) with the day index or
+    NaN where the threshold is never crossed.  The crossing test is
+    series > threshold (>= with inclusive), or < (<=) with below.
+
+    The running maximum of the searched window is built once, so every
+    extra threshold only costs a comparison.
+    """
+    nd = series.shape[-1]
+    if stop is None:
+        stop = nd
+    sign = -1.0 if below else 1.0
+    days = np.arange(nd)
+    window = (days >= np.asarray(start, dtype=float)[...,None]) & (days < stop) & ~np.isnan(series)
+    running = np.maximum.accumulate(np.where(window, sign*series, -np.inf), axis=-1)
+
+    out = []
+    for thresh in thresholds:
+        thresh = sign*np.asarray(thresh, dtype=float)
+        if inclusive:
+            before = running < thresh[...,None]
+            found = running[...,-1] >= thresh
+        else:
+            before = running <= thresh[...,None]
+            found = running[...,-1] > thresh
+        out.append(np.where(found, before.sum(axis=-1), np.nan))
+    return np.array(out)
+
+def fit_day_turn(diff_clim, min_valid=2):
+    """Day the SST climatology starts rising, per pixel
+
+    A degree-6 polynomial is fitted to the valid (non-NaN) values of each
+    pixel's diff_sst_climatology (lat, lon, 366) and day_turn is the first
+    day number (1-365) on which the fit is positive.  Pixels with min_valid
+    or fewer valid days, or whose fit never turns positive, get NaN.  All
+    pixels are fitted at once with a Legendre basis (the same polynomial
+    space as np.polyfit, but well conditioned) and per-pixel weights of 0/1.
+    """
+    nlat, nlon, nd = diff_clim.shape
+    y = np.ma.filled(diff_clim, np.nan).reshape(-1, nd)
+    valid = np.isfinite(y)
+    n = valid.sum(axis=1)
+    w = valid.astype(float)
+    y = np.where(valid, y, 0.0)
+
+    basis = np.polynomial.legendre.legvander(np.linspace(-1.0, 1.0, nd), 6)
+    gram = (w @ (basis[:,:,None]*basis[:,None,:]).reshape(nd, -1)).reshape(-1, 7, 7)
+    rhs = (w*y) @ basis
+
+    coef = np.zeros((y.shape[0], 7))
+    full = n >= 7
+    coef[full] = np.linalg.solve(gram[full], rhs[full][:,:,None])[:,:,0]
+    ys = coef @ basis.T
+
+    # too few days for a unique fit, np.polyfit gives the minimum-norm solution
+    xrange = np.arange(nd)
+    for p in np.where((n > min_valid) & ~full)[0]:
+        ys[p] = np.poly1d(np.polyfit(xrange[valid[p]], y[p,valid[p]], 6))(xrange)
+
+    positive = ys[:,0:365] > 0
+    day_turn = np.where(positive.any(axis=1), np.argmax(positive, axis=1) + 1.0, np.nan)
+    day_turn[n <= min_valid] = np.nan
+    return day_turn.reshape(nlat, nlon)
+
+def read_day_turn(clim_filename, window=None):
+    """diff_sst_climatology and day_turn of a climatology file
+
+    window = (lat slice, lon slice) reads only that part of the grid.
+    Climatology files written before day_turn was stored get it fitted here.
+    """
+    if window is None:
+        window = (slice(None), slice(None))
+    ncin = Dataset(clim_filename, 'r')
+    diff_clim = ncin.variables['diff_sst_climatology'][window[0],window[1],:]
+    if 'day_turn' in ncin.variables:
+        day_turn = np.ma.filled(ncin.variables['day_turn'][window[0],window[1]].astype(float), np.nan)
+    else:
+        day_turn = fit_day_turn(diff_clim)
+    ncin.close()
+    return diff_clim, day_turn
+
+def _box_reduce(ufunc, a, start, end, axis, fill):
+    """ufunc reduction of a over [start[b], end[b]) along axis for every box b
+
+    Boxes with end <= start get fill.
+    """
+    n = a.shape[axis]
+    index = np.empty(2*len(start), dtype=np.intp)
+    index[0::2] = start
+    index[1::2] = end
+    index = np.minimum(index, n)
+    if index.max() >= n:
+        # reduceat indices must be < n, add a row for boxes ending at the edge
+        pad = [(0, 0)]*a.ndim
+        pad[axis] = (0, 1)
+        a = np.pad(a, pad, constant_values=fill)
+    ret = np.take(ufunc.reduceat(a, index, axis=axis), np.arange(0, index.size, 2), axis=axis)
+    empty = np.asarray(end) <= np.asarray(start)
+    if empty.any():
+        shape = [1]*a.ndim
+        shape[axis] = empty.size
+        ret = np.where(empty.reshape(shape), fill, ret)
+    return ret
+
+def _box_block(data, valid, lat0, lat1, lon0, lon1):
+    """box_statistics() of one (lat, lon, m) block"""
+
+    def reduce2(ufunc, a, fill):
+        return _box_reduce(ufunc, _box_reduce(ufunc, a, lat0, lat1, 0, fill), lon0, lon1, 1, fill)
+
+    # sums of the values shifted by the field mean, for an accurate variance
+    count = reduce2(np.add, valid.astype(np.float64), 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = np.where(valid, data, 0.0).sum(axis=(0,1)) / valid.sum(axis=(0,1))
+    shift = np.where(np.isfinite(shift), shift, 0.0)
+    x = np.where(valid, data - shift, 0.0)
+    s1 = reduce2(np.add, x, 0.0)
+    s2 = reduce2(np.add, x*x, 0.0)
+    del x
+    amin = reduce2(np.minimum, np.where(valid, data, np.inf), np.inf)
+    amax = reduce2(np.maximum, np.where(valid, data, -np.inf), -np.inf)
+
+    empty = count == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1/count
+        std = np.sqrt(np.maximum(s2/count - mean*mean, 0.0))
+    mean = mean + shift
+    for a in (mean, std, amin, amax):
+        a[empty] = np.nan
+    return {'count': count, 'average': mean, 'std': std, 'min': amin, 'max': amax}
+
+def box_statistics(data, valid, box_lat_start, box_lat_end, box_lon_start, box_lon_end, block=32):
+    """Count, mean, std, min and max of the valid values of every box
+
+    data is (lat, lon, ...), valid a boolean array of the same shape; box b
+    covers rows box_lat_start[b]:box_lat_end[b] (data_info.getboxinfo()).
+    All boxes are reduced at once by segment sums along lat, then lon, for
+    block trailing elements (days) at a time.  Returns a dict of
+    (nx, ny, ...) arrays; boxes without valid values get count 0 and NaN
+    statistics.  std has ddof=0 like np.nanstd.
+    """
+    lat0 = box_lat_start.astype(np.intp)
+    lat1 = box_lat_end.astype(np.intp)
+    lon0 = box_lon_start.astype(np.intp)
+    lon1 = box_lon_end.astype(np.intp)
+    nlat, nlon = data.shape[0:2]
+    trailing = data.shape[2:]
+    data = np.ma.getdata(data).reshape(nlat, nlon, -1)
+    valid = valid.reshape(nlat, nlon, -1)
+
+    stats = {}
+    for b0 in range(0, data.shape[2], block):
+        b1 = min(b0 + block, data.shape[2])
+        result = _box_block(data[:,:,b0:b1], valid[:,:,b0:b1] & np.isfinite(data[:,:,b0:b1]), lat0, lat1, lon0, lon1)
+        for name, a in result.items():
+            if name not in stats:
+                stats[name] = np.empty(a.shape[0:2] + (data.shape[2],), dtype=np.int32 if name == 'count' else np.float64)
+            stats[name][:,:,b0:b1] = a
+    return {name: a.reshape(a.shape[0:2] + trailing) for name, a in stats.items()}
+
 def runningMeanFast(x, N):
     """Running mean using numpy internal convolve routine"""
     #return np.convolve(x, np.ones((N,))/N, mode='full')[(N-1):]
@@ -72,75 +272,55 @@ def parseoptions():
 
   return( options )
 
-def climatology(lats, lons, startY, endY, spring_thresh1, spring_thresh2, summer_thresh_offset, variablename, outdir, outfilename, dirname):
+def climatology_tile(startY, endY, variablename, dirname, window, prefetch=0):
+  """Climatology, day_turn and monthly trend of one (lat slice, lon slice) window
 
+  Returns a dict of the output variables of the climatology file for the
+  window.  prefetch is passed to datacube.iter_daily_fields().
+  """
   ny = endY - startY + 1
+  nlat, nlon = executor.window_shape(window)
 
-  # define variables
-  sst_all        = np.empty((lats.size, lons.size, 366))
-  sst_all_number = np.empty((lats.size, lons.size, 366))
-  data_year_all  = np.empty((ny, 12, 31, lats.size, lons.size))
-  diff_sst_all        = np.empty((lats.size, lons.size, 366))
-
-  data_year_all[:] = np.nan
+  # define variables, day-major so every daily field is a contiguous slice
+  sst_all        = np.zeros((366, nlat, nlon))
+  sst_all_number = np.zeros((366, nlat, nlon))
+  diff_sst_all   = np.zeros((nlat, nlon, 366))
 
-  nlat = lats.size
-  nlon = lons.size
+  # running sums and counts of the first 28 days of every month and year, for the trend
+  month_sum      = np.zeros((ny, 12, nlat, nlon))
+  month_number   = np.zeros((ny, 12, nlat, nlon), dtype=np.int32)
 
   for i in range(startY, endY+1):
     print("Processing Year = " + str(i))
     nd = 0
-    for j in range(1, 367):
-       for filename in glob.glob(dirname+'/'+str(i)+'/'+"{0:0>3}".format(j)+'/*.nc'):
-         ncfile = filename.rsplit( "/")[ -1 ]
-         ncin = Dataset(filename, 'r')
-         asst = ncin.variables[variablename][:]
-         sst = asst.squeeze()
-         #sst = asst[0,:,:]
-         lons = ncin.variables['lon'][:]
-         lats = ncin.variables['lat'][:]
-         amask = ncin.variables['mask'][:]
-         mask = amask[0,:,:]
-         #get global attributes
-         atts = ncin.__dict__
-         for att,val in atts.items():
-           if att.find('start_time') != -1: 
-             start_time = val
-             continue
-         ncin.close()
-         #aindex = ( (sst > -250.0) & (sst < 350.0) & (mask == 1) )
-         #sst_all[aindex,j-1] = sst_all[aindex,j-1] + sst[aindex]
-         #sst_all_number[aindex,j-1] = sst_all_number[aindex,j-1] + 1
-         aindex = np.where( (sst > -250.0) & (sst < 350.0) & (mask == 1) )
-         sst_all[aindex[0][:],aindex[1][:],j-1] = sst_all[aindex[0][:],aindex[1][:],j-1] + sst[aindex[0][:],aindex[1][:]]
-         sst_all_number[aindex[0][:],aindex[1][:],j-1] = sst_all_number[aindex[0][:],aindex[1][:],j-1] + 1
-         data_year_all[i-startY,int(start_time[4:6])-1,int(start_time[6:8])-1, :,:] = sst[0:nlat,0:nlon]
+    for j, fields, start_time in datacube.iter_daily_fields(dirname, i, [variablename, 'mask'], window, prefetch):
+         sst = fields[variablename]
+         mask = fields['mask']
+         aindex = (sst > -250.0) & (sst < 350.0) & (mask == 1)
+         np.add(sst_all[j-1], sst, out=sst_all[j-1], where=aindex)
+         sst_all_number[j-1] += aindex
+         if int(start_time[6:8]) <= 28:
+           valid = sst >= 0.0
+           k = int(start_time[4:6])-1
+           np.add(month_sum[i-startY,k], sst, out=month_sum[i-startY,k], where=valid)
+           month_number[i-startY,k] += valid
 
   # calculate climatology
-  sst_all = sst_all/sst_all_number
+  sst_all = np.moveaxis(sst_all/sst_all_number, 0, -1)
   diff_sst_all[:,:,1:] = np.diff(sst_all)
+  day_turn = fit_day_turn(diff_sst_all)
 
-  # trend calculation
-  data_rate=np.empty((12, nlat,nlon))
-  atemp=np.empty((ny, 28, 12))
-  data=np.empty((12,ny))
+  # trend calculation, monthly means of the first 28 days of every year
+  data = np.full(month_sum.shape, np.nan)
+  np.divide(month_sum, month_number, out=data, where=month_number > 0)
+  data_rate, _, _, data_rate_pvalue = trend.ols_trend(np.moveaxis(data, 0, -1))
 
-  for k in range(12):
-    for j in range(nlat):
-      for i in range(nlon):
-         atemp[:,:,k] = data_year_all[:,k,0:28,j,i]
-         b = atemp < 0.0
-         if np.count_nonzero(b) > 0:
-           atemp[b]=np.nan
-         if np.count_nonzero(b) == atemp.size:
-           data_rate[k,j,i] = np.nan 
-         else:
-           data[k,:] = np.nanmean(atemp[:,:,k], axis=1)
-           xx = np.arange(ny)
-           yy = np.squeeze(data[k,:])
-           #z = np.polyfit(range(ny), data[k,:], 1)
-           z = np.polyfit(xx[np.invert(np.isnan(yy))], yy[np.invert(np.isnan(yy))], 1)
-           data_rate[k,j,i] = z[0]
+  return {'sst_climatology': sst_all, 'diff_sst_climatology': diff_sst_all, 'day_turn': day_turn,
+          'data_rate': data_rate, 'data_rate_pvalue': data_rate_pvalue}
+
+def create_climatology_file(lats, lons, startY, endY, outdir, outfilename):
+  """Open a climatology output file with every variable defined, to be filled by tiles"""
+  ny = endY - startY + 1
 
   ### create output directory
   data_info.createdir(outdir)
@@ -149,8 +329,8 @@ def climatology(lats, lons, startY, endY, spring_thresh1, spring_thresh2, summer
   fid = Dataset(outdir+'/'+outfilename,'w')
 
   # Define the dimensions
-  nlat = fid.createDimension('lat', nlat) # Unlimited
-  nlon = fid.createDimension('lon', nlon) # Unlimited
+  nlat = fid.createDimension('lat', lats.size) # Unlimited
+  nlon = fid.createDimension('lon', lons.size) # Unlimited
   time = fid.createDimension('time', 366) # Unlimited
   month = fid.createDimension('month', 12) # Unlimited
   nyear = fid.createDimension('year', ny) # Unlimited
@@ -181,24 +361,53 @@ def climatology(lats, lons, startY, endY, spring_thresh1, spring_thresh2, summer
   fid.variables['year'].standard_name='Year'
 
   nc_var = fid.createVariable('sst_climatology', 'f8',('lat','lon','time'),zlib=True)
-  fid.variables['sst_climatology'][:] = sst_all
   fid.variables['sst_climatology'].standard_name='SST Average'
   fid.variables['sst_climatology'].units='kelvin'
 
   nc_var = fid.createVariable('diff_sst_climatology', 'f8',('lat','lon','time'),zlib=True)
-  fid.variables['diff_sst_climatology'][:] = diff_sst_all
   fid.variables['diff_sst_climatology'].standard_name='SST Different with previous day'
   fid.variables['diff_sst_climatology'].units='kelvin'
 
+  nc_var = fid.createVariable('day_turn', 'f8',('lat','lon'),zlib=True)
+  fid.variables['day_turn'].long_name='first day the polynomial fit of diff_sst_climatology is positive'
+  fid.variables['day_turn'].units='day number'
+
   nc_var = fid.createVariable('months', 'f8',('month'))
 
   nc_var = fid.createVariable('data_rate', 'f8',('month', 'lat', 'lon'))
-  fid.variables['data_rate'][:] = data_rate
   fid.variables['data_rate'].units='Kelvin/Yr'
   fid.variables['data_rate'].comment='analysed_sst'
 
+  nc_var = fid.createVariable('data_rate_pvalue', 'f8',('month', 'lat', 'lon'))
+  fid.variables['data_rate_pvalue'].long_name='two-sided p-value of the data_rate trend'
+
   fid.cdm_data_type         = "Grid"
-  fid.close()
+  return fid
+
+def write_climatology_tile(fid, clim, window):
+  """Write the climatology_tile() results of a window into an open climatology file"""
+  lat_slice, lon_slice = window
+  for name in ('sst_climatology', 'diff_sst_climatology'):
+    fid.variables[name][lat_slice,lon_slice,:] = clim[name]
+  fid.variables['day_turn'][lat_slice,lon_slice] = clim['day_turn']
+  for name in ('data_rate', 'data_rate_pvalue'):
+    fid.variables[name][:,lat_slice,lon_slice] = clim[name]
+
+def climatology(lats, lons, startY, endY, spring_thresh1, spring_thresh2, summer_thresh_offset, variablename, outdir, outfilename, dirname, tile_size=0, prefetch=0):
+  """Daily SST climatology, day_turn and monthly trend
+
+  With tile_size > 0 the grid is processed in tile_size x tile_size
+  tiles, each read from the daily files and written before the next one,
+  so memory is bounded by the tile instead of the domain.
+  """
+
+  fid = create_climatology_file(lats, lons, startY, endY, outdir, outfilename)
+  try:
+    for window in executor.tile_windows(lats.size, lons.size, tile_size):
+      clim = climatology_tile(startY, endY, variablename, dirname, window, prefetch)
+      write_climatology_tile(fid, clim, window)
+  finally:
+    fid.close()
   
   return
 
@@ -230,11 +439,14 @@ def climatology_chlor(lats, lons, startY, endY, latmin, latmax, lonmin, lonmax,
       range_end = 367
     else:
       range_end = 366
+    catalog = file_catalog.get_catalog(dirname)
     for j in range(1, range_end):
-       for filename in glob.glob(dirname+"/"+"{0:0>4}".format(i)+"/"+"{0:0>3}".format(j)+"/S"+"{0:0>4}".format(i)+"{0:0>3}".format(j)+'*.nc'):
+       for filename in catalog.day_files(i, j):
+         if not os.path.basename(filename).startswith("S"+"{0:0>4}".format(i)+"{0:0>3}".format(j)):
+           continue
          ncfile = filename.rsplit( "/")[ -1 ]
          ncin = Dataset(filename, 'r')
-         asst = ncin.variables[variablename][:]
+         asst = datacube.read_hyperslab(ncin.variables[variablename], (slice(None), slice(None)))
          sst = asst[::-1,:]
          #get global attributes
          atts = ncin.__dict__
@@ -322,221 +534,130 @@ def climatology_chlor(lats, lons, startY, endY, latmin, latmax, lonmin, lonmax,
   
   return
 
-def metric_spring_start(lats, lons, startY, endY, spring_thresh1, spring_thresh2, variablename, outdir, outfilename, clim_filename, dirname):
-
+def read_data_year(dirname, year, variablename, window, prefetch=0):
+  """Valid daily values of a year in a (lat slice, lon slice) window as a (lat, lon, 366) array, NaN where missing"""
+  nlat, nlon = executor.window_shape(window)
+  data_year = np.full((nlat, nlon, 366), np.nan)
+  for j, fields, start_time in datacube.iter_daily_fields(dirname, year, [variablename, 'mask'], window, prefetch):
+       sst = fields[variablename]
+       mask = fields['mask']
+       aindex = np.where( (sst > -250.0) & (sst < 350.0) & (mask == 1) )
+       data_year[aindex[0][:],aindex[1][:],j-1] = sst[aindex[0][:],aindex[1][:]]
+  return data_year
+
+def _metrics_year(i, arrays, context):
+  """Read, smooth and search one year of phenology_metrics"""
+  y = i - context['startY']
+  day_min = arrays['day_min']
+  print("Processing Year = " + str(i))
+  series = read_data_year(context['dirname'], i, context['variablename'], context['window'], context['prefetch'])
+
+  if 'data_summer_max_all' in arrays:
+    # summer start/end matrics calculation
+    # Step 1: find summer maximum for each year 
+    summer = moving_average_nd(series[:,:,150:150+90])
+    arrays['data_summer_max_all'][:,:,y] = extrema_days(summer)[3]
+
+  # smoothed daily series of the year, data max/date and min/date calculation
+  smooth = moving_average_nd(series)
+  day_min[:,:,y], arrays['data_min'][:,:,y], arrays['day_max'][:,:,y], arrays['data_max'][:,:,y] = extrema_days(smooth)
+
+  if 'day_spring' in arrays:
+    # spring start matrics calculation, first day after day_turn and before day 300 above each threshold
+    spring = first_crossing(smooth, context['day_turn'], context['spring_thresholds'], stop=300)
+    spring[:, np.isnan(day_min[:,:,y])] = np.nan
+    arrays['day_spring'][...,y] = spring
+
+  if 'data_year' in arrays:
+    arrays['data_year'][:,:,:,y] = smooth
+
+def _summer_year(i, arrays, context):
+  """Summer start/end days of one year of phenology_metrics"""
+  y = i - context['startY']
+  atemp = arrays['data_year'][:,:,:,y]
+  invalid = np.isnan(arrays['day_min'][:,:,y])
+  start = first_crossing(atemp, context['day_turn'], [context['summer_thresh']], inclusive=True)[0]
+  end = first_crossing(atemp, arrays['day_max'][:,:,y], [context['summer_thresh']], below=True, inclusive=True)[0]
+  start[invalid] = np.nan
+  end[invalid] = np.nan
+  arrays['day_summer_start'][:,:,y] = start
+  arrays['day_summer_end'][:,:,y] = end
+
+def phenology_metrics(lats, lons, startY, endY, variablename, clim_filename, dirname, spring_thresholds=None, summer_thresh_offset=None, workers=1, window=None, prefetch=0):
+  """Spring and/or summer phenology metrics in one pass over the daily files
+
+  Every year is read and smoothed once; the yearly extrema are shared by
+  both metrics.  With spring_thresholds (a list) the spring start days
+  are searched, with summer_thresh_offset the summer start/end days.
+  Years are processed on up to workers processes (see executor.py).
+  window = (lat slice, lon slice) restricts the grid to one tile.  With
+  workers <= 1 every year's daily files are decoded by prefetch processes
+  (see datacube.iter_daily_fields()); parallel years read their own
+  files, so at most 1 + max(workers, prefetch) processes run.  Returns a dict of (lat, lon, year) arrays, NaN where undefined:
+  day_min, day_max, data_min, data_max, and day_spring (one per
+  threshold), day_summer_start, day_summer_end.
+  """
   ny = endY - startY + 1
-
-  # define max and min matrics
-  day_min = np.empty((lats.size, lons.size, ny))
-  day_max = np.empty((lats.size, lons.size, ny))
-  data_min = np.empty((lats.size, lons.size, ny))
-  data_max = np.empty((lats.size, lons.size, ny))
-
-  # define spring start matrics
-  day_spring_start1 = np.empty((lats.size, lons.size, ny))
-  day_spring_start2 = np.empty((lats.size, lons.size, ny))
-  data_year      = np.empty((lats.size, lons.size, 366, ny))
-
-  # define spring start matrics trend
-  day_spring_start_trend1 = np.empty((lats.size, lons.size))
-  day_spring_start_trend2 = np.empty((lats.size, lons.size))
-
-  # initilization with NAN
-  data_year[:] = np.nan
-  day_spring_start1[:] = np.nan
-  day_spring_start2[:] = np.nan
-  day_spring_start_trend1[:] = np.nan
-  day_spring_start_trend2[:] = np.nan
-
-  nlat = lats.size
-  nlon = lons.size
+  if window is None:
+    window = (slice(0, lats.size), slice(0, lons.size))
+  nlat, nlon = executor.window_shape(window)
+  years = range(startY, endY+1)
 
   # Read in climatology
-  ncin = Dataset(clim_filename, 'r')
-  diff_clim = ncin.variables['diff_sst_climatology'][:]
-  ncin.close()
+  diff_clim, day_turn = read_day_turn(clim_filename, window)
 
-  day_turn = np.empty([lats.size, lons.size])
-  day_turn[:,:] = np.nan
-
-  for i in range(0, lats.size):
-    for j in range(0, lons.size):
-      xrange = np.arange(366)
-      yrange = diff_clim[i,j,:]
-      xtemp = xrange[np.invert(np.isnan(yrange))]
-      if xtemp.size > 2:
-        z = np.polyfit(xrange[np.invert(np.isnan(yrange))], yrange[np.invert(np.isnan(yrange))], 6)
-        polynomial = np.poly1d(z)
-        ys = polynomial(np.arange(366))
-
-        for k in range(0, 365):
-          if(ys[k] > 0):
-            day_turn[i, j] = k + 1
-            break
-      else:
-        day_turn[i, j] = np.nan
-
-  """
-  fig= plt.figure(figsize=(6,6), dpi=300)
-  clevs = np.linspace(1, 100, 101)
-  cmap=plt.get_cmap("jet")
-  plt.contourf(day_turn, clevs, cmap=cmap)
-  plt.show()
-  print(lats[22])
-  print(lons[40])
-  """
-
-  for i in range(startY, endY+1):
-    print("Processing Year = " + str(i))
-    nd = 0
-    for j in range(1, 367):
-       for filename in glob.glob(dirname+'/'+str(i)+'/'+"{0:0>3}".format(j)+'/*.nc'):
-         if os.path.isfile(filename):
-           ncfile = filename.rsplit( "/")[ -1 ]
-           ncin = Dataset(filename, 'r')
-           asst = ncin.variables[variablename][:]
-           sst = asst.squeeze()
-           #sst = asst[0,:,:]
-           lons = ncin.variables['lon'][:]
-           lats = ncin.variables['lat'][:]
-           amask = ncin.variables['mask'][:]
-           mask = amask[0,:,:]
-           #get global attributes
-           atts = ncin.__dict__
-           for att,val in atts.items():
-             if att.find('start_time') != -1: 
-               start_time = val
-               continue
-           ncin.close()
-           aindex = np.where( (sst > -250.0) & (sst < 350.0) & (mask == 1) )
-           data_year[aindex[0][:],aindex[1][:],j-1,i-startY] = sst[aindex[0][:],aindex[1][:]]
-
-    # data max/date and min/date calculation
-    for i1 in range(0, lats.size): 
-      for j1 in range(0, lons.size):
-           atemp = data_year[i1,j1,:,i-startY]
-           atemp1 = atemp.squeeze()
-           mx = np.ma.masked_array(atemp1,np.isnan(atemp1))
-           atemp = moving_average(mx)
-           if np.count_nonzero(np.isnan(atemp)) == atemp.size:
-             day_min[i1,j1,i-startY]  = np.nan 
-             data_min[i1,j1,i-startY] = np.nan
-             day_max[i1,j1,i-startY]  = np.nan
-             data_max[i1,j1,i-startY] = np.nan
-           else: 
-             day_min[i1,j1,i-startY]  = np.nanargmin(atemp)
-             if day_min[i1,j1,i-startY] > 300:
-               day_min[i1,j1,i-startY] = np.nan
-             data_min[i1,j1,i-startY] = np.nanmin(atemp)
-             day_max[i1,j1,i-startY]  = np.nanargmax(atemp)
-             data_max[i1,j1,i-startY] = np.nanmax(atemp)
-
-    # spring start matrics calculation
-    for i1 in range(0, lats.size): 
-      for j1 in range(0, lons.size):
-           atemp = data_year[i1,j1,:,i-startY]
-           atemp = atemp.squeeze()
-           mx = np.ma.masked_array(atemp,np.isnan(atemp))
-           atemp = moving_average(mx)
-           if np.count_nonzero(np.isnan(atemp)) <= atemp.size and ~np.isnan(day_min[i1,j1,i-startY]):
-             dmin = int(day_min[i1,j1,i-startY])
-             datamin = data_min[i1,j1,i-startY]
-
-             bfind1 = False
-             for k in range(int(day_turn[i1, j1]), 300):
-               if atemp[k] > spring_thresh1:
-                 bfind1 = True 
-                 """
-                 for i2 in range(1,11):
-                   if atemp[k+i2] < spring_thresh1:
-                     bfind1 = False
-                 """
-                 #if bfind1 == True:
-                 day_spring_start1[i1,j1,i-startY] = k
-                 break
-             if bfind1 == False:
-               day_spring_start1[i1,j1,i-startY] = np.nan 
-
-             bfind2 = False
-             for k in range(int(day_turn[i1, j1]), 300):
-               if atemp[k] > spring_thresh2 and k > 0:
-                 bfind2 = True 
-                 """
-                 for i2 in range(1,11):
-                   if atemp[k+i2] < spring_thresh2:
-                     bfind2 = False
-                 """
-                 #if bfind2 == True:
-                 day_spring_start2[i1,j1,i-startY] = k
-                 break
-             if bfind2 == False:
-               day_spring_start2[i1,j1,i-startY] = np.nan 
-
-  # Calculate the spring start day trend 
-  x = np.arange(ny)
-  for i1 in range(0, lats.size): 
-    for j1 in range(0, lons.size):
-      y = day_spring_start1[i1,j1,:].squeeze()
-      idx = np.isfinite(y)
-      x1 = x[idx]
-      if x1.size > ny/2:
-        z = np.polyfit(x[idx], y[idx], 1)
-        day_spring_start_trend1[i1,j1] = z[0]
-        """
-        if np.abs(z[0]) < 1.0:
-          day_spring_start_trend1[i1,j1] = z[0]
-        else:
-          print(str(i1) + ", "+ str(j1))
-          y1 = y[idx]
-          X = np.empty(shape=(x1.size,1))
-          X[:,0] = x1
-          if (i1 == 22) and (j1 == 40):
-           for kk in range(0,36):
-             plt.plot(data_year[i1,j1,:,kk])
-             plt.plot([0, 365], [281, 281], color='r', linewidth=3)
-             plt.xlim([0, 365])
-             plt.xlabel("Day #")
-             plt.ylabel("SST (K)")
-           plt.show()
-          ransac = linear_model.RANSACRegressor()
-          ransac.fit(X, y1)
-          day_spring_start_trend1[i1,j1] = ransac.estimator_.coef_[0]
-        """
-      else:
-        day_spring_start_trend1[i1,j1] = np.nan
-
-      y = day_spring_start2[i1,j1,:].squeeze()
-      idx = np.isfinite(y)
-      x1 = x[idx]
-      if x1.size > ny/2:
-        z = np.polyfit(x[idx], y[idx], 1)
-        day_spring_start_trend2[i1,j1] = z[0]
-        """  
-        if np.abs(z[0]) < 1.0:
-          day_spring_start_trend2[i1,j1] = z[0]
-        else:
-          y1 = y[idx]
-          X = np.empty(shape=(x1.size,1))
-          X[:,0] = x1
-          print(x1)
-          print(y1)
-          ransac = linear_model.RANSACRegressor()
-          ransac.fit(X, y1)
-          day_spring_start_trend2[i1,j1] = ransac.estimator_.coef_[0]
-        """  
-      else:
-        day_spring_start_trend2[i1,j1] = np.nan
+  if workers > 1 and not datacube.is_cube(dirname):
+    file_catalog.get_catalog(dirname)   # bring the catalog up to date once, not in every worker
 
-
-  # Update the variables with _Fill_Value (-9999)
-  day_min[np.isnan(day_min)] = -9999
-  day_max[np.isnan(day_max)] = -9999
-  data_min[np.isnan(data_min)] = -9999
-  data_max[np.isnan(data_max)] = -9999
-  day_spring_start1[np.isnan(day_spring_start1)] = -9999
-  day_spring_start_trend1[np.isnan(day_spring_start_trend1)] = -9999
-  day_spring_start2[np.isnan(day_spring_start2)] = -9999
-  day_spring_start_trend2[np.isnan(day_spring_start_trend2)] = -9999
+  # define max and min matrics
+  arrays = executor.SharedArrays(workers)
+  names = ['day_min', 'day_max', 'data_min', 'data_max']
+  for name in names:
+    arrays.create(name, (nlat, nlon, ny))
+  context = {'startY': startY, 'dirname': dirname, 'variablename': variablename, 'window': window,
+             'prefetch': prefetch if workers <= 1 else 0, 'day_turn': day_turn, 'spring_thresholds': spring_thresholds}
+
+  if spring_thresholds is not None:
+    arrays.create('day_spring', (len(spring_thresholds), nlat, nlon, ny))
+    names.append('day_spring')
+
+  if summer_thresh_offset is not None:
+    arrays.create('data_year', (nlat, nlon, 366, ny))
+    arrays.create('data_summer_max_all', (nlat, nlon, ny))
+    arrays.create('day_summer_start', (nlat, nlon, ny))
+    arrays.create('day_summer_end', (nlat, nlon, ny))
+    names = names + ['day_summer_start', 'day_summer_end']
+
+  try:
+    executor.map_years(_metrics_year, years, arrays, context, workers)
+
+    if summer_thresh_offset is not None:
+      # summer start/end matrics calculation
+      # Step 2: summer lowest maximum calculation
+      data_summer_max = extrema_days(arrays.arrays['data_summer_max_all'])[1]
+
+      # summer start/end matrics calculation
+      # Step 3: summer start/end calculation
+      # the summer metrics need a fit over more than half of the year
+      day_turn_summer = day_turn.copy()
+      day_turn_summer[np.isfinite(diff_clim).sum(axis=2) <= 366/2] = np.nan
+      context = {'startY': startY, 'day_turn': day_turn_summer,
+                 'summer_thresh': data_summer_max + summer_thresh_offset}
+      executor.map_years(_summer_year, years, arrays, context, workers)
+
+    metrics = {name: arrays.copy(name) for name in names}
+  finally:
+    arrays.close()
+
+  return metrics
+
+def _fill(a):
+  """Copy of a with NaN replaced by the _Fill_Value (-9999)"""
+  return np.where(np.isnan(a), -9999, a)
+
+def create_metric_file(lats, lons, startY, endY, outdir, outfilename, trend_method='ols'):
+  """Open a metric output file with the grid, the years and the yearly extrema variables"""
+  ny = endY - startY + 1
 
   ### create output directory
   data_info.createdir(outdir)
@@ -545,8 +666,8 @@ def metric_spring_start(lats, lons, startY, endY, spring_thresh1, spring_thresh2
   fid = Dataset(outdir+'/'+outfilename,'w')
 
   # Define the dimensions
-  nlat = fid.createDimension('lat', nlat) # Unlimited
-  nlon = fid.createDimension('lon', nlon) # Unlimited
+  nlat = fid.createDimension('lat', lats.size) # Unlimited
+  nlon = fid.createDimension('lon', lons.size) # Unlimited
   nyear = fid.createDimension('year', ny) # Unlimited
 
   nc_var = fid.createVariable('lat', 'f8',('lat'),zlib=True)
@@ -568,579 +689,429 @@ def metric_spring_start(lats, lons, startY, endY, spring_thresh1, spring_thresh2
   fid.variables['year'].standard_name='Year'
 
   nc_var = fid.createVariable('day_min', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_min'][:] = day_min
   fid.variables['day_min'].standard_name='coldest day of the year'
   fid.variables['day_min'].units='Day number in a year'
 
   nc_var = fid.createVariable('day_max', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_max'][:] = day_max
   fid.variables['day_max'].standard_name='warmest day of the year'
   fid.variables['day_max'].units='Day number in a year'
 
   nc_var = fid.createVariable('data_min', 'f8',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['data_min'][:] = data_min
   fid.variables['data_min'].standard_name='coldest data of the year'
   fid.variables['data_min'].units=''
 
   nc_var = fid.createVariable('data_max', 'f8',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['data_max'][:] = data_max
   fid.variables['data_max'].standard_name='warmest data of the year'
   fid.variables['data_max'].units=''
 
+  fid.trend_method = trend_method
+  fid.cdm_data_type         = "Grid"
+  return fid
+
+def create_metric_spring(lats, lons, startY, endY, outdir, outfilename, trend_method='ols'):
+  """Open a spring metric file with every variable defined, to be filled by tiles"""
+  fid = create_metric_file(lats, lons, startY, endY, outdir, outfilename, trend_method)
+
   nc_var = fid.createVariable('day_spring1', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_spring1'][:] = day_spring_start1
   fid.variables['day_spring1'].standard_name='spring start day of the year'
   fid.variables['day_spring1'].units='Day number in a year'
 
   nc_var = fid.createVariable('day_spring2', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_spring2'][:] = day_spring_start2
   fid.variables['day_spring2'].standard_name='spring start day of the year'
   fid.variables['day_spring2'].units='Day number in a year'
 
   nc_var = fid.createVariable('day_spring_trend1', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
-  fid.variables['day_spring_trend1'][:] = day_spring_start_trend1
   fid.variables['day_spring_trend1'].standard_name='spring start day trend per year'
   fid.variables['day_spring_trend1'].units='Day number per year'
 
   nc_var = fid.createVariable('day_spring_trend2', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
-  fid.variables['day_spring_trend2'][:] = day_spring_start_trend2
   fid.variables['day_spring_trend2'].standard_name='spring start day trend per year'
   fid.variables['day_spring_trend2'].units='Day number per year'
 
-  fid.cdm_data_type         = "Grid"
-  fid.close()
-  
-  return
-
-def metric_summer_start_end(lats, lons, startY, endY, summer_thresh_offset, variablename, outdir, outfilename, clim_filename, dirname):
-
-  ny = endY - startY + 1
-
-  # define max and min matrics
-  day_min = np.empty((lats.size, lons.size, ny))
-  day_max = np.empty((lats.size, lons.size, ny))
-  data_min = np.empty((lats.size, lons.size, ny))
-  data_max = np.empty((lats.size, lons.size, ny))
-
-  # define summer start/end matrics
-  day_summer_start = np.empty((lats.size, lons.size, ny))
-  day_summer_end = np.empty((lats.size, lons.size, ny))
-  data_summer_max_all = np.empty((lats.size, lons.size, ny))
-  data_summer_max = np.empty((lats.size, lons.size))
-  day_summer_max = np.empty((lats.size, lons.size))
-
-  sst_all        = np.empty((lats.size, lons.size, 366))
-  sst_all_number = np.empty((lats.size, lons.size, 366))
-  data_year_all  = np.empty((ny, 12, 31, lats.size, lons.size))
-  data_year      = np.empty((lats.size, lons.size, 366, ny))
-
-  # define summer start/end matrics trend
-  day_summer_start_trend = np.empty((lats.size, lons.size))
-  day_summer_end_trend = np.empty((lats.size, lons.size))
-
-  # initilization with NAN
-  data_year_all[:] = np.nan
-  data_year[:] = np.nan
-  day_summer_start[:] = np.nan
-  day_summer_end[:] = np.nan
-  data_summer_max[:] = np.nan
-  data_summer_max_all[:] = np.nan
-  day_summer_max[:] = np.nan
-  day_summer_start_trend[:] = np.nan
-  day_summer_end_trend[:] = np.nan
-
-  nlat = lats.size
-  nlon = lons.size
-
-  # Read in climatology
-  ncin = Dataset(clim_filename, 'r')
-  diff_clim = ncin.variables['diff_sst_climatology'][:]
-  ncin.close()
-
-  day_turn = np.empty([lats.size, lons.size])
-  day_turn[:,:] = np.nan
-
-  for i in range(0, lats.size):
-    for j in range(0, lons.size):
-      xrange = np.arange(366)
-      yrange = diff_clim[i,j,:].squeeze()
-
-      idx = np.argwhere(np.isfinite(yrange))
-      if idx.size > len(xrange)/2:
-        z = np.polyfit(xrange[idx[:,0].squeeze()], yrange[idx[:,0].squeeze()], 6)
-        polynomial = np.poly1d(z)
-        ys = polynomial(range(366))
-
-        for k in range(0, 365):
-          if(ys[k] > 0):
-            day_turn[i, j] = k + 1
-            break
-
-  for i in range(startY, endY+1):
-    print("Processing Year = " + str(i))
-    nd = 0
-    for j in range(1, 367):
-       for filename in glob.glob(dirname+'/'+str(i)+'/'+"{0:0>3}".format(j)+'/*.nc'):
-         ncfile = filename.rsplit( "/")[ -1 ]
-         ncin = Dataset(filename, 'r')
-         asst = ncin.variables[variablename][:]
-         sst = asst.squeeze()
-         #sst = asst[0,:,:]
-         lons = ncin.variables['lon'][:]
-         lats = ncin.variables['lat'][:]
-         amask = ncin.variables['mask'][:]
-         mask = amask[0,:,:]
-         #get global attributes
-         atts = ncin.__dict__
-         for att,val in atts.items():
-           if att.find('start_time') != -1: 
-             start_time = val
-             continue
-         ncin.close()
-         aindex = np.where( (sst > -250.0) & (sst < 350.0) & (mask == 1) )
-         data_year[aindex[0][:],aindex[1][:],j-1,i-startY] = sst[aindex[0][:],aindex[1][:]]
-
-    # data max/date and min/date calculation
-    for i1 in range(0, lats.size): 
-      for j1 in range(0, lons.size):
-           atemp = data_year[i1,j1,:,i-startY]
-           atemp1 = atemp.squeeze()
-           mx = np.ma.masked_array(atemp1,np.isnan(atemp1))
-           atemp = moving_average(mx)
-           if np.count_nonzero(np.isnan(atemp)) == atemp.size:
-             day_min[i1,j1,i-startY]  = np.nan 
-             data_min[i1,j1,i-startY] = np.nan
-             day_max[i1,j1,i-startY]  = np.nan
-             data_max[i1,j1,i-startY] = np.nan
-           else: 
-             day_min[i1,j1,i-startY]  = np.nanargmin(atemp)
-             if day_min[i1,j1,i-startY] > 300:
-               day_min[i1,j1,i-startY] = np.nan
-             data_min[i1,j1,i-startY] = np.nanmin(atemp)
-             day_max[i1,j1,i-startY]  = np.nanargmax(atemp)
-             data_max[i1,j1,i-startY] = np.nanmax(atemp)
-
-    # summer start/end matrics calculation
-    # Step 1: find summer maximum for each year 
-    for i1 in range(0, lats.size): 
-      for j1 in range(0, lons.size):
-           atemp = data_year[i1,j1,150:150+90,i-startY]
-           atemp = atemp.squeeze()
-           mx = np.ma.masked_array(atemp,np.isnan(atemp))
-           atemp = moving_average(mx)
-           if np.count_nonzero(np.isnan(atemp)) == atemp.size:
-             data_summer_max_all[i1,j1,i-startY]  = np.nan 
-           else: 
-             data_summer_max_all[i1,j1,i-startY] = np.nanmax(atemp)
-
-  # summer start/end matrics calculation
-  # Step 2: summer lowest maximum calculation
-  for i1 in range(0, lats.size): 
-    for j1 in range(0, lons.size):
-       atemp = data_summer_max_all[i1,j1,:]
-       atemp = atemp.squeeze()
-       if np.count_nonzero(np.isnan(atemp)) == atemp.size:
-         data_summer_max[i1,j1]  = np.nan 
-         day_summer_max[i1,j1]  = np.nan 
-       else: 
-         data_summer_max[i1,j1] = np.nanmin(atemp)
-         day_summer_max[i1,j1] = np.nanargmin(atemp)+startY
-
-  # summer start/end matrics calculation
-  # Step 3: summer start/end calculation
-  for i in range(startY, endY+1):
-    for i1 in range(0, lats.size): 
-      for j1 in range(0, lons.size):
-           atemp = data_year[i1,j1,:,i-startY]
-           atemp = atemp.squeeze()
-           mx = np.ma.masked_array(atemp,np.isnan(atemp))
-           atemp = moving_average(mx)
-           """
-           if np.count_nonzero(np.isnan(atemp)) == atemp.size:
-             day_summer_start[i1,j1,i-startY]  = np.nan 
-           elif np.isnan(day_turn[i1, j1]):
-             day_summer_start[i1,j1,i-startY]  = np.nan 
-           else: 
-           """
-           if np.count_nonzero(np.isnan(atemp)) <= atemp.size and ~np.isnan(day_min[i1,j1,i-startY]):
-             for k in range(int(day_turn[i1, j1]), atemp.size):
-               if atemp[k] >= data_summer_max[i1,j1]+summer_thresh_offset:
-                 day_summer_start[i1,j1,i-startY] = k
-                 break
-             for k in range(np.nanargmax(atemp), atemp.size):
-               if atemp[k] <= data_summer_max[i1,j1]+summer_thresh_offset:
-                 day_summer_end[i1,j1,i-startY] = k
-                 break
-
-  # Calculate the summer start/end day trend 
-  x = np.arange(ny)
-  for i1 in range(0, lats.size): 
-    for j1 in range(0, lons.size):
-      """
-      z = np.polyfit(range(ny), day_summer_start[i1,j1,:], 1)
-      day_summer_start_trend[i1,j1] = z[0]
-      z = np.polyfit(range(ny), day_summer_end[i1,j1,:], 1)
-      day_summer_end_trend[i1,j1] = z[0]
-      """
-      y = day_summer_start[i1,j1,:].squeeze()
-      idx = np.isfinite(y)
-      x1 = x[idx]
-      if x1.size > ny/2:
-        z = np.polyfit(x[idx], y[idx], 1)
-        day_summer_start_trend[i1,j1] = z[0]
-      else:
-        day_summer_start_trend[i1,j1] = np.nan
-
-      y = day_summer_end[i1,j1,:].squeeze()
-      idx = np.isfinite(y)
-      x1 = x[idx]
-      if x1.size > ny/2:
-        z = np.polyfit(x[idx], y[idx], 1)
-        day_summer_end_trend[i1,j1] = z[0]
-      else:
-        day_summer_end_trend[i1,j1] = np.nan
-
-  # Update the variables with _Fill_Value (-9999)
-  day_min[np.isnan(day_min)] = -9999
-  day_max[np.isnan(day_max)] = -9999
-  data_min[np.isnan(data_min)] = -9999
-  data_max[np.isnan(data_max)] = -9999
-  day_summer_start[np.isnan(day_summer_start)] = -9999
-  day_summer_end[np.isnan(day_summer_end)] = -9999
-  day_summer_start_trend[np.isnan(day_summer_start_trend)] = -9999
-  day_summer_end_trend[np.isnan(day_summer_end_trend)] = -9999
-
-  ### create output directory
-  data_info.createdir(outdir)
-
-  #output into netCDF file
-  fid = Dataset(outdir+'/'+outfilename,'w')
-  # Define the dimensions
-  nlat = fid.createDimension('lat', nlat) # Unlimited
-  nlon = fid.createDimension('lon', nlon) # Unlimited
-  nyear = fid.createDimension('year', ny) # Unlimited
-
-  nc_var = fid.createVariable('lat', 'f8',('lat'),zlib=True)
-  fid.variables['lat'][:] = lats
-  fid.variables['lat'].standard_name='latitude'
-  fid.variables['lat'].long_name='latitude'
-  fid.variables['lat'].axis='Y'
-  fid.variables['lat'].units='degrees_north'
-
-  nc_var = fid.createVariable('lon', 'f8',('lon'),zlib=True)
-  fid.variables['lon'][:] = lons
-  fid.variables['lon'].standard_name='longitude'
-  fid.variables['lon'].long_name='longitude'
-  fid.variables['lon'].units='degrees_east'
-  fid.variables['lon'].axis='X'
+  nc_var = fid.createVariable('day_spring_trend1_pvalue', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
+  fid.variables['day_spring_trend1_pvalue'].long_name='two-sided p-value of day_spring_trend1'
 
-  nc_var = fid.createVariable('year', 'i4',('year'),zlib=True)
-  fid.variables['year'][:] = range(startY,endY+1)
-  fid.variables['year'].standard_name='Year'
+  nc_var = fid.createVariable('day_spring_trend2_pvalue', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
+  fid.variables['day_spring_trend2_pvalue'].long_name='two-sided p-value of day_spring_trend2'
 
-  nc_var = fid.createVariable('day_min', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_min'][:] = day_min
-  fid.variables['day_min'].standard_name='coldest day of the year'
-  fid.variables['day_min'].units='Day number in a year'
+  return fid
 
-  nc_var = fid.createVariable('day_max', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_max'][:] = day_max
-  fid.variables['day_max'].standard_name='warmest day of the year'
-  fid.variables['day_max'].units='Day number in a year'
-
-  nc_var = fid.createVariable('data_min', 'f8',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['data_min'][:] = data_min
-  fid.variables['data_min'].standard_name='coldest data of the year'
-  fid.variables['data_min'].units=''
-
-  nc_var = fid.createVariable('data_max', 'f8',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['data_max'][:] = data_max
-  fid.variables['data_max'].standard_name='warmest data of the year'
-  fid.variables['data_max'].units=''
+def create_metric_summer(lats, lons, startY, endY, outdir, outfilename, trend_method='ols'):
+  """Open a summer metric file with every variable defined, to be filled by tiles"""
+  fid = create_metric_file(lats, lons, startY, endY, outdir, outfilename, trend_method)
 
   nc_var = fid.createVariable('day_summer_start', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_summer_start'][:] = day_summer_start
   fid.variables['day_summer_start'].standard_name='summer start day of the year'
   fid.variables['day_summer_start'].units='Day number in a year'
 
   nc_var = fid.createVariable('day_summer_end', 'i4',('lat','lon','year'),fill_value=-9999,zlib=True)
-  fid.variables['day_summer_end'][:] = day_summer_end
   fid.variables['day_summer_end'].standard_name='summer start day of the year'
   fid.variables['day_summer_end'].units='Day number in a year'
 
   nc_var = fid.createVariable('day_summer_start_trend', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
-  fid.variables['day_summer_start_trend'][:] = day_summer_start_trend
   fid.variables['day_summer_start_trend'].standard_name='Summer End Day Trend per Year'
   fid.variables['day_summer_start_trend'].units='Day number per year'
 
   nc_var = fid.createVariable('day_summer_end_trend', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
-  fid.variables['day_summer_end_trend'][:] = day_summer_end_trend
   fid.variables['day_summer_end_trend'].standard_name='Summer Start Day Trend per Year'
   fid.variables['day_summer_end_trend'].units='Day number per Year'
 
-  fid.cdm_data_type         = "Grid"
-  fid.close()
+  nc_var = fid.createVariable('day_summer_start_trend_pvalue', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
+  fid.variables['day_summer_start_trend_pvalue'].long_name='two-sided p-value of day_summer_start_trend'
+
+  nc_var = fid.createVariable('day_summer_end_trend_pvalue', 'f8',('lat','lon'),fill_value=-9999,zlib=True)
+  fid.variables['day_summer_end_trend_pvalue'].long_name='two-sided p-value of day_summer_end_trend'
+
+  return fid
+
+def _write_tile(fid, name, data, window):
+  """Write a (lat, lon, ...) tile into variable name, NaN as the _Fill_Value (-9999)"""
+  fid.variables[name][window[0],window[1]] = _fill(data)
+
+def write_metric_spring(fid, metrics, window, trend_method='ols'):
+  """Spring start days of a tile, their trends and p-values into an open spring metric file"""
+  ny = len(fid.dimensions['year'])
+  day_spring_start1, day_spring_start2 = metrics['day_spring'][0:2]
+
+  # Calculate the spring start day trend 
+  day_spring_start_trend1, _, _, day_spring_start_pvalue1 = trend.fit_trend(day_spring_start1, trend_method, min_valid=trend.half_years(ny))
+  day_spring_start_trend2, _, _, day_spring_start_pvalue2 = trend.fit_trend(day_spring_start2, trend_method, min_valid=trend.half_years(ny))
+
+  for name in ('day_min', 'day_max', 'data_min', 'data_max'):
+    _write_tile(fid, name, metrics[name], window)
+  _write_tile(fid, 'day_spring1', day_spring_start1, window)
+  _write_tile(fid, 'day_spring2', day_spring_start2, window)
+  _write_tile(fid, 'day_spring_trend1', day_spring_start_trend1, window)
+  _write_tile(fid, 'day_spring_trend2', day_spring_start_trend2, window)
+  _write_tile(fid, 'day_spring_trend1_pvalue', day_spring_start_pvalue1, window)
+  _write_tile(fid, 'day_spring_trend2_pvalue', day_spring_start_pvalue2, window)
+
+def write_metric_summer(fid, metrics, window, trend_method='ols'):
+  """Summer start/end days of a tile, their trends and p-values into an open summer metric file"""
+  ny = len(fid.dimensions['year'])
+  day_summer_start = metrics['day_summer_start']
+  day_summer_end = metrics['day_summer_end']
+
+  # Calculate the summer start/end day trend 
+  day_summer_start_trend, _, _, day_summer_start_pvalue = trend.fit_trend(day_summer_start, trend_method, min_valid=trend.half_years(ny))
+  day_summer_end_trend, _, _, day_summer_end_pvalue = trend.fit_trend(day_summer_end, trend_method, min_valid=trend.half_years(ny))
+
+  for name in ('day_min', 'day_max', 'data_min', 'data_max'):
+    _write_tile(fid, name, metrics[name], window)
+  _write_tile(fid, 'day_summer_start', day_summer_start, window)
+  _write_tile(fid, 'day_summer_end', day_summer_end, window)
+  _write_tile(fid, 'day_summer_start_trend', day_summer_start_trend, window)
+  _write_tile(fid, 'day_summer_end_trend', day_summer_end_trend, window)
+  _write_tile(fid, 'day_summer_start_trend_pvalue', day_summer_start_pvalue, window)
+  _write_tile(fid, 'day_summer_end_trend_pvalue', day_summer_end_pvalue, window)
+
+def metric_spring_start(lats, lons, startY, endY, spring_thresh1, spring_thresh2, variablename, outdir, outfilename, clim_filename, dirname, trend_method='ols', workers=1, tile_size=0, prefetch=0):
+
+  fid = create_metric_spring(lats, lons, startY, endY, outdir, outfilename, trend_method)
+  try:
+    for window in executor.tile_windows(lats.size, lons.size, tile_size):
+      metrics = phenology_metrics(lats, lons, startY, endY, variablename, clim_filename, dirname,
+                                  spring_thresholds=[spring_thresh1, spring_thresh2], workers=workers, window=window, prefetch=prefetch)
+      write_metric_spring(fid, metrics, window, trend_method)
+  finally:
+    fid.close()
   
   return
 
-def climatologybox(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons, variablename, clim_filename, outfilename):
+def metric_summer_start_end(lats, lons, startY, endY, summer_thresh_offset, variablename, outdir, outfilename, clim_filename, dirname, trend_method='ols', workers=1, tile_size=0, prefetch=0):
 
-  nstep = 1
-  nd = 366
+  fid = create_metric_summer(lats, lons, startY, endY, outdir, outfilename, trend_method)
+  try:
+    for window in executor.tile_windows(lats.size, lons.size, tile_size):
+      metrics = phenology_metrics(lats, lons, startY, endY, variablename, clim_filename, dirname,
+                                  summer_thresh_offset=summer_thresh_offset, workers=workers, window=window, prefetch=prefetch)
+      write_metric_summer(fid, metrics, window, trend_method)
+  finally:
+    fid.close()
+  
+  return
 
-  ### get box info
-  nx, ny, box_lat_start, box_lat_end, box_lon_start, box_lon_end = data_info.getboxinfo(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
+def metric_spring_summer(lats, lons, startY, endY, spring_thresh1, spring_thresh2, summer_thresh_offset, variablename, outdir, spring_filename, summer_filename, clim_filename, dirname, trend_method='ols', workers=1, tile_size=0, prefetch=0):
+  """Spring start and summer start/end metrics from a single pass over the daily files
 
-  # Read in climatology
-  print(clim_filename)
-  ncin = Dataset(clim_filename, 'r')
-  sst_clim = ncin.variables['sst_climatology'][:]
-  ncin.close()
+  Writes the same two files as metric_spring_start and
+  metric_summer_start_end, reading every daily field once.  With
+  tile_size > 0 the grid is processed in tile_size x tile_size tiles and
+  each tile is written before the next one is read.
+  """
 
-  ### create box average of parameters
-  sst_avg=np.empty((nd, nx, ny))
+  fid_spring = create_metric_spring(lats, lons, startY, endY, outdir, spring_filename, trend_method)
+  fid_summer = create_metric_summer(lats, lons, startY, endY, outdir, summer_filename, trend_method)
+  try:
+    for window in executor.tile_windows(lats.size, lons.size, tile_size):
+      metrics = phenology_metrics(lats, lons, startY, endY, variablename, clim_filename, dirname,
+                                  spring_thresholds=[spring_thresh1, spring_thresh2],
+                                  summer_thresh_offset=summer_thresh_offset, workers=workers, window=window, prefetch=prefetch)
+      write_metric_spring(fid_spring, metrics, window, trend_method)
+      write_metric_summer(fid_summer, metrics, window, trend_method)
+  finally:
+    fid_spring.close()
+    fid_summer.close()
 
-  for k in range(0, nd):
-       for ii in range(0, nx):
-          for jj in range(0, ny):
-             atemp = sst_clim[int(box_lat_start[ii]):int(box_lat_end[ii]):nstep, int(box_lon_start[jj]):int(box_lon_end[jj]):nstep, k-1]
-             atemp = atemp.flatten()
-             b = (atemp < -100.0) | (atemp > 350.0)
-             if np.count_nonzero(b) > 0:
-               atemp[b]=np.nan
-             sst_avg[k,ii,jj] = np.nanmean(atemp)
+  return
+
+def write_climatology_box(outfilename, prefix, stats, units):
+  """Write the box_statistics() of a climatology, (nx, ny, day), to a box climatology file"""
+  nbox_x, nbox_y, nd = stats['average'].shape
 
   fid = Dataset(outfilename,'w')
   # Define the dimensions
-  nx = fid.createDimension('nx', nx) # Unlimited
-  ny = fid.createDimension('ny', ny) # Unlimited
-  day = fid.createDimension('daynumber', 366) # Unlimited
+  nx = fid.createDimension('nx', nbox_x) # Unlimited
+  ny = fid.createDimension('ny', nbox_y) # Unlimited
+  day = fid.createDimension('daynumber', nd) # Unlimited
 
   nc_var = fid.createVariable('daynumber', 'i4',('daynumber'),zlib=True)
-  fid.variables['daynumber'][:] = range(1, 367)
+  fid.variables['daynumber'][:] = range(1, nd+1)
   fid.variables['daynumber'].standard_name='day number'
   fid.variables['daynumber'].units='day number'
   fid.variables['daynumber'].axis='T'
   fid.variables['daynumber'].comment="Starting on Jan 1 of earch year with day number 1 until the end of the year with either day number 365 or 366 depending on the leap year status."
 
-  nc_var = fid.createVariable('sst_box_average', 'f8',('daynumber', 'nx', 'ny'),zlib=True)
-  fid.variables['sst_box_average'][:] = sst_avg[:,:,:]
-  fid.variables['sst_box_average'].standard_name='Data Average in the Box'
-  fid.variables['sst_box_average'].units='kelvin'
+  names = {'average': 'Data Average in the Box',
+           'count': 'Number of Valid Data in the Box',
+           'std': 'Data Standard Deviation in the Box',
+           'min': 'Data Minimum in the Box',
+           'max': 'Data Maximum in the Box'}
+  for stat, standard_name in names.items():
+    name = prefix+'_box_'+stat
+    nc_var = fid.createVariable(name, 'i4' if stat == 'count' else 'f8',('daynumber', 'nx', 'ny'),zlib=True)
+    fid.variables[name][:] = np.moveaxis(stats[stat], -1, 0)
+    fid.variables[name].standard_name=standard_name
+    if stat != 'count':
+      fid.variables[name].units=units
 
   fid.close()
 
-def climatologybox_chlor(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons, variablename, clim_filename, outfilename):
+def _climatology_box_statistics(clim, valid, lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons):
+  """box_statistics() of a (lat, lon, day) climatology; day k of the result is climatology day k-1"""
+  nx, ny, box_lat_start, box_lat_end, box_lon_start, box_lon_end = data_info.getboxinfo(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
+  stats = box_statistics(clim, valid, box_lat_start, box_lat_end, box_lon_start, box_lon_end)
+  return {stat: np.roll(a, 1, axis=-1) for stat, a in stats.items()}
 
-  nstep = 1
-  nd = 366
+def climatologybox(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons, variablename, clim_filename, outfilename):
 
-  ### get box info
-  nx, ny, box_lat_start, box_lat_end, box_lon_start, box_lon_end = data_info.getboxinfo(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
+  # Read in climatology
+  print(clim_filename)
+  ncin = Dataset(clim_filename, 'r')
+  sst_clim = np.ma.filled(ncin.variables['sst_climatology'][:].astype(np.float64), np.nan)
+  ncin.close()
+
+  ### box statistics of every day
+  valid = (sst_clim >= -100.0) & (sst_clim <= 350.0)
+  stats = _climatology_box_statistics(sst_clim, valid, lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
+
+  write_climatology_box(outfilename, 'sst', stats, 'kelvin')
+
+def climatologybox_chlor(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons, variablename, clim_filename, outfilename):
 
   # Read in climatology
   print(clim_filename)
   ncin = Dataset(clim_filename, 'r')
-  sst_clim = ncin.variables['chlor_climatology'][:]
+  chlor_clim = np.ma.filled(ncin.variables['chlor_climatology'][:].astype(np.float64), np.nan)
   ncin.close()
 
-  ### create box average of parameters
-  sst_avg=np.empty((nd, nx, ny))
+  ### box statistics of every day
+  valid = chlor_clim >= 0.0
+  stats = _climatology_box_statistics(chlor_clim, valid, lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
 
-  for k in range(0, nd):
-       for ii in range(0, nx):
-          for jj in range(0, ny):
-             atemp = sst_clim[int(box_lat_start[ii]):int(box_lat_end[ii]):nstep, int(box_lon_start[jj]):int(box_lon_end[jj]):nstep, k-1]
-             atemp = atemp.flatten()
-             b = (atemp < -0.0)
-             if np.count_nonzero(b) > 0:
-               atemp[b]=np.nan
-             sst_avg[k,ii,jj] = np.nanmean(atemp)
+  write_climatology_box(outfilename, 'chlor', stats, 'mg m-3')
+ 
+def create_box_index_file(outfilename, startY, endY, lats, lons, windows, nlat0, nlon0, box_cubes=True, append_days=32):
+  """Open the box index file: daily statistics of every box and year, (year, day, box_y, box_x)
+
+  One chunk holds a year of every box, so a box time series or the whole
+  product is read with a single call.  With box_cubes the pixels of every
+  box are kept too, as nlat0 x nlon0 cubes (the size of the first box)
+  chunked append_days days per box.
+  """
+  nbox_y, nbox_x = len(windows), len(windows[0])
+  nyear = endY - startY + 1
 
   fid = Dataset(outfilename,'w')
   # Define the dimensions
-  nx = fid.createDimension('nx', nx) # Unlimited
-  ny = fid.createDimension('ny', ny) # Unlimited
-  day = fid.createDimension('daynumber', 366) # Unlimited
-
-  nc_var = fid.createVariable('daynumber', 'i4',('daynumber'),zlib=True)
-  fid.variables['daynumber'][:] = range(1, 367)
-  fid.variables['daynumber'].standard_name='day number'
-  fid.variables['daynumber'].units='day number'
-  fid.variables['daynumber'].axis='T'
-  fid.variables['daynumber'].comment="Starting on Jan 1 of earch year with day number 1 until the end of the year with either day number 365 or 366 depending on the leap year status."
+  fid.createDimension('year', nyear)
+  fid.createDimension('day', 366)
+  fid.createDimension('box_y', nbox_y)
+  fid.createDimension('box_x', nbox_x)
 
-  nc_var = fid.createVariable('chlor_box_average', 'f8',('daynumber', 'nx', 'ny'),zlib=True)
-  fid.variables['chlor_box_average'][:] = sst_avg[:,:,:]
-  fid.variables['chlor_box_average'].standard_name='Data Average in the Box'
-  fid.variables['chlor_box_average'].units='kelvin'
+  nc_var = fid.createVariable('year', 'i4',('year'),zlib=True)
+  fid.variables['year'][:] = range(startY,endY+1)
+  fid.variables['year'].standard_name='Year'
 
-  fid.close()
- 
-def indexProcessing(dataset_name, startY, endY, lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons, variablename, error_variable, clim_filename, dirname, output_dir):
-  
-  nstep = 1
-  nd = 366
+  nc_var = fid.createVariable('day', 'i4',('day'),zlib=True)
+  fid.variables['day'][:] = range(1, 367)
+  fid.variables['day'].standard_name='time'
+  fid.variables['day'].long_name='day number'
+  fid.variables['day'].units='day number'
+  fid.variables['day'].axis='T'
+  fid.variables['day'].comment="Starting on Jan 1 of earch year with day number 1 until the end of the year with either day number 365 or 366 depending on the leap year status. Days without data are _FillValue."
+
+  for name, coords, axis, units in (('box_lat', lats, 0, 'degrees_north'), ('box_lon', lons, 1, 'degrees_east')):
+    for edge in ('min', 'max'):
+      dim = 'box_y' if axis == 0 else 'box_x'
+      nc_var = fid.createVariable(name+'_'+edge, 'f8',(dim),zlib=True)
+      if axis == 0:
+        index = [windows[ii][0][0].start if edge == 'min' else windows[ii][0][0].stop for ii in range(0, nbox_y)]
+      else:
+        index = [windows[0][jj][1].start if edge == 'min' else windows[0][jj][1].stop for jj in range(0, nbox_x)]
+      fid.variables[name+'_'+edge][:] = coords[index]
+      fid.variables[name+'_'+edge].long_name='grid center at the '+('start' if edge == 'min' else 'end')+' of the box'
+      fid.variables[name+'_'+edge].units=units
+
+  chunks = (1, 366, nbox_y, nbox_x)
+  for name, standard_name in (('sst_box_average', 'SST Average in the Box'),
+                              ('sst_box_anomaly', 'SST Anomaly in the Box'),
+                              ('sst_box_std', 'SST Standard Deviation in the Box')):
+    nc_var = fid.createVariable(name, 'f8',('year', 'day', 'box_y', 'box_x'),zlib=True,chunksizes=chunks)
+    fid.variables[name].standard_name=standard_name
+    fid.variables[name].units='kelvin'
+  nc_var = fid.createVariable('sst_box_count', 'i4',('year', 'day', 'box_y', 'box_x'),zlib=True,chunksizes=chunks)
+  fid.variables['sst_box_count'].standard_name='Number of Valid SST in the Box'
+
+  if box_cubes:
+    fid.createDimension('lat', nlat0)
+    fid.createDimension('lon', nlon0)
+    cube_dims = ('year', 'day', 'box_y', 'box_x', 'lat', 'lon')
+    cube_chunks = (1, min(append_days, 366), 1, 1, nlat0, nlon0)
+
+    nc_var = fid.createVariable('lat', 'f8',('box_y', 'lat'),zlib=True)
+    fid.variables['lat'][:] = [_box_cube(lats[None,:,None], (windows[ii][0][0], slice(None)), nlat0, 1, np.nan)[0,:,0] for ii in range(0, nbox_y)]
+    fid.variables['lat'].standard_name='latitude'
+    fid.variables['lat'].long_name='latitude'
+    fid.variables['lat'].axis='Y'
+    fid.variables['lat'].units='degrees_north'
+
+    nc_var = fid.createVariable('lon', 'f8',('box_x', 'lon'),zlib=True)
+    fid.variables['lon'][:] = [_box_cube(lons[None,None,:], (slice(None), windows[0][jj][1]), 1, nlon0, np.nan)[0,0,:] for jj in range(0, nbox_x)]
+    fid.variables['lon'].standard_name='longitude'
+    fid.variables['lon'].long_name='longitude'
+    fid.variables['lon'].units='degrees_east'
+    fid.variables['lon'].axis='X'
+
+    nc_var = fid.createVariable('analysed_sst', 'f8',cube_dims,zlib=True,fill_value=-32768,chunksizes=cube_chunks)
+    fid.variables['analysed_sst'].units='kelvin'
+    fid.variables['analysed_sst'].comment='SST defined at all grid points but no physical meaning is ascribed to values over land'
+    fid.variables['analysed_sst'].source='https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
+
+    nc_var = fid.createVariable('analysis_error', 'f8',cube_dims,zlib=True,fill_value=-32768,chunksizes=cube_chunks)
+    fid.variables['analysis_error'].units='kelvin'
+    fid.variables['analysis_error'].comment='Error defined at all grid points but no meaning is ascribed to values over land'
+    fid.variables['analysis_error'].source='https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
+
+    nc_var = fid.createVariable('mask', 'i',cube_dims,zlib=True,fill_value=-1,chunksizes=cube_chunks)
+    fid.variables['mask'].valid_min = 0
+    fid.variables['mask'].valid_max = 31
+    fid.variables['mask'].flag_masks = '1b, 2b, 4b, 8b, 16b'
+    fid.variables['mask'].flag_meanings = "water land optional_lake_surface sea_ice optional_river_surface"
+    fid.variables['mask'].comment='Mask can be used to further filter the data'
+    fid.variables['mask'].source='https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
+
+  fid.product_version     = "Version 1.0"
+  fid.Conventions         = "CF-1.6"
+  fid.institution         = "Jet Propulsion Laboratory"
+  fid.summary             = "Applies the method of statistical interpolation to assimilate observations from in situ and satellite sources using, as the background, the analysis valid 24 hours prior assuming persistence of the anomalies."
+  fid.source              = 'https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
+  fid.creator_name        = "Ed Armstrong, Yibo Jiang"
+  fid.creator_email       = "Edward.M.Armstrong@jpl.nasa.gov; Yibo.Jiang@jpl.nasa.gov"
+  fid.creator_url         = "http;//podaac.jpl.nasa.gov"
+  fid.project             = "Phenology of North Atlantic Ocean"
+  fid.acknowledgment      = "This project was supported in part by a grant from"
+  fid.processing_level    = "L4"
+  fid.gds_version_id      = "2.0r5"
+  fid.naming_authority    = "org.ghrsst"
+  fid.geospatial_lat_units         = "degrees_north"
+  fid.geospatial_lon_units         = "degrees_east"
+  fid.westernmost_longitude        = str( lons[windows[0][0][1].start] )
+  fid.easternmost_longitude        = str( lons[windows[0][-1][1].stop] )
+  fid.southernmost_latitude        = str( lats[windows[0][0][0].start] )
+  fid.northernmost_latitude        = str( lats[windows[-1][0][0].stop] )
+  fid.cdm_data_type       = "Grid"
+  return fid
+
+def _box_cube(fields, window, nlat0, nlon0, fill):
+  """(day, nlat0, nlon0) cube of a box from (day, lat, lon) fields, padded with fill where the box is smaller"""
+  a = fields[:, window[0], window[1]]
+  cube = np.full((a.shape[0], nlat0, nlon0), fill, dtype=np.float64)
+  cube[:, 0:a.shape[1], 0:a.shape[2]] = a
+  return cube
+
+def _append_box_days(fid, windows, year_index, days, sst, error, mask, clim, box_lat_start, box_lat_end, box_lon_start, box_lon_end):
+  """Box statistics of a block of (day, lat, lon) fields, written to the box index file"""
+  days = np.array(days)
+  with np.errstate(invalid='ignore'):
+    valid = ~((sst < -250.0) | (sst > 350.0) | (mask > 1))
+  stats = box_statistics(np.moveaxis(sst, 0, -1), np.moveaxis(valid, 0, -1), box_lat_start, box_lat_end, box_lon_start, box_lon_end)
+  sst_anomaly = stats['average'] - np.moveaxis(clim[np.minimum(days, 365)-1], 0, -1)
+
+  # days come in order, a contiguous block is written as a slice
+  if days[-1] - days[0] == days.size - 1:
+    index = slice(days[0]-1, days[-1])
+  else:
+    index = days - 1
+  fid.variables['sst_box_average'][year_index, index] = np.moveaxis(stats['average'], -1, 0)
+  fid.variables['sst_box_anomaly'][year_index, index] = np.moveaxis(sst_anomaly, -1, 0)
+  fid.variables['sst_box_std'][year_index, index] = np.moveaxis(stats['std'], -1, 0)
+  fid.variables['sst_box_count'][year_index, index] = np.moveaxis(stats['count'], -1, 0)
+  if 'analysed_sst' not in fid.variables:
+    return
+  nlat0, nlon0 = len(fid.dimensions['lat']), len(fid.dimensions['lon'])
+  for name, fields, fill in (('analysed_sst', sst, np.nan), ('analysis_error', error, np.nan), ('mask', mask, -1)):
+    cubes = np.empty((days.size, len(windows), len(windows[0]), nlat0, nlon0))
+    for ii in range(0, len(windows)):
+      for jj in range(0, len(windows[ii])):
+        cubes[:,ii,jj] = _box_cube(fields, windows[ii][jj], nlat0, nlon0, fill)
+    fid.variables[name][year_index, index] = cubes
+
+def indexProcessing(dataset_name, startY, endY, lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons, variablename, error_variable, clim_filename, dirname, output_dir, box_cubes=True, append_days=32, prefetch=0):
+  """Daily box average, anomaly, standard deviation and count of every year in one file
+
+  Writes output_dir/data_info.box_index_filename(...).  Every daily field
+  is read once.  Days are buffered append_days at a time, reduced with
+  box_statistics() and written, so memory is append_days daily fields
+  however long the record.  box_cubes keeps the pixels of every box too;
+  prefetch is passed to datacube.iter_daily_fields().
+  """
 
   ### get box info
   nx, ny, box_lat_start, box_lat_end, box_lon_start, box_lon_end = data_info.getboxinfo(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
+  windows = [[(slice(int(box_lat_start[ii]), int(box_lat_end[ii])), slice(int(box_lon_start[jj]), int(box_lon_end[jj]))) for jj in range(0, ny)] for ii in range(0, nx)]
 
   ### Read in climatology
   ncin = Dataset(clim_filename, 'r')
   clim = ncin.variables['sst_box_average'][:]
   ncin.close()
 
-  ### setup size for tempory matrix
-  nlat0 = math.ceil((box_lat_end[0]-box_lat_start[0])/nstep)
-  nlon0 = math.ceil((box_lon_end[0]-box_lon_start[0])/nstep)
-
-  for i in range(startY, endY+1):
-    print("Processing Year = " + str(i)+", please wait ...")
-    k = 0
-
-    sst_year=np.empty((nd, nlat0, nlon0, nx, ny))
-    sst_avg=np.empty((nd, nx, ny))
-    sst_std=np.empty((nd, nx, ny))
-    sst_anomaly=np.empty((nd, nx, ny))
-    error_year=np.empty((nd, nlat0, nlon0, nx, ny))
-    mask_year=np.empty((nd, nlat0, nlon0, nx, ny))
-
-    sst_year[:] = np.nan
-    sst_avg[:] = np.nan
-    sst_std[:] = np.nan
-    sst_anomaly[:] = np.nan
-    error_year[:] = np.nan
-    mask_year[:] = np.nan
-
-    atime=np.empty(nd)
-
-    for j in range(1, nd+1):
-     for filename in glob.glob(dirname+'/'+str(i)+'/'+"{0:0>3}".format(j)+'/*.nc'):
-       ncfile = filename.rsplit( "/")[ -1 ]
-       ncin = Dataset(filename, 'r')
-       sst = ncin.variables[variablename][:]
-       error = ncin.variables[error_variable][:]
-       mask = ncin.variables['mask'][:]
-       for ii in range(0, nx):
-          for jj in range(0, ny):
-             sst_year[k, 0:len(range(int(box_lat_start[ii]),int(box_lat_end[ii]),nstep)), 0:len(range(int(box_lon_start[jj]),int(box_lon_end[jj]),nstep)), ii,jj] = sst[0,int(box_lat_start[ii]):int(box_lat_end[ii]):nstep, int(box_lon_start[jj]):int(box_lon_end[jj]):nstep]
-             error_year[k, 0:len(range(int(box_lat_start[ii]),int(box_lat_end[ii]),nstep)), 0:len(range(int(box_lon_start[jj]),int(box_lon_end[jj]),nstep)), ii,jj] = error[0,int(box_lat_start[ii]):int(box_lat_end[ii]):nstep, int(box_lon_start[jj]):int(box_lon_end[jj]):nstep]
-             mask_year[k, 0:len(range(int(box_lat_start[ii]),int(box_lat_end[ii]),nstep)), 0:len(range(int(box_lon_start[jj]),int(box_lon_end[jj]),nstep)), ii,jj] = mask[0,int(box_lat_start[ii]):int(box_lat_end[ii]):nstep, int(box_lon_start[jj]):int(box_lon_end[jj]):nstep]
-             btemp = mask_year[k, :,:, ii,jj]
-             atemp = sst_year[k, :,:, ii,jj]
-             atemp = atemp.flatten()
-             btemp = btemp.flatten()
-             b = (atemp < -250.0) | (atemp > 350.0) | (btemp > 1)
-             if np.count_nonzero(b) > 0:
-               atemp[b]=np.nan
-             sst_avg[k,ii,jj] = np.nanmean(atemp)
-             sst_std[k,ii,jj] = np.nanstd(atemp)
-             if j == 366:
-               sst_anomaly[k,ii,jj] = sst_avg[k,ii,jj] - clim[364,ii,jj]
-             else:
-               sst_anomaly[k,ii,jj] = sst_avg[k,ii,jj] - clim[j-1,ii,jj]
-       ncin.close()
-       atime[k] = j
-       k = k + 1
-
-    ### create output directory
-    data_info.createdir(output_dir+'/'+str(i))
-
-    for ii in range(0, nx):
-     for jj in range(0, ny):
-        outfilename = output_dir + '/'+str(i)+'/'+variablename+'_'+str(i)+'_'+dataset_name+'_'+str(lat_boxsize)+'_degree_box_'+str(jj+1)+'x'+str(ii+1)+'.nc'
-        fid = Dataset(outfilename,'w')
-        # Define the dimensions
-        nlat = fid.createDimension('lat', math.ceil((box_lat_end[0]-box_lat_start[0])/nstep)) # Unlimited
-        nlon = fid.createDimension('lon', math.ceil((box_lon_end[0]-box_lon_start[0])/nstep)) # Unlimited
-        time = fid.createDimension('time', k) # Unlimited
-
-        nc_var = fid.createVariable('lat', 'f8',('lat'),zlib=True)
-        fid.variables['lat'][:] = lats[int(box_lat_start[ii]):int(box_lat_end[ii]):nstep]
-        fid.variables['lat'].standard_name='latitude'
-        fid.variables['lat'].long_name='latitude'
-        fid.variables['lat'].axis='Y'
-        fid.variables['lat'].units='degrees_north'
-        fid.variables['lat'].comment='Uniform grid with centers from '+str(lats[int(box_lat_start[ii])])+' to '+str(lats[int(box_lat_end[ii])])+ ' degrees.'
-
-        nc_var = fid.createVariable('lon', 'f8',('lon'),zlib=True)
-        fid.variables['lon'][:] = lons[int(box_lon_start[jj]):int(box_lon_end[jj]):nstep]
-        fid.variables['lon'].standard_name='longitude'
-        fid.variables['lon'].long_name='longitude'
-        fid.variables['lon'].units='degrees_east'
-        fid.variables['lon'].axis='X'
-        fid.variables['lon'].comment='Uniform grid with centers from '+str(lons[int(box_lon_start[jj])])+' to '+str(lons[int(box_lon_end[jj])])+' degrees.'
-
-        nc_var = fid.createVariable('time', 'i4',('time'),zlib=True)
-        fid.variables['time'][:] = atime[0:k]
-        fid.variables['time'].standard_name='time'
-        fid.variables['time'].long_name='day number'
-        fid.variables['time'].units='day number'
-        fid.variables['time'].axis='T'
-        fid.variables['time'].comment="Starting on Jan 1 of earch year with day number 1 until the end of the year with either day number 365 or 366 depending on the leap year status."
-
-        nc_var = fid.createVariable('sst_box_average', 'f8',('time'),zlib=True)
-        fid.variables['sst_box_average'][:] = sst_avg[0:k,ii,jj]
-        fid.variables['sst_box_average'].standard_name='SST Average in the Box'
-        fid.variables['sst_box_average'].units='kelvin'
-
-        nc_var = fid.createVariable('sst_box_anomaly', 'f8',('time'),zlib=True)
-        fid.variables['sst_box_anomaly'][:] = sst_anomaly[0:k,ii,jj]
-        fid.variables['sst_box_anomaly'].standard_name='SST Anomaly in the Box'
-        fid.variables['sst_box_anomaly'].units='kelvin'
-
-        nc_var = fid.createVariable('sst_box_std', 'f8',('time'),zlib=True)
-        fid.variables['sst_box_std'][:] = sst_std[0:k,ii,jj]
-        fid.variables['sst_box_std'].standard_name='SST Standard Deviation in the Box'
-        fid.variables['sst_box_std'].units='kelvin'
-
-        nc_var = fid.createVariable('analysed_sst', 'f8',('time', 'lat', 'lon'),zlib=True,fill_value=-32768)
-        fid.variables['analysed_sst'][:] = sst_year[0:k,:,:,ii,jj]
-        fid.variables['analysed_sst'].units='kelvin'
-        #fid.variables['analysed_sst']._FillValue=-32768
-        fid.variables['analysed_sst'].comment='SST defined at all grid points but no physical meaning is ascribed to values over land'
-        fid.variables['analysed_sst'].source='https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
-
-        nc_var = fid.createVariable('analysis_error', 'f8',('time', 'lat', 'lon'),zlib=True,fill_value=-32768)
-        fid.variables['analysis_error'][:] = error_year[0:k,:,:,ii,jj]
-        fid.variables['analysis_error'].units='kelvin'
-        fid.variables['analysis_error'].comment='Error defined at all grid points but no meaning is ascribed to values over land'
-        fid.variables['analysis_error'].source='https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
-
-        nc_var = fid.createVariable('mask', 'i',('time', 'lat', 'lon'),zlib=True,fill_value=-1)
-        fid.variables['mask'][:] = mask_year[0:k,:,:,ii,jj]
-        fid.variables['mask'].valid_min = 0
-        fid.variables['mask'].valid_max = 31
-        fid.variables['mask'].flag_masks = '1b, 2b, 4b, 8b, 16b'
-        fid.variables['mask'].flag_meanings = "water land optional_lake_surface sea_ice optional_river_surface"
-        fid.variables['mask'].comment='Mask can be used to further filter the data'
-        fid.variables['mask'].source='https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
-
-        fid.product_version     = "Version 1.0"
-        #fid.spatial_resolution  = str(dlat*nstep)+" degree"
-        fid.Conventions         = "CF-1.6"
-        #fid.title               = "CMC 0.2 global "+str(dlat*nstep)+" deg daily sea surface temperature analysis using Multi-Resolution Variational Analysis (MRVA) method for interpolation"
-        fid.institution         = "Jet Propulsion Laboratory"
-        fid.summary             = "Applies the method of statistical interpolation to assimilate observations from in situ and satellite sources using, as the background, the analysis valid 24 hours prior assuming persistence of the anomalies."
-        fid.source              = 'https://podaac.jpl.nasa.gov/dataset/CMC0.2deg-CMC-L4-GLOB-v2.0'
-        fid.creator_name        = "Ed Armstrong, Yibo Jiang"
-        fid.creator_email       = "Edward.M.Armstrong@jpl.nasa.gov; Yibo.Jiang@jpl.nasa.gov"
-        fid.creator_url         = "http;//podaac.jpl.nasa.gov"
-        fid.project             = "Phenology of North Atlantic Ocean"
-        fid.acknowledgment      = "This project was supported in part by a grant from"
-        fid.processing_level    = "L4"
-        #fid.date_created        = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
-        fid.gds_version_id      = "2.0r5"
-        fid.naming_authority    = "org.ghrsst"
-        #fid.geospatial_lat_resolution    = str(dlat*nstep)+"f"
-        fid.geospatial_lat_units         = "degrees_north"
-        #fid.geospatial_lon_resolution    = str(dlat*nstep)+"f"
-        fid.geospatial_lon_units         = "degrees_east"
-        fid.westernmost_longitude        = str( lons[int(box_lon_start[jj])] )
-        fid.easternmost_longitude        = str( lons[int(box_lon_end[jj])] )
-        fid.southernmost_latitude        = str( lats[int(box_lat_start[ii])] )
-        fid.northernmost_latitude        = str( lats[int(box_lat_end[ii])] )
-        fid.cdm_data_type       = "Grid"
-
-        fid.close()
+  ### setup size for the box cubes
+  nlat0 = int(box_lat_end[0]-box_lat_start[0])
+  nlon0 = int(box_lon_end[0]-box_lon_start[0])
 
+  ### create output directory
+  data_info.createdir(output_dir)
+
+  outfilename = data_info.box_index_filename(output_dir, variablename, dataset_name, lat_boxsize)
+  fid = create_box_index_file(outfilename, startY, endY, lats, lons, windows, nlat0, nlon0, box_cubes, append_days)
+  try:
+    for i in range(startY, endY+1):
+      print("Processing Year = " + str(i)+", please wait ...")
+
+      days, sst, error, mask = [], [], [], []
+      for j, fields, start_time in datacube.iter_daily_fields(dirname, i, [variablename, error_variable, 'mask'], None, prefetch):
+        days.append(j)
+        sst.append(fields[variablename])
+        error.append(fields[error_variable])
+        # the mask is written as integers, -1 (its _FillValue) where missing
+        mask.append(np.nan_to_num(fields['mask'], nan=-1))
+        if len(days) == append_days:
+          _append_box_days(fid, windows, i-startY, days, np.array(sst), np.array(error), np.array(mask), clim,
+                           box_lat_start, box_lat_end, box_lon_start, box_lon_end)
+          days, sst, error, mask = [], [], [], []
+      if days:
+        _append_box_days(fid, windows, i-startY, days, np.array(sst), np.array(error), np.array(mask), clim,
+                         box_lat_start, box_lat_end, box_lon_start, box_lon_end)
+  finally:
+    fid.close()
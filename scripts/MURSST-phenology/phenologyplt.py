@@ -845,7 +845,18 @@ def plot_line_box_parameter(pname, dataset_name, startY, endY, lat_boxsize, lon_
   ### get box info
   nx, ny, box_lat_start, box_lat_end, box_lon_start, box_lon_end = data_info.getboxinfo(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
 
-  ### Read in data
+  ### Read in data, every box and year in one read
+  ncin = Dataset(data_info.box_index_filename(output_dir, variablename, dataset_name, lat_boxsize), 'r')
+  years = ncin.variables['year'][:]
+  daynumber = ncin.variables['day'][:]
+  if pname == 'Average':
+    data_all = ncin.variables['sst_box_average'][:]
+  elif pname == 'Anomaly':
+    data_all = ncin.variables['sst_box_anomaly'][:]
+  elif pname == 'STD':
+    data_all = ncin.variables['sst_box_std'][:]
+  ncin.close()
+
   for ii in range(0, nx):
     ### setup plot
     fig = plt.figure(ii+1, figsize=(0.5* (endY-startY), 1.5 * ny))
@@ -865,16 +876,16 @@ def plot_line_box_parameter(pname, dataset_name, startY, endY, lat_boxsize, lon_
         
       tpos = 0.0
       for i in range(startY, endY+1):
-        boxfilename = output_dir + '/'+str(i)+'/'+variablename+'_'+str(i)+'_'+dataset_name+'_'+str(lat_boxsize)+'_degree_box_'+str(jj+1)+'x'+str(ii+1)+'.nc'
-        ncin = Dataset(boxfilename, 'r')
-        if pname == 'Average':
-          data_pname = ncin.variables['sst_box_average'][:]
-        elif pname == 'Anomaly':
-          data_pname = ncin.variables['sst_box_anomaly'][:]
+        if i < years[0] or i > years[-1]:
+          continue
+        if pname == 'Anomaly':
           plt.plot([startY, endY+1], [0,0], color='red', linewidth=1)
-        elif pname == 'STD':
-          data_pname = ncin.variables['sst_box_std'][:]
-        atime = ncin.variables['time'][:]
+        # days with data only
+        aday = ~np.ma.getmaskarray(data_all[i-years[0],:,ii,jj])
+        data_pname = data_all[i-years[0],aday,ii,jj]
+        atime = daynumber[aday]
+        if atime.size == 0:
+          continue
         plt.plot(i+atime/float(np.max(atime)), data_pname)
         if np.nanmax(data_pname) == np.nanmax(data_pname):
           tpos = np.nanmax(data_pname)
@@ -890,7 +901,18 @@ def plot_line_box_parameter_merged(pname, dataset_name, startY, endY, lat_boxsiz
   ### get box info
   nx, ny, box_lat_start, box_lat_end, box_lon_start, box_lon_end = data_info.getboxinfo(lat_boxsize, lon_boxsize, lat_min, lat_max, lon_min, lon_max, lats, lons)
 
-  ### Read in data
+  ### Read in data, every box and year in one read
+  ncin = Dataset(data_info.box_index_filename(output_dir, variablename, dataset_name, lat_boxsize), 'r')
+  years = ncin.variables['year'][:]
+  daynumber = ncin.variables['day'][:]
+  if pname == 'Average':
+    data_all = ncin.variables['sst_box_average'][:]
+  elif pname == 'Anomaly':
+    data_all = ncin.variables['sst_box_anomaly'][:]
+  elif pname == 'STD':
+    data_all = ncin.variables['sst_box_std'][:]
+  ncin.close()
+
   for ii in range(0, nx):
     ### setup plot
     fig = plt.figure(ii+1, figsize=(0.5* (endY-startY), 1.5 * ny))
@@ -910,16 +932,16 @@ def plot_line_box_parameter_merged(pname, dataset_name, startY, endY, lat_boxsiz
         
       tpos = 0.0
       for i in range(startY, endY+1):
-        boxfilename = output_dir + '/'+str(i)+'/'+variablename+'_'+str(i)+'_'+dataset_name+'_'+str(lat_boxsize)+'_degree_box_'+str(jj+1)+'x'+str(ii+1)+'.nc'
-        ncin = Dataset(boxfilename, 'r')
-        if pname == 'Average':
-          data_pname = ncin.variables['sst_box_average'][:]
-        elif pname == 'Anomaly':
-          data_pname = ncin.variables['sst_box_anomaly'][:]
+        if i < years[0] or i > years[-1]:
+          continue
+        if pname == 'Anomaly':
           plt.plot([startY, endY+1], [0,0], color='red', linewidth=1)
-        elif pname == 'STD':
-          data_pname = ncin.variables['sst_box_std'][:]
-        atime = ncin.variables['time'][:]
+        # days with data only
+        aday = ~np.ma.getmaskarray(data_all[i-years[0],:,ii,jj])
+        data_pname = data_all[i-years[0],aday,ii,jj]
+        atime = daynumber[aday]
+        if atime.size == 0:
+          continue
         plt.plot(i+atime/float(np.max(atime)), data_pname)
         if np.nanmax(data_pname) == np.nanmax(data_pname):
           tpos = np.nanmax(data_pname)
@@ -19,6 +19,11 @@
 #   2014.12.23  Y. Jiang, version 3 (Modified to be more general including L3 and L4 datasets)
 #   2017.06.20  Y. Jiang, fix to work with MODIS datasets 
 #   2017.09.26  Y. Jiang, fix python 2.6 and 3.0 version issues 
+#   parallel downloads over a pooled in-process HTTP client (python 3 only)
+#   OPeNDAP .ddx metadata cached per dataset shortname
+#   granule search pages parsed as they stream in
+#   several boxes and a variable subset per run, overlapping boxes share requests
+#   optional ingest straight into a per-dataset data cube (datacube.py)
 
 ##################################
 # user parameters to be editted: #
@@ -55,6 +60,7 @@
 # for shortName MUR-JPL-L4-GLOB-v4.1
 
 import sys,os
+import io
 import time
 import datetime
 from datetime import date, timedelta
@@ -63,23 +69,32 @@ from optparse import OptionParser
 from netCDF4 import Dataset
 import calendar
 import ftplib
+import threading
+import json
 import numpy as np
 
 from xml.dom import minidom
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
-if sys.version_info >= (3,0):
-  import subprocess
-  import urllib.request
-else:
-  import commands
-  import urllib
+import http_pool
+import granule_manifest
+import datacube
+import file_catalog
 
 #####################
 # Global Parameters #
 #####################
 
-itemsPerPage = 10
+itemsPerPage = 400     # granules per search page
 PODAAC_WEB = 'https://podaac.jpl.nasa.gov'
+maxConcurrency = 4
+
+# the netCDF/HDF5 library is not thread-safe, local file work is serialized
+netcdfLock = threading.Lock()
+
+# parsed .ddx metadata per dataset shortname, delete the file to refresh it
+metadataCache = os.path.join(os.path.expanduser('~'), '.podaac_phenology', 'opendap_metadata.json')
 
 ###############
 # subroutines #
@@ -177,61 +192,106 @@ def boundingindex(sort,nt,dmin,dint,length,boundary0,boundary1):
 
   return [inx0,inx1]
 
-def download_data(start_year, start_month, start_day, end_year, end_month, end_day, latmin, latmax, lonmin, lonmax, gridpoints, shortname, rootdir):
-
-  # get command line options:
-
-  year0=start_year; month0=str(start_month).zfill(2); day0=str(start_day).zfill(2);
-  year1=end_year; month1=str(end_month).zfill(2); day1=str(end_day).zfill(2);
-
-  timeStr = '&startTime='+year0+'-'+month0+'-'+day0+'&endTime='+year1+'-'+month1+'-'+day1
-
-  ig = gridpoints
-  box = [lonmin, lonmax, latmin, latmax]
-
-  print ('Longitude range: %f to %f'%(box[0],box[1]))
-  print ('Latitude range: %f to %f'%(box[2],box[3]))
-
-  wsurl = PODAAC_WEB+'/ws/search/granule/?shortName='+shortname+timeStr+'&itemsPerPage=1&sortBy=timeAsc'
-
-  print ('\nPlease wait while program searching for the granules ...\n')
-
-  if sys.version_info >= (3,0):
-    response = urllib.request.urlopen(wsurl)
-  else:
-    response = urllib.urlopen(wsurl)
-  data = response.read()
-
-  if (len(data.splitlines()) == 1):
-    sys.exit('No granules found for dataset: '+shortname+'\nProgram will exit now !\n')
-
-  numGranules = 0
-  doc = minidom.parseString(data)
-  for arrays in doc.getElementsByTagName('link'):
-   names = arrays.getAttribute("title")
-   if names == 'OPeNDAP URL':
-      numGranules = numGranules + 1
-      href = arrays.getAttribute("href")
-      #if numGranules > 0:
-      #  break
-
-  if numGranules == 0 and len(data.splitlines()) < 30:
-    sys.exit('No granules found for dataset: '+shortname+'\nProgram will exit now !\n')
-  elif numGranules == 0 and len(data.splitlines()) > 30:
-    sys.exit('No OpenDap access for dataset: '+shortname+'\nProgram will exit now !\n')
-
-  samplefile = href.rsplit( ".", 1 )[ 0 ] + '.ddx'
-
+def download_pool(tasks, fetch, max_concurrency=maxConcurrency):
+  """Run fetch(*task) for every task on a bounded pool of worker threads
+
+  tasks may be a generator (e.g. the paged granule search); it is consumed
+  in the calling thread while earlier downloads are still in flight, with
+  at most 2*max_concurrency tasks queued at any time.  The fetch results
+  are returned in submission order.
+  """
+  max_concurrency = max(1, int(max_concurrency))
+  slots = threading.BoundedSemaphore(2*max_concurrency)
+  futures = []
+  with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+    for task in tasks:
+      slots.acquire()
+      future = pool.submit(fetch, *task)
+      future.add_done_callback(lambda f: slots.release())
+      futures.append(future)
+  return [future.result() for future in futures]
+
+def _localname(tag):
+  return tag.rsplit('}', 1)[-1]
+
+def search_granules(shortname, timeStr, items_per_page=itemsPerPage):
+  """Page through the PO.DAAC granule search
+
+  Each page is read whole, so its connection goes back to the pool before
+  any download starts, then parsed incrementally: the OPeNDAP URL and
+  "updated" stamp of every granule entry are yielded as soon as the entry
+  is parsed.
+  """
+  startIndex = 0
+  while True:
+    urllink = PODAAC_WEB+'/ws/search/granule/?shortName='+shortname+timeStr+'&itemsPerPage=%d&sortBy=timeAsc'%items_per_page
+    if startIndex > 0:
+      urllink = urllink+'&startIndex=%d'%startIndex
+
+    numEntries = 0
+    for event, elem in ElementTree.iterparse(io.BytesIO(http_pool.fetch(urllink)), events=('end',)):
+      if _localname(elem.tag) != 'entry':
+        continue
+      numEntries = numEntries + 1
+      href = None
+      updated = None
+      for child in elem:
+        name = _localname(child.tag)
+        if name == 'link' and child.get('title') == 'OPeNDAP URL':
+          href = child.get('href')
+        elif name == 'updated':
+          updated = child.text
+      # drop the finished entry so memory stays flat on large pages
+      elem.clear()
+      if href is not None:
+        yield href, updated
+
+    if numEntries < items_per_page:
+      break
+    startIndex = startIndex + items_per_page
+
+def write_info_file(ncout, shortname, rootdir):
+  """Save the lat/lon grid of a downloaded granule as <shortname>_info.nc"""
+  ncin = Dataset(ncout, 'r')
+  lons = ncin.variables['lon'][:]
+  lats = ncin.variables['lat'][:]
+  ncin.close()
+  write_info_grid(lats, lons, shortname, rootdir)
+
+def write_info_grid(lats, lons, shortname, rootdir):
+  """Save a lat/lon grid as <shortname>_info.nc"""
+  outfilename = rootdir+"/"+shortname + '_info.nc'
+  fid = Dataset(outfilename,'w')
+  # Define the dimensions
+  nlat = fid.createDimension('lat', lats.size) # Unlimited
+  nlon = fid.createDimension('lon', lons.size) # Unlimited
+
+  nc_var = fid.createVariable('lat', 'f8',('lat'),zlib=True)
+  fid.variables['lat'][:] = lats
+  fid.variables['lat'].standard_name='latitude'
+  fid.variables['lat'].long_name='latitude'
+  fid.variables['lat'].axis='Y'
+  fid.variables['lat'].units='degrees_north'
+
+  nc_var = fid.createVariable('lon', 'f8',('lon'),zlib=True)
+  fid.variables['lon'][:] = lons
+  fid.variables['lon'].standard_name='longitude'
+  fid.variables['lon'].long_name='longitude'
+  fid.variables['lon'].units='degrees_east'
+  fid.variables['lon'].axis='X'
+
+  fid.cdm_data_type = "Grid"
+  fid.close()
+
+def parse_ddx(data, shortname):
+  """Grid geometry, variable list and index order from an OPeNDAP .ddx document"""
   variable_list = []
   lon_order = 'X'
   lat_order = 'Y'
   nt = 1 #time dimension
   nd = 1 #depth dimension
 
-  if sys.version_info >= (3,0):
-    doc = minidom.parse(urllib.request.urlopen(samplefile))
-  else:
-    doc = minidom.parse(urllib.urlopen(samplefile))
+  doc = minidom.parseString(data)
   for arrays in doc.getElementsByTagName('Grid'):
    names = arrays.getAttribute("name")
    if names == 'lat' or names == 'latitude':
@@ -356,14 +416,73 @@ def download_data(start_year, start_month, start_day, end_year, end_month, end_d
   except NameError:
     sys.exit('No easternmost_longitude info for dataset: '+shortname+'\n')
 
-  nlon = nj
-  nlat = ni
+  return {'variable_list': variable_list, 'nlat': ni, 'nlon': nj,
+          'lat_order': lat_order, 'lon_order': lon_order,
+          'nt': nt, 'nd': nd,
+          'has_time': 'ntime' in locals(), 'has_depth': 'ndepth' in locals(),
+          'lat0': lat0, 'lat1': lat1, 'lon0': lon0, 'lon1': lon1,
+          'lat_sort': lat_sort, 'lon_sort': lon_sort}
+
+def dataset_metadata(shortname, timeStr):
+  """Parsed .ddx metadata of a dataset, from the metadata cache if possible
+
+  On a cache miss one granule is looked up with the granule search, its
+  .ddx is parsed and the result is stored under the shortname.
+  """
+  cache = {}
+  if os.path.exists(metadataCache):
+    try:
+      with open(metadataCache) as f:
+        cache = json.load(f)
+    except ValueError:
+      cache = {}
+  if shortname in cache:
+    print ('Using cached OPeNDAP metadata for '+shortname+' from '+metadataCache)
+    return cache[shortname]
+
+  wsurl = PODAAC_WEB+'/ws/search/granule/?shortName='+shortname+timeStr+'&itemsPerPage=1&sortBy=timeAsc'
+
+  print ('\nPlease wait while program searching for the granules ...\n')
+
+  data = http_pool.fetch(wsurl)
+
+  if (len(data.splitlines()) == 1):
+    sys.exit('No granules found for dataset: '+shortname+'\nProgram will exit now !\n')
+
+  numGranules = 0
+  doc = minidom.parseString(data)
+  for arrays in doc.getElementsByTagName('link'):
+   names = arrays.getAttribute("title")
+   if names == 'OPeNDAP URL':
+      numGranules = numGranules + 1
+      href = arrays.getAttribute("href")
+      #if numGranules > 0:
+      #  break
+
+  if numGranules == 0 and len(data.splitlines()) < 30:
+    sys.exit('No granules found for dataset: '+shortname+'\nProgram will exit now !\n')
+  elif numGranules == 0 and len(data.splitlines()) > 30:
+    sys.exit('No OpenDap access for dataset: '+shortname+'\nProgram will exit now !\n')
+
+  samplefile = href.rsplit( ".", 1 )[ 0 ] + '.ddx'
+
+  meta = parse_ddx(http_pool.fetch(samplefile), shortname)
+
+  cache[shortname] = meta
+  createdir(os.path.dirname(metadataCache))
+  tmpfile = metadataCache + '.%d.tmp' % os.getpid()
+  with open(tmpfile, 'w') as f:
+    json.dump(cache, f, indent=1, sort_keys=True)
+  os.replace(tmpfile, metadataCache)
+  return meta
 
-  dint_lon = (lon1-lon0)/float(nlon)
-  dint_lat = (lat1-lat0)/float(nlat)
+def box_index(meta, box, ig):
+  """Grid index range [i0,i1,j0,j1] of a [latmin, latmax, lonmin, lonmax] box"""
+  dint_lon = (meta['lon1']-meta['lon0'])/float(meta['nlon'])
+  dint_lat = (meta['lat1']-meta['lat0'])/float(meta['nlat'])
 
-  [i0,i1]=boundingindex(lon_sort,nlon,lon0,dint_lon,nlon,box[0],box[1])
-  [j0,j1]=boundingindex(lat_sort,nlat,lat0,dint_lat,nlat,box[2],box[3])
+  [i0,i1]=boundingindex(meta['lon_sort'],meta['nlon'],meta['lon0'],dint_lon,meta['nlon'],box[2],box[3])
+  [j0,j1]=boundingindex(meta['lat_sort'],meta['nlat'],meta['lat0'],dint_lat,meta['nlat'],box[0],box[1])
   if i0>i1 or j0>j1:
     sys.exit('No grid point in your domain box.')
 
@@ -371,155 +490,290 @@ def download_data(start_year, start_month, start_day, end_year, end_month, end_d
   if ig>1:
     i1=max(span(i0,i1,ig))
     j1=max(span(j0,j1,ig))
+  return [i0,i1,j0,j1]
+
+def merge_boxes(index_boxes, ig):
+  """Group box index ranges that are cheaper to request as one hyperslab
+
+  Two groups are merged while the bounding hyperslab of both holds no more
+  grid points than the two hyperslabs requested separately, so overlapping
+  or adjacent boxes share one request.  With a grid skip ig > 1 only boxes
+  whose starts lie on the same ig lattice are merged, so every box gets
+  the same points from the group hyperslab as from its own request.
+  Returns lists of box numbers.
+  """
+  def lattice(r):
+    return (r[0] % ig, r[2] % ig)
+
+  # box ends are on the lattice of their start (box_index), so are the
+  # ends of a union of boxes sharing a lattice
+  def npoints(r):
+    return ((r[1]-r[0])//ig+1)*((r[3]-r[2])//ig+1)
+
+  def union(a, b):
+    return [min(a[0],b[0]), max(a[1],b[1]), min(a[2],b[2]), max(a[3],b[3])]
+
+  groups = [[[k], list(r)] for k, r in enumerate(index_boxes)]
+  while len(groups) > 1:
+    best = None
+    for m in range(len(groups)):
+      for n in range(m+1, len(groups)):
+        if lattice(groups[m][1]) != lattice(groups[n][1]):
+          continue
+        saved = npoints(groups[m][1]) + npoints(groups[n][1]) - npoints(union(groups[m][1], groups[n][1]))
+        if saved >= 0 and (best is None or saved > best[0]):
+          best = (saved, m, n)
+    if best is None:
+      break
+    saved, m, n = best
+    groups[m] = [groups[m][0] + groups[n][0], union(groups[m][1], groups[n][1])]
+    del groups[n]
+  return [g[0] for g in groups]
+
+def constraint_index(meta, inx_lon, inx_lat):
+  """OPeNDAP hyperslab string for the lon and lat index ranges [start,stride,stop]"""
+  nt = meta['nt']
+  nd = meta['nd']
 
   #************************************************************************************
-  if lon_order == 'X':
-    try:
-       ntime # does a exist in the current namespace
-       order=[0,2,1]
-       try:
-         ndepth # does a exist in the current namespace
-         order=[0,1,3,2]
-       except NameError:
-         order=[0,2,1]
-    except NameError:
-       order=[1,0]
+  if meta['lon_order'] == 'X':
+    if meta['has_time'] and meta['has_depth']:
+      order=[0,1,3,2]
+    elif meta['has_time']:
+      order=[0,2,1]
+    else:
+      order=[1,0]
   else:
-    try:
-       ntime # does a exist in the current namespace
-       order=[0,1,2]
-       try:
-         ndepth # does a exist in the current namespace
-         order=[0,1,2,3]
-       except NameError:
-         order=[0,1,2]
-    except NameError:
-       order=[0,1]
+    if meta['has_time'] and meta['has_depth']:
+      order=[0,1,2,3]
+    elif meta['has_time']:
+      order=[0,1,2]
+    else:
+      order=[0,1]
   #************************************************************************************
-  # download size information:
-  print (' ')
-  print ('Longitude range: %f to %f'%(box[0],box[1]))
-  print ('Latitude range: %f to %f'%(box[2],box[3]))
-  print ('  every %d pixel(s) is obtained'%(ig))
-  print (' ')
-  print ('grid dimensions will be ( %d x %d )'%(len(span(i0,i1,ig)),len(span(j0,j1,ig))))
-  print (' ')
-
-  # Check if curl or wget commands exsit on your computer
-  if sys.version_info >= (3,0):
-    status_curl, result = subprocess.getstatusoutput('which curl')
-    status_wget, result = subprocess.getstatusoutput('which wget')
-  else:
-    status_curl, result = commands.getstatusoutput("which curl")
-    status_wget, result = commands.getstatusoutput("which wget")
 
   # form the index set for the command line:
-  try:
-     ntime # does a exist in the current namespace
-     inx=[[0,1,nt-1],[i0,ig,i1],[j0,ig,j1]]
-     try:
-       ndepth # does a exist in the current namespace
-       inx=[[0,1,nt-1],[0,1,nd-1],[i0,ig,i1],[j0,ig,j1]]
-     except NameError:
-       inx=[[0,1,nt-1],[i0,ig,i1],[j0,ig,j1]]
-  except NameError:
-     inx=[[i0,ig,i1],[j0,ig,j1]]
-     try:
-       ndepth # does a exist in the current namespace
-       inx=[[0,1,nd-1],[i0,ig,i1],[j0,ig,j1]]
-     except NameError:
-       inx=[[i0,ig,i1],[j0,ig,j1]]
+  if meta['has_time'] and meta['has_depth']:
+    inx=[[0,1,nt-1],[0,1,nd-1],inx_lon,inx_lat]
+  elif meta['has_time']:
+    inx=[[0,1,nt-1],inx_lon,inx_lat]
+  elif meta['has_depth']:
+    inx=[[0,1,nd-1],inx_lon,inx_lat]
+  else:
+    inx=[inx_lon,inx_lat]
 
   index=''
   for i in order:
     index=index+'[%d:%d:%d]'%(inx[i][0],inx[i][1],inx[i][2])
+  return index
+
+def split_granule(groupfile, outputs):
+  """Cut per-box files out of a granule downloaded for a merged box group
+
+  outputs is a list of (ncout, lat slice, lon slice), the slices index the
+  lat/lon dimensions of groupfile.  Values are copied unscaled.
+  """
+  ncin = Dataset(groupfile, 'r')
+  for ncout, lat_slice, lon_slice in outputs:
+    cut = {}
+    for name in ncin.dimensions:
+      if name in ('lat', 'latitude'):
+        cut[name] = lat_slice
+      elif name in ('lon', 'longitude'):
+        cut[name] = lon_slice
+
+    partfile = ncout + '.part'
+    fid = Dataset(partfile, 'w', format=ncin.data_model)
+    fid.setncatts({k: ncin.getncattr(k) for k in ncin.ncattrs()})
+    for name, dim in ncin.dimensions.items():
+      if name in cut:
+        fid.createDimension(name, len(range(*cut[name].indices(len(dim)))))
+      else:
+        fid.createDimension(name, None if dim.isunlimited() else len(dim))
+    for name, var in ncin.variables.items():
+      var.set_auto_maskandscale(False)
+      fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+      out = fid.createVariable(name, var.dtype, var.dimensions, zlib=True, fill_value=fill)
+      out.set_auto_maskandscale(False)
+      out.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+      out[...] = var[tuple(cut.get(d, slice(None)) for d in var.dimensions)]
+    fid.close()
+    os.replace(partfile, ncout)
+  ncin.close()
+
+def download_data(start_year, start_month, start_day, end_year, end_month, end_day, latmin, latmax, lonmin, lonmax, gridpoints, shortname, rootdir, max_concurrency=maxConcurrency, items_per_page=itemsPerPage, cubename=None):
+
+  download_data_boxes(start_year, start_month, start_day, end_year, end_month, end_day,
+                      [[latmin, latmax, lonmin, lonmax]], gridpoints, shortname, [rootdir],
+                      None, max_concurrency, items_per_page, cubename)
+
+def download_data_boxes(start_year, start_month, start_day, end_year, end_month, end_day, boxes, gridpoints, shortname, rootdirs, variables=None, max_concurrency=maxConcurrency, items_per_page=itemsPerPage, cubename=None):
+  """Subset several [latmin, latmax, lonmin, lonmax] boxes in one pass
+
+  Box k is written under rootdirs[k].  Overlapping or adjacent boxes are
+  merged into one OPeNDAP request per granule and cut apart locally, and
+  variables (default: all gridded variables) limits the requested fields.
+
+  With cubename set, granules are decoded in memory and appended to the
+  data cube rootdirs[k]/cubename instead of being saved as daily files;
+  dates already in the cube are skipped.
+  """
 
-  # main loop:
-  start = time.time()
-  bmore = 1
-  bwrite = False
-  while (bmore > 0):
-   if (bmore == 1):
-       urllink = PODAAC_WEB+'/ws/search/granule/?shortName='+shortname+timeStr+'&itemsPerPage=%d&sortBy=timeAsc'%itemsPerPage
-   else:
-       urllink = PODAAC_WEB+'/ws/search/granule/?shortName='+shortname+timeStr+'&itemsPerPage=%d&sortBy=timeAsc&startIndex=%d'%(itemsPerPage, (bmore-1)*itemsPerPage)
-   bmore = bmore + 1
-   if sys.version_info >= (3,0):
-     response = urllib.request.urlopen(urllink)
-   else:
-     response = urllib.urlopen(urllink)
-   data = response.read()
-   doc = minidom.parseString(data)
-
-   numGranules = 0
-   for arrays in doc.getElementsByTagName('link'):
-    names = arrays.getAttribute("title")
-    if names == 'OPeNDAP URL':
-      numGranules = numGranules + 1
-      href = arrays.getAttribute("href")
-      ncfile = href.rsplit( ".", 1 )[ 0 ]
-      head, tail = os.path.split(ncfile)
-      ncout = tail
-      if ncout.endswith('.bz2') or ncout.endswith('.gz'):
-        ncout = ncout.rsplit( ".", 1 )[ 0 ]
-      ncout = ncout.rsplit( ".", 1 )[ 0 ]+'_subset.'+ncout.rsplit( ".", 1 )[ 1 ]
-      day_of_year = datetime.date(int(ncout[0:4]), int(ncout[4:6]), int(ncout[6:8])).timetuple().tm_yday
-      outdir = rootdir + '/' + ncout[0:4] + '/' + str(day_of_year).zfill(3)
-      ncout = outdir + '/' + ncout
-      createdir(outdir)
+  # get command line options:
+
+  year0=start_year; month0=str(start_month).zfill(2); day0=str(start_day).zfill(2);
+  year1=end_year; month1=str(end_month).zfill(2); day1=str(end_day).zfill(2);
+
+  timeStr = '&startTime='+year0+'-'+month0+'-'+day0+'&endTime='+year1+'-'+month1+'-'+day1
+
+  ig = gridpoints
+
+  for box in boxes:
+    print ('Longitude range: %f to %f'%(box[2],box[3]))
+    print ('Latitude range: %f to %f'%(box[0],box[1]))
+
+  meta = dataset_metadata(shortname, timeStr)
+  variable_list = meta['variable_list']
+  if variables is not None:
+    variable_list = [item for item in variable_list if item in variables]
+    if not variable_list:
+      sys.exit('None of the variables '+' '.join(variables)+' found in dataset: '+shortname+'\n')
+
+  index_boxes = [box_index(meta, box, ig) for box in boxes]
+
+  #************************************************************************************
+  # download size information:
+  for box, (i0,i1,j0,j1) in zip(boxes, index_boxes):
+    print (' ')
+    print ('Longitude range: %f to %f'%(box[2],box[3]))
+    print ('Latitude range: %f to %f'%(box[0],box[1]))
+    print ('  every %d pixel(s) is obtained'%(ig))
+    print (' ')
+    print ('grid dimensions will be ( %d x %d )'%(len(span(i0,i1,ig)),len(span(j0,j1,ig))))
+    print (' ')
+
+  # one constraint expression per group of merged boxes, each box of a
+  # group is cut out of the group hyperslab by its local lat/lon slices
+  groups = []
+  for members in merge_boxes(index_boxes, ig):
+    gi0 = min(index_boxes[k][0] for k in members)
+    gi1 = max(index_boxes[k][1] for k in members)
+    gj0 = min(index_boxes[k][2] for k in members)
+    gj1 = max(index_boxes[k][3] for k in members)
+    index = constraint_index(meta, [gi0,ig,gi1], [gj0,ig,gj1])
+    cuts = []
+    for k in members:
+      # members share the group's ig lattice (merge_boxes), offsets divide exactly
+      i0,i1,j0,j1 = index_boxes[k]
+      lat_slice = slice((j0-gj0)//ig, (j1-gj0)//ig+1)
+      lon_slice = slice((i0-gi0)//ig, (i1-gi0)//ig+1)
+      cuts.append((k, lat_slice, lon_slice))
+    groups.append((index, cuts))
+  if len(groups) < len(boxes):
+    print ('%d boxes merged into %d request(s) per granule'%(len(boxes), len(groups)))
+
+  info_written = set()
+
+  manifests = [granule_manifest.Manifest(rootdir) for rootdir in rootdirs]
+  writers = None
+  if cubename is not None:
+    writers = [datacube.CubeWriter(rootdir + '/' + cubename) for rootdir in rootdirs]
+
+  def fetch(href, updated):
+    ncfile = href.rsplit( ".", 1 )[ 0 ]
+    head, tail = os.path.split(ncfile)
+    ncbase = tail
+    if ncbase.endswith('.bz2') or ncbase.endswith('.gz'):
+      ncbase = ncbase.rsplit( ".", 1 )[ 0 ]
+    ncbase = ncbase.rsplit( ".", 1 )[ 0 ]+'_subset.'+ncbase.rsplit( ".", 1 )[ 1 ]
+    day = datetime.date(int(ncbase[0:4]), int(ncbase[4:6]), int(ncbase[6:8]))
+    day_of_year = day.timetuple().tm_yday
+    daydir = '/' + ncbase[0:4] + '/' + str(day_of_year).zfill(3)
+
+    written = []
+    for index, cuts in groups:
       cmd=ncfile+'.nc?'
       for item in variable_list:
         cmd=cmd+item+index+','
       cmd=cmd[0:(len(cmd)-1)]  # remove the extra "," at the end.
 
-      if status_curl == 0:
-        #cmd='curl -g -silent "'+cmd+'" -o '+ ncout
-        cmd='curl -g  "'+cmd+'" -o '+ ncout
-      elif status_wget == 0:
-        cmd='wget -quite "'+cmd+'" -O '+ ncout
+      # ingest mode: decode the hyperslab in memory and append it to the cubes
+      if writers is not None:
+        if all(writers[k].has(day) for k, lat_slice, lon_slice in cuts):
+          print (ncbase + ' is already in the data cube, skipped !')
+          continue
+        try:
+          data = http_pool.fetch(cmd)
+          with netcdfLock:
+            ncin = Dataset('granule.nc', memory=data)
+            for k, lat_slice, lon_slice in cuts:
+              writers[k].append(ncin, day, lat_slice, lon_slice)
+            ncin.close()
+        except Exception as e:
+          print (e)
+          return None
+        print (ncbase + ' ingested into the data cube !')
+        continue
+
+      outputs = []
+      for k, lat_slice, lon_slice in cuts:
+        createdir(rootdirs[k] + daydir)
+        outputs.append((k, rootdirs[k] + daydir + '/' + ncbase, lat_slice, lon_slice))
+
+      if len(outputs) == 1:
+        k, ncout = outputs[0][0:2]
+        if not manifests[k].fetch(cmd, ncout, updated):
+          return None
+      elif all(manifests[k].is_current(ncout, cmd, updated) for k, ncout, lat_slice, lon_slice in outputs):
+        for k, ncout, lat_slice, lon_slice in outputs:
+          print (ncout + ' is up to date, skipped !')
       else:
-        sys.exit('\nThe script will need curl or wget on the system, please install them first before running the script !\nProgram will exit now !\n')
-
-      os.system( cmd )
-      print (ncout + ' download finished !')
-      if bwrite == False:
-        ncin = Dataset(ncout, 'r')
-        lons = ncin.variables['lon'][:]
-        lats = ncin.variables['lat'][:]
-        ncin.close()
-
-        outfilename = rootdir+"/"+shortname + '_info.nc'
-        fid = Dataset(outfilename,'w')
-        # Define the dimensions
-        nlat = fid.createDimension('lat', lats.size) # Unlimited
-        nlon = fid.createDimension('lon', lons.size) # Unlimited
-
-        nc_var = fid.createVariable('lat', 'f8',('lat'),zlib=True)
-        fid.variables['lat'][:] = lats
-        fid.variables['lat'].standard_name='latitude'
-        fid.variables['lat'].long_name='latitude'
-        fid.variables['lat'].axis='Y'
-        fid.variables['lat'].units='degrees_north'
-
-        nc_var = fid.createVariable('lon', 'f8',('lon'),zlib=True)
-        fid.variables['lon'][:] = lons
-        fid.variables['lon'].standard_name='longitude'
-        fid.variables['lon'].long_name='longitude'
-        fid.variables['lon'].units='degrees_east'
-        fid.variables['lon'].axis='X'
-
-        fid.cdm_data_type = "Grid"
-        fid.close()
-        bwrite = True
-  
-   if numGranules < itemsPerPage:
-     bmore = 0
+        groupfile = outputs[0][1] + '.group'
+        try:
+          http_pool.download(cmd, groupfile)
+          with netcdfLock:
+            split_granule(groupfile, [output[1:] for output in outputs])
+        except Exception as e:
+          print (e)
+          return None
+        finally:
+          if os.path.exists(groupfile):
+            os.remove(groupfile)
+        for k, ncout, lat_slice, lon_slice in outputs:
+          manifests[k].record(ncout, cmd, 'done', updated, os.path.getsize(ncout), granule_manifest.file_checksum(ncout))
+          print (ncout + ' download finished !')
+      written.extend(output[0:2] for output in outputs)
+
+    # keep the grid of the first granule for the later processing steps
+    with netcdfLock:
+      for k, ncout in written:
+        if k not in info_written:
+          write_info_file(ncout, shortname, rootdirs[k])
+          info_written.add(k)
+    return ncbase
+
+  # main loop: the granule search is paged in this thread while up to
+  # max_concurrency granules are fetched in the background
+  start = time.time()
+  try:
+    results = download_pool(search_granules(shortname, timeStr, items_per_page), fetch, max_concurrency)
+  finally:
+    for k, writer in enumerate(writers or []):
+      if writer.fid is not None:
+        lats, lons = writer.grid()
+        write_info_grid(lats, lons, shortname, rootdirs[k])
+      writer.close()
+  nfailed = results.count(None)
+  if nfailed > 0:
+    print (str(nfailed) + ' granule(s) failed, run the download again to retry them')
 
   end = time.time()
   print ('Time spend = ' + str(end - start) + ' seconds')
+  for rootdir in rootdirs:
+    file_catalog.invalidate(rootdir)
 
 
-def download_data_seawifs(start_year, start_month, start_day, end_year, end_month, end_day, latmin, latmax, lonmin, lonmax, gridpoints, rootdir):
+def download_data_seawifs(start_year, start_month, start_day, end_year, end_month, end_day, latmin, latmax, lonmin, lonmax, gridpoints, rootdir, max_concurrency=maxConcurrency):
 
   GSFC_WEB = 'https://oceandata.sci.gsfc.nasa.gov:443/opendap/SeaWiFS/L3SMI/'
 
@@ -558,14 +812,6 @@ def download_data_seawifs(start_year, start_month, start_day, end_year, end_mont
   print ('Latitude range: %f to %f'%(box[2],box[3]))
   print (' ')
 
-  # Check if curl or wget commands exsit on your computer
-  if sys.version_info >= (3,0):
-    status_curl, result = subprocess.getstatusoutput('which curl')
-    status_wget, result = subprocess.getstatusoutput('which wget')
-  else:
-    status_curl, result = commands.getstatusoutput("which curl")
-    status_wget, result = commands.getstatusoutput("which wget")
-
   lat_index = '[%d:%d:%d]'%(j0,1,j1)
   lon_index = '[%d:%d:%d]'%(i0,1,i1)
 
@@ -575,6 +821,7 @@ def download_data_seawifs(start_year, start_month, start_day, end_year, end_mont
   day_of_year0 = datetime.date(int(start_year), int(start_month), int(start_day)).timetuple().tm_yday
   day_of_year1 = datetime.date(int(end_year), int(end_month), int(end_day)).timetuple().tm_yday
 
+  tasks = []
   for i in range(year0, year1+1):
     range_start = 1
     range_end = 367
@@ -588,33 +835,27 @@ def download_data_seawifs(start_year, start_month, start_day, end_year, end_mont
       range_end = day_of_year1
 
     for j in range(range_start, range_end):
-      filename = 'S'+str(i)+str(j).zfill(3)+'.L3m_DAY_CHL_chlor_a_9km.nc.nc'
-      filename0 = 'S'+str(i)+str(j).zfill(3)+'.L3m_DAY_CHL_chlor_a_9km.nc'
-      outdir = rootdir + '/' + str(i) + '/' + str(j).zfill(3)
-      ncout = outdir + '/' + filename0
-      createdir(outdir)
+      tasks.append((i, j))
 
-      cmd = GSFC_WEB+str(i)+'/'+str(j).zfill(3)+'/'+filename+'?chlor_a'+lat_index+lon_index+',lat'+lat_index+',lon'+lon_index+',palette[0:1:2][0:1:255]'
+  def fetch(i, j):
+    filename = 'S'+str(i)+str(j).zfill(3)+'.L3m_DAY_CHL_chlor_a_9km.nc.nc'
+    filename0 = 'S'+str(i)+str(j).zfill(3)+'.L3m_DAY_CHL_chlor_a_9km.nc'
+    outdir = rootdir + '/' + str(i) + '/' + str(j).zfill(3)
+    ncout = outdir + '/' + filename0
+    createdir(outdir)
 
-      if status_curl == 0:
-        #cmd='curl -g -silent "'+cmd+'" -o '+ ncout
-        cmd='curl -g  "'+cmd+'" -o '+ ncout
-      elif status_wget == 0:
-        cmd='wget -quite "'+cmd+'" -O '+ ncout
-      else:
-        sys.exit('\nThe script will need curl or wget on the system, please install them first before running the script !\nProgram will exit now !\n')
+    cmd = GSFC_WEB+str(i)+'/'+str(j).zfill(3)+'/'+filename+'?chlor_a'+lat_index+lon_index+',lat'+lat_index+',lon'+lon_index+',palette[0:1:2][0:1:255]'
 
-      os.system( cmd )
-      print (ncout + ' download finished !')
+    # responses smaller than 1000 bytes are error pages, not granules
+    if not manifest.fetch(cmd, ncout, minsize=1000) and not os.listdir(outdir):
+      os.rmdir(outdir)
 
-      # remove file if file does not exist or damaged
-      bsize = os.path.getsize(ncout)
-      if(bsize < 1000):
-        os.remove(ncout)
-        os.rmdir(outdir)
+  manifest = granule_manifest.Manifest(rootdir)
+  download_pool(tasks, fetch, max_concurrency)
   
   end = time.time()
   print ('Time spend = ' + str(end - start) + ' seconds')
+  file_catalog.invalidate(rootdir)
 
 
 def download_data_modis_bck(start_year, start_month, start_day, end_year, end_month, end_day, latmin, latmax, lonmin, lonmax, gridpoints, rootdir):
@@ -656,14 +897,6 @@ def download_data_modis_bck(start_year, start_month, start_day, end_year, end_mo
   print ('Latitude range: %f to %f'%(box[2],box[3]))
   print (' ')
 
-  # Check if curl or wget commands exsit on your computer
-  if sys.version_info >= (3,0):
-    status_curl, result = subprocess.getstatusoutput('which curl')
-    status_wget, result = subprocess.getstatusoutput('which wget')
-  else:
-    status_curl, result = commands.getstatusoutput("which curl")
-    status_wget, result = commands.getstatusoutput("which wget")
-
   lat_index = '[%d:%d:%d]'%(j0,1,j1)
   lon_index = '[%d:%d:%d]'%(i0,1,i1)
 
@@ -694,28 +927,25 @@ def download_data_modis_bck(start_year, start_month, start_day, end_year, end_mo
 
       cmd = GSFC_WEB+str(i)+'/'+str(j).zfill(3)+'/'+filename+'?chlor_a'+lat_index+lon_index+',lat'+lat_index+',lon'+lon_index+',palette[0:1:2][0:1:255]'
 
-      if status_curl == 0:
-        #cmd='curl -g -silent "'+cmd+'" -o '+ ncout
-        cmd='curl -g  "'+cmd+'" -o '+ ncout
-      elif status_wget == 0:
-        cmd='wget -quite "'+cmd+'" -O '+ ncout
-      else:
-        sys.exit('\nThe script will need curl or wget on the system, please install them first before running the script !\nProgram will exit now !\n')
-
-      os.system( cmd )
+      try:
+        http_pool.download(cmd, ncout)
+      except http_pool.HTTPError as e:
+        print (e)
       print (ncout + ' download finished !')
 
       # remove file if file does not exist or damaged
-      bsize = os.path.getsize(ncout)
-      if(bsize < 1000):
+      if not os.path.exists(ncout):
+        os.rmdir(outdir)
+      elif(os.path.getsize(ncout) < 1000):
         os.remove(ncout)
         os.rmdir(outdir)
   
   end = time.time()
   print ('Time spend = ' + str(end - start) + ' seconds')
+  file_catalog.invalidate(rootdir)
 
 
-def download_data_modis(start_year, start_month, start_day, end_year, end_month, end_day, latmin, latmax, lonmin, lonmax, gridpoints, rootdir):
+def download_data_modis(start_year, start_month, start_day, end_year, end_month, end_day, latmin, latmax, lonmin, lonmax, gridpoints, rootdir, max_concurrency=maxConcurrency):
 
   #GSFC_WEB = 'https://oceandata.sci.gsfc.nasa.gov/MODIS-Aqua/Mapped/Daily/4km/chlor_a/'
   GSFC_WEB = "https://oceandata.sci.gsfc.nasa.gov/opendap/MODISA/L3SMI/"
@@ -756,14 +986,6 @@ def download_data_modis(start_year, start_month, start_day, end_year, end_month,
   print ('Latitude range: %f to %f'%(box[2],box[3]))
   print (' ')
 
-  # Check if curl or wget commands exsit on your computer
-  if sys.version_info >= (3,0):
-    status_curl, result = subprocess.getstatusoutput('which curl')
-    status_wget, result = subprocess.getstatusoutput('which wget')
-  else:
-    status_curl, result = commands.getstatusoutput("which curl")
-    status_wget, result = commands.getstatusoutput("which wget")
-
   lat_index = '[%d:%d:%d]'%(j0,1,j1)
   lon_index = '[%d:%d:%d]'%(i0,1,i1)
 
@@ -773,11 +995,11 @@ def download_data_modis(start_year, start_month, start_day, end_year, end_month,
   day_of_year0 = datetime.date(int(start_year), int(start_month), int(start_day)).timetuple().tm_yday
   day_of_year1 = datetime.date(int(end_year), int(end_month), int(end_day)).timetuple().tm_yday
 
-  cmd = 'wget -q -O - "https://oceandata.sci.gsfc.nasa.gov/api/file_search?sensor=aqua&sdate='+start_year+'-'+str(int(start_month)).zfill(2)+'-'+str(int(start_day)).zfill(2)+'&edate='+end_year+'-'+str(int(end_month)).zfill(2)+'-'+str(int(end_day)).zfill(2)+'&dtype=L3m&search=A*.L3m_DAY_CHL_chlor_a_4km.nc&format=txt"'
+  cmd = 'https://oceandata.sci.gsfc.nasa.gov/api/file_search?sensor=aqua&sdate='+start_year+'-'+str(int(start_month)).zfill(2)+'-'+str(int(start_day)).zfill(2)+'&edate='+end_year+'-'+str(int(end_month)).zfill(2)+'-'+str(int(end_day)).zfill(2)+'&dtype=L3m&search=A*.L3m_DAY_CHL_chlor_a_4km.nc&format=txt'
 
-  filelist = os.popen(cmd).read().split()
+  filelist = http_pool.fetch(cmd).decode().split()
 
-  for afile in filelist:
+  def fetch(afile):
     outdir = rootdir + '/'+afile[1:5] + '/' + afile[5:8]
     ncout = outdir + '/'+afile
     createdir(outdir)
@@ -785,25 +1007,17 @@ def download_data_modis(start_year, start_month, start_day, end_year, end_month,
     #cmd = GSFC_WEB+str(i)+'/'+filename
     acmd = GSFC_WEB+afile
 
-    if status_curl == 0:
-        acmd='curl "'+acmd+'" -o '+ ncout
-    elif status_wget == 0:
-        acmd='wget "'+acmd+'" -O '+ ncout
-    else:
-        sys.exit('\nThe script will need curl or wget on the system, please install them first before running the script !\nProgram will exit now !\n')
-
     print(acmd)
-    os.system( acmd )
-    print (ncout + ' download finished !')
-
-    # remove file if file does not exist or damaged
-    bsize = os.path.getsize(ncout)
-    if(bsize < 1000):
-      os.remove(ncout)
+    # responses smaller than 1000 bytes are error pages, not granules
+    if not manifest.fetch(acmd, ncout, minsize=1000) and not os.listdir(outdir):
       os.rmdir(outdir)
+
+  manifest = granule_manifest.Manifest(rootdir)
+  download_pool(((afile,) for afile in filelist), fetch, max_concurrency)
   
   end = time.time()
   print ('Time spend = ' + str(end - start) + ' seconds')
+  file_catalog.invalidate(rootdir)
 
 
 
@@ -0,0 +1,109 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Resumable downloads against a local server that closes the connection
+part way through the first transfer of a granule.
+
+% python -m unittest test_granule_manifest
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import http_pool
+import granule_manifest
+
+################################################################################################
+
+BODY = bytes(range(256)) * 400      # 102400 bytes
+CUT = 5000                          # bytes sent before the first transfer is dropped
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  requests = []
+
+  def do_GET(self):
+    start = 0
+    rng = self.headers.get('Range')
+    if rng is not None:
+      start = int(rng.split('=')[1].split('-')[0])
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(BODY)-1, len(BODY)))
+    else:
+      self.send_response(200)
+    self.send_header('Content-Length', str(len(BODY) - start))
+    self.end_headers()
+    Handler.requests.append(rng)
+    if len(Handler.requests) == 1:
+      # announce the whole body, then drop the connection
+      self.wfile.write(BODY[start:start+CUT])
+      self.wfile.flush()
+      self.close_connection = True
+      return
+    self.wfile.write(BODY[start:])
+
+  def log_message(self, *args):
+    pass
+
+class ResumeTest(unittest.TestCase):
+
+  def setUp(self):
+    Handler.requests = []
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = 'http://127.0.0.1:%d/granule.nc' % self.server.server_address[1]
+    self.rootdir = tempfile.mkdtemp()
+    self.outfile = self.rootdir + '/2010/001/granule.nc'
+    os.makedirs(os.path.dirname(self.outfile))
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    http_pool.close_all()
+    shutil.rmtree(self.rootdir)
+
+  def last_record(self):
+    with open(self.rootdir + '/' + granule_manifest.manifestName) as f:
+      return json.loads(f.readlines()[-1])
+
+  def test_download_cut_short(self):
+    with self.assertRaises(http_pool.IncompleteDownload) as cm:
+      http_pool.download(self.url, self.outfile)
+    self.assertEqual(cm.exception.nbytes, CUT)
+    self.assertEqual(cm.exception.expected, len(BODY))
+
+  def test_fetch_resumes(self):
+    manifest = granule_manifest.Manifest(self.rootdir)
+    self.assertFalse(manifest.fetch(self.url, self.outfile))
+    self.assertEqual(self.last_record()['status'], 'failed')
+    self.assertFalse(os.path.exists(self.outfile))
+    self.assertEqual(os.path.getsize(self.outfile + '.part'), CUT)
+    self.assertFalse(granule_manifest.Manifest(self.rootdir).is_current(self.outfile, self.url))
+
+    manifest = granule_manifest.Manifest(self.rootdir)
+    self.assertTrue(manifest.fetch(self.url, self.outfile))
+    self.assertEqual(Handler.requests, [None, 'bytes=%d-' % CUT])
+    entry = self.last_record()
+    self.assertEqual(entry['status'], 'done')
+    self.assertEqual(entry['size'], len(BODY))
+    with open(self.outfile, 'rb') as f:
+      self.assertEqual(f.read(), BODY)
+    self.assertTrue(granule_manifest.Manifest(self.rootdir).is_current(self.outfile, self.url))
+
+if __name__ == '__main__':
+  unittest.main()
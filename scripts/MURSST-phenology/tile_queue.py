@@ -0,0 +1,451 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Tile queue: run the tiled climatology and phenology metric steps on any
+number of worker processes or hosts sharing a directory.
+
+A job splits the grid into Tile_Size tiles and writes one task file per
+tile.  Workers claim tasks by renaming them (atomic on a shared
+filesystem), compute the tile and write it as a partial netCDF file with
+the layout of the final output; a tile that raises is put back in the
+queue until it has failed maxAttempts times.  When every tile is done the
+merge step assembles the final climatology or metric files.
+
+  queue/job.json        stage, parameters, grid and output files
+  queue/pending/        tasks waiting for a worker
+  queue/running/        claimed tasks, touched by their worker every heartbeatSeconds
+  queue/done/           finished tasks
+  queue/failed/         tasks that failed maxAttempts times
+  queue/parts/          partial output files, one per tile and output
+
+% python tile_queue.py -c phenology.cfg -n CMC -s climatology -q /shared/queue_clim
+% python tile_queue.py -q /shared/queue_clim -w        (on every node, any number of times)
+% python tile_queue.py -q /shared/queue_clim -w -t 600 (also requeue tiles of workers silent for 10 minutes)
+% python tile_queue.py -q /shared/queue_clim -m
+
+or, on a single machine, submit and run with 4 local worker processes:
+
+% python tile_queue.py -c phenology.cfg -n CMC -s climatology -q queue_clim -l 4
+
+The metric stages (spring, summer, spring_summer) read the climatology
+file, so merge the climatology job before submitting them.
+"""
+
+import sys, os
+import json
+import time
+import socket
+import subprocess
+import threading
+import traceback
+import configparser
+from optparse import OptionParser
+from netCDF4 import Dataset
+import numpy as np
+
+import data_info
+import executor
+import phenologyalg
+
+#####################
+# Global Parameters #
+#####################
+
+stageOutputs = {'climatology': ('climatology',),
+                'spring': ('spring',),
+                'summer': ('summer',),
+                'spring_summer': ('spring', 'summer')}
+maxAttempts = 3
+heartbeatSeconds = 60        # a worker touches its running task file this often
+usePrefetch = True           # off for the workers of run_local(nprocs > 1), which already fill the host
+
+###############
+# subroutines #
+###############
+def _owner():
+  """host.pid of this worker, used for task ownership and temporary file names"""
+  return socket.gethostname() + '.' + str(os.getpid())
+
+def _write_json(filename, data):
+  """Write data to filename through a temporary file, so readers never see a partial file"""
+  tmpname = filename + '.' + _owner() + '.tmp'
+  with open(tmpname, 'w') as f:
+    json.dump(data, f)
+  os.replace(tmpname, filename)
+
+def _read_json(filename):
+  with open(filename) as f:
+    return json.load(f)
+
+def _window(task):
+  i0, i1, j0, j1 = task['window']
+  return (slice(i0, i1), slice(j0, j1))
+
+def read_job(queuedir):
+  job = _read_json(os.path.join(queuedir, 'job.json'))
+  job['lats'] = np.array(job['lats'])
+  job['lons'] = np.array(job['lons'])
+  return job
+
+def submit(queuedir, stage, lats, lons, params, outputs, tile_size):
+  """Create a queue with one task per tile of the grid
+
+  params are the arguments of the stage (see run_task), outputs maps each
+  output of the stage ('climatology', 'spring', 'summer') to its final
+  filename.
+  """
+  if stage not in stageOutputs:
+    raise ValueError('unknown stage ' + stage + ', use one of ' + ', '.join(stageOutputs))
+  if os.path.exists(os.path.join(queuedir, 'job.json')):
+    raise ValueError(queuedir + ' already holds a job')
+  for name in ('pending', 'running', 'done', 'failed', 'parts'):
+    data_info.createdir(os.path.join(queuedir, name))
+
+  _write_json(os.path.join(queuedir, 'job.json'),
+              {'stage': stage, 'params': params, 'outputs': outputs,
+               'lats': np.asarray(lats).tolist(), 'lons': np.asarray(lons).tolist()})
+  windows = executor.tile_windows(len(lats), len(lons), tile_size)
+  for n, window in enumerate(windows):
+    task = {'id': 'tile_{0:0>5}'.format(n), 'attempts': 0,
+            'window': [window[0].start, window[0].stop, window[1].start, window[1].stop]}
+    _write_json(os.path.join(queuedir, 'pending', task['id'] + '.json'), task)
+  print(str(len(windows)) + ' tiles submitted to ' + queuedir)
+  return len(windows)
+
+def claim(queuedir):
+  """Move the next pending task to running/ and return it, None if there is none
+
+  Several workers may try the same task; the rename succeeds for one of
+  them and the others move on to the next task.
+  """
+  pending = os.path.join(queuedir, 'pending')
+  for name in sorted(os.listdir(pending)):
+    if not name.endswith('.json'):
+      continue
+    running = os.path.join(queuedir, 'running', name)
+    try:
+      os.rename(os.path.join(pending, name), running)
+    except OSError:
+      continue
+    os.utime(running)
+    task = _read_json(running)
+    task['host'] = socket.gethostname()
+    task['pid'] = os.getpid()
+    task['owner'] = _owner()
+    _write_json(running, task)
+    return task
+  return None
+
+def _finish(queuedir, task, source, error):
+  """Move task from source to done/, or back to pending/ or failed/ on error"""
+  if error is None:
+    target = 'done'
+  else:
+    task['attempts'] = task['attempts'] + 1
+    task['error'] = error
+    target = 'pending' if task['attempts'] < maxAttempts else 'failed'
+  if target == 'pending':
+    # the next claim records its own worker
+    for key in ('host', 'pid', 'owner'):
+      task.pop(key, None)
+  _write_json(source, task)
+  os.replace(source, os.path.join(queuedir, target, task['id'] + '.json'))
+  return target
+
+def release(queuedir, task, error=None):
+  """Finish a running task: done/ on success, back to pending/ or failed/ on error
+
+  Only a task this worker still holds is moved; None if it was requeued
+  by requeue_stale() in the meantime.
+  """
+  running = os.path.join(queuedir, 'running', task['id'] + '.json')
+  try:
+    current = _read_json(running)
+  except (OSError, ValueError):
+    current = None
+  if current is None or current.get('owner') != task.get('owner'):
+    print(task['id'] + ' is no longer held by this worker')
+    return None
+  return _finish(queuedir, task, running, error)
+
+def _heartbeat(filename, stop):
+  """Touch a running task file every heartbeatSeconds until stop is set"""
+  while not stop.wait(heartbeatSeconds):
+    try:
+      os.utime(filename)
+    except OSError:
+      return
+
+def _alive(task):
+  """False if the task's worker ran on this host and its process is gone"""
+  if task.get('host') != socket.gethostname():
+    return True
+  try:
+    os.kill(task['pid'], 0)
+  except ProcessLookupError:
+    return False
+  except (OSError, KeyError):
+    pass
+  return True
+
+def requeue_stale(queuedir, stale_seconds):
+  """Put tasks of dead workers back in the queue
+
+  A running task is stale when its file has not been touched by the
+  worker's heartbeat for stale_seconds (> heartbeatSeconds), or at once
+  when its worker ran on this host and has exited.  The task is taken
+  over by an atomic rename, so only one worker requeues it; it counts as
+  a failed attempt.
+  """
+  running = os.path.join(queuedir, 'running')
+  now = time.time()
+  for name in sorted(os.listdir(running)):
+    filename = os.path.join(running, name)
+    if not name.endswith('.json'):
+      continue
+    try:
+      task = _read_json(filename)
+      if now - os.path.getmtime(filename) < stale_seconds and _alive(task):
+        continue
+      stale = filename + '.' + _owner() + '.stale'
+      os.rename(filename, stale)
+    except (OSError, ValueError):
+      continue
+    print(task['id'] + ' held by a dead worker, moved to ' + _finish(queuedir, task, stale, 'stale'))
+
+def _create_output(output, lats, lons, params, outdir, outfilename):
+  """Open an empty climatology or metric file with the layout of the final output"""
+  if output == 'climatology':
+    return phenologyalg.create_climatology_file(lats, lons, params['startY'], params['endY'], outdir, outfilename)
+  if output == 'spring':
+    return phenologyalg.create_metric_spring(lats, lons, params['startY'], params['endY'], outdir, outfilename, params['trend_method'])
+  return phenologyalg.create_metric_summer(lats, lons, params['startY'], params['endY'], outdir, outfilename, params['trend_method'])
+
+def part_filename(queuedir, task, output):
+  return os.path.join(queuedir, 'parts', task['id'] + '.' + output + '.nc')
+
+def run_task(queuedir, job, task):
+  """Compute one tile and write its partial output files"""
+  params = job['params']
+  window = _window(task)
+  prefetch = params.get('prefetch', 0) if usePrefetch else 0
+  lats = job['lats'][window[0]]
+  lons = job['lons'][window[1]]
+  local = (slice(0, lats.size), slice(0, lons.size))
+
+  if job['stage'] == 'climatology':
+    results = {'climatology': phenologyalg.climatology_tile(params['startY'], params['endY'], params['variablename'],
+                                                            params['dirname'], window, prefetch)}
+  else:
+    spring_thresholds = params.get('spring_thresholds') if job['stage'] != 'summer' else None
+    summer_thresh_offset = params.get('summer_thresh_offset') if job['stage'] != 'spring' else None
+    metrics = phenologyalg.phenology_metrics(job['lats'], job['lons'], params['startY'], params['endY'],
+                                             params['variablename'], params['clim_filename'], params['dirname'],
+                                             spring_thresholds=spring_thresholds, summer_thresh_offset=summer_thresh_offset,
+                                             workers=params.get('workers', 1), window=window, prefetch=prefetch)
+    results = {output: metrics for output in stageOutputs[job['stage']]}
+
+  for output, result in results.items():
+    filename = part_filename(queuedir, task, output)
+    # per-worker temporary name, a requeued tile may be written twice at once
+    tmpname = filename + '.' + _owner() + '.tmp'
+    fid = _create_output(output, lats, lons, params, os.path.dirname(filename), os.path.basename(tmpname))
+    try:
+      if output == 'climatology':
+        phenologyalg.write_climatology_tile(fid, result, local)
+      elif output == 'spring':
+        phenologyalg.write_metric_spring(fid, result, local, params['trend_method'])
+      else:
+        phenologyalg.write_metric_summer(fid, result, local, params['trend_method'])
+    finally:
+      fid.close()
+    os.replace(tmpname, filename)
+
+def work(queuedir, stale_seconds=0):
+  """Worker loop: claim and run tasks until the queue is empty
+
+  Returns the number of tasks this worker finished.  While a task runs
+  its file is touched every heartbeatSeconds.  With stale_seconds > 0
+  an idle worker also requeues tasks whose worker stopped doing so for
+  that long (see requeue_stale).
+  """
+  if 0 < stale_seconds <= heartbeatSeconds:
+    raise ValueError('stale_seconds must exceed the heartbeat interval of ' + str(heartbeatSeconds) + ' seconds')
+  job = read_job(queuedir)
+  ndone = 0
+  while True:
+    task = claim(queuedir)
+    if task is None and stale_seconds > 0:
+      requeue_stale(queuedir, stale_seconds)
+      task = claim(queuedir)
+    if task is None:
+      break
+    print('Processing ' + task['id'] + ' attempt ' + str(task['attempts']+1) + ' on ' + task['host'])
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(os.path.join(queuedir, 'running', task['id'] + '.json'), stop), daemon=True)
+    beat.start()
+    try:
+      run_task(queuedir, job, task)
+      error = None
+    except Exception:
+      error = traceback.format_exc()
+      print(error)
+    finally:
+      stop.set()
+      beat.join()
+    target = release(queuedir, task, error)
+    if error is not None:
+      print(task['id'] + ' moved to ' + str(target))
+    elif target == 'done':
+      ndone = ndone + 1
+  return ndone
+
+def status(queuedir):
+  """Number of tasks in each state"""
+  counts = {}
+  for name in ('pending', 'running', 'done', 'failed'):
+    counts[name] = len([f for f in os.listdir(os.path.join(queuedir, name)) if f.endswith('.json')])
+  return counts
+
+def merge(queuedir):
+  """Assemble the partial files of a finished job into its final output files"""
+  counts = status(queuedir)
+  if counts['pending'] or counts['running'] or counts['failed']:
+    raise RuntimeError('job in ' + queuedir + ' is not finished: ' + json.dumps(counts))
+
+  job = read_job(queuedir)
+  donedir = os.path.join(queuedir, 'done')
+  tasks = [_read_json(os.path.join(donedir, name)) for name in sorted(os.listdir(donedir)) if name.endswith('.json')]
+  for output, outname in job['outputs'].items():
+    print('Merging ' + str(len(tasks)) + ' tiles into ' + outname)
+    fid = _create_output(output, job['lats'], job['lons'], job['params'], os.path.dirname(outname) or '.', os.path.basename(outname))
+    try:
+      for task in tasks:
+        window = _window(task)
+        part = Dataset(part_filename(queuedir, task, output), 'r')
+        for name, var in part.variables.items():
+          if 'lat' not in var.dimensions or 'lon' not in var.dimensions:
+            continue
+          # copy the stored values, fill values included
+          var.set_auto_maskandscale(False)
+          out = fid.variables[name]
+          out.set_auto_maskandscale(False)
+          index = tuple(window[0] if dim == 'lat' else window[1] if dim == 'lon' else slice(None) for dim in var.dimensions)
+          out[index] = var[:]
+        part.close()
+    finally:
+      fid.close()
+
+def run_local(queuedir, nprocs, stale_seconds=0):
+  """Local stand-in for a cluster scheduler: nprocs worker processes on this host, then merge"""
+  script = os.path.abspath(__file__)
+  command = [sys.executable, script, '-q', queuedir, '-w', '-t', str(stale_seconds), '-a', str(maxAttempts)]
+  if nprocs > 1:
+    command.append('-p')
+  procs = [subprocess.Popen(command) for n in range(nprocs)]
+  for proc in procs:
+    proc.wait()
+  counts = status(queuedir)
+  print('Tasks: ' + json.dumps(counts))
+  if counts['pending'] or counts['running'] or counts['failed']:
+    return False
+  merge(queuedir)
+  return True
+
+def submit_config(config_input, dataset_name, stage, queuedir):
+  """Submit a stage of an SST dataset with the parameters of the config file"""
+  rootdir = config_input.get(dataset_name, 'Root_Name')
+  lats, lons = data_info.latloninfo(rootdir, data_info.podaac_dataset_shorname(dataset_name))
+  params = {'startY': int(config_input.get(dataset_name, 'Start_Year')),
+            'endY': int(config_input.get(dataset_name, 'End_Year')),
+            'variablename': config_input.get(dataset_name, 'Parameter_Name'),
+            'dirname': os.path.abspath(data_info.data_dirname(config_input, dataset_name)),
+            'clim_filename': os.path.abspath(rootdir+"/"+config_input.get(dataset_name, 'Climatology_File')),
+            'spring_thresholds': [float(config_input.get('DEFAULT', 'Thresh_Spring1')),
+                                  float(config_input.get('DEFAULT', 'Thresh_Spring2'))],
+            'summer_thresh_offset': float(config_input.get('DEFAULT', 'Thresh_Offset_Summer')),
+            'trend_method': config_input.get(dataset_name, 'Trend_Method', fallback='ols'),
+            'workers': int(config_input.get(dataset_name, 'Workers', fallback=1)),
+            'prefetch': int(config_input.get(dataset_name, 'Prefetch', fallback=0))}
+
+  metricdir = rootdir+"/"+config_input.get(dataset_name, 'Metric_Dir', fallback='Metric')
+  filenames = {'climatology': params['clim_filename']}
+  if stage != 'climatology':
+    filenames['spring'] = os.path.abspath(metricdir+"/"+config_input.get(dataset_name, 'Metric_Spring_File'))
+    filenames['summer'] = os.path.abspath(metricdir+"/"+config_input.get(dataset_name, 'Metric_Summer_File'))
+  outputs = {output: filenames[output] for output in stageOutputs.get(stage, ())}
+
+  tile_size = int(config_input.get(dataset_name, 'Tile_Size', fallback=0))
+  return submit(queuedir, stage, lats, lons, params, outputs, tile_size)
+
+def parseoptions():
+  usage = "Usage: %prog [options]"
+  parser = OptionParser(usage)
+  parser.add_option("-q", "--queue", help="queue directory, shared by all workers", dest="queue")
+  parser.add_option("-c", "--config", help="config filename, to submit a job", dest="config")
+  parser.add_option("-n", "--dataset", help="dataset section of the config file, to submit a job", dest="dataset")
+  parser.add_option("-s", "--stage", help="stage to submit: " + ", ".join(stageOutputs), dest="stage")
+  parser.add_option("-w", "--worker", help="run a worker until the queue is empty", dest="worker", action="store_true", default=False)
+  parser.add_option("-l", "--local", help="run this many local workers, then merge", dest="local", type="int", default=0)
+  parser.add_option("-m", "--merge", help="merge the partial files of a finished job", dest="merge", action="store_true", default=False)
+  parser.add_option("-t", "--stale", help="requeue tasks whose worker has not reported for this many seconds, more than the " + str(heartbeatSeconds) + " second heartbeat (0: never)", dest="stale", type="int", default=0)
+  parser.add_option("-p", "--no-prefetch", help="ignore the Prefetch setting of the job", dest="prefetch", action="store_false", default=True)
+  parser.add_option("-a", "--attempts", help="attempts per tile before it is marked failed", dest="attempts", type="int", default=maxAttempts)
+
+  # Parse command line arguments
+  (options, args) = parser.parse_args()
+
+  if options.queue == None:
+    print('\nQueue directory is required !\nProgram will exit now !\n')
+    parser.print_help()
+    exit(-1)
+
+  if options.stage != None and (options.config == None or options.dataset == None):
+    print('\nConfig filename and dataset are required to submit a job !\nProgram will exit now !\n')
+    parser.print_help()
+    exit(-1)
+
+  if 0 < options.stale <= heartbeatSeconds:
+    print('\nStale time must exceed the ' + str(heartbeatSeconds) + ' second heartbeat !\nProgram will exit now !\n')
+    parser.print_help()
+    exit(-1)
+
+  return( options )
+
+def standalone_main():
+  global maxAttempts, usePrefetch
+
+  options = parseoptions()
+  maxAttempts = options.attempts
+  usePrefetch = options.prefetch
+
+  start = time.time()
+  if options.stage != None:
+    config_input = configparser.ConfigParser()
+    config_input.read(options.config)
+    submit_config(config_input, options.dataset, options.stage, options.queue)
+  if options.local > 0:
+    if not run_local(options.queue, options.local, options.stale):
+      print('\nSome tiles did not finish, see ' + options.queue + '/failed !\n')
+      exit(-1)
+  elif options.worker:
+    print(str(work(options.queue, options.stale)) + ' tiles processed')
+  if options.merge:
+    merge(options.queue)
+  end = time.time()
+  print (' Time spend = ' + str(end - start) + ' seconds')
+
+################################################################################################
+
+if __name__ == "__main__":
+        standalone_main()
@@ -0,0 +1,188 @@
+# Copyright 2018, by the California Institute of Technology. ALL RIGHTS RESERVED.
+# United States Government Sponsorship acknowledged. Any commercial use must be negotiated
+# with the Office of Technology Transfer at the California Institute of Technology.
+#
+# This software may be subject to U.S. export control laws. By accepting this software,
+# the user agrees to comply with all applicable U.S. export laws and regulations.
+# User has the responsibility to obtain export licenses, or other export authority
+# as may be required before exporting such information to foreign countries or providing access to foreign persons.
+
+#!  /usr/bin/env python3
+#
+
+"""
+Per-pixel linear trends of yearly fields.
+
+Every function takes an array whose last axis is the year and fits all
+the other elements (pixels, months, ...) at once.  NaN years are left out
+of each fit, and elements with too few valid years get NaN.
+
+Three estimators share one interface, fit_trend(y, method, min_valid):
+
+  ols       least squares, t-test p-value
+  theilsen  median of the pairwise slopes, Mann-Kendall p-value
+  ransac    least squares on the inliers of the best of randomly drawn
+            two-year lines (residual threshold: median absolute deviation)
+"""
+
+import warnings
+import numpy as np
+from scipy import stats
+
+#####################
+# Global Parameters #
+#####################
+
+trendMethods = ('ols', 'theilsen', 'ransac')
+pairBudget = 16*1024*1024      # pairwise slopes held in memory at once (Theil-Sen)
+ransacTrials = 100
+ransacSeed = 0
+
+###############
+# subroutines #
+###############
+def ols_trend(y, x=None, min_valid=2):
+  """Least-squares line along the last axis of y, in closed form
+
+  x defaults to the year index 0..ny-1.  Elements with fewer than
+  min_valid valid years (at least 2) get NaN.  Returns slope, intercept,
+  standard error of the slope and the two-sided p-value of slope != 0.
+  """
+  y = np.ma.filled(y, np.nan).astype(float)
+  ny = y.shape[-1]
+  if x is None:
+    x = np.arange(ny, dtype=float)
+  x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+
+  valid = np.isfinite(y) & np.isfinite(x)
+  n = valid.sum(axis=-1)
+  ok = n >= max(min_valid, 2)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    xm = np.where(valid, x, 0.0).sum(axis=-1)/n
+    ym = np.where(valid, y, 0.0).sum(axis=-1)/n
+    dx = np.where(valid, x - xm[...,None], 0.0)
+    dy = np.where(valid, y - ym[...,None], 0.0)
+    sxx = (dx*dx).sum(axis=-1)
+    sxy = (dx*dy).sum(axis=-1)
+    syy = (dy*dy).sum(axis=-1)
+    ok = ok & (sxx > 0)
+
+    slope = np.where(ok, sxy/sxx, np.nan)
+    intercept = np.where(ok, ym - slope*xm, np.nan)
+
+    # residual variance with n-2 degrees of freedom
+    dof = n - 2
+    sse = np.maximum(syy - slope*sxy, 0.0)
+    stderr = np.where(ok & (dof > 0), np.sqrt(sse/np.maximum(dof, 1)/sxx), np.nan)
+    tvalue = np.abs(slope)/stderr
+    pvalue = np.where(np.isfinite(stderr), 2.0*stats.t.sf(tvalue, np.maximum(dof, 1)), np.nan)
+
+  return slope, intercept, stderr, pvalue
+
+def half_years(ny):
+  """min_valid of the metric trends: more than half of the ny years"""
+  return ny//2 + 1
+
+def _flatten(y):
+  y = np.ma.filled(y, np.nan).astype(float)
+  return y.reshape(-1, y.shape[-1]), y.shape[:-1]
+
+def theilsen_trend(y, min_valid=2):
+  """Theil-Sen line along the last axis of y (x is the year index)
+
+  The slope is the median of the slopes between every pair of valid
+  years, the intercept the median of y - slope*x.  The p-value is the
+  two-sided Mann-Kendall test (no tie correction); stderr is NaN.
+  Pixels are processed in blocks of pairBudget pairwise slopes.
+  """
+  yf, shape = _flatten(y)
+  npix, ny = yf.shape
+  x = np.arange(ny, dtype=float)
+  i0, i1 = np.triu_indices(ny, 1)
+  dx = x[i1] - x[i0]
+
+  slope = np.full(npix, np.nan)
+  intercept = np.full(npix, np.nan)
+  pvalue = np.full(npix, np.nan)
+  n = np.isfinite(yf).sum(axis=1)
+  block = max(1, pairBudget//max(i0.size, 1))
+  for b0 in range(0, npix, block):
+    yb = yf[b0:b0+block]
+    dy = yb[:,i1] - yb[:,i0]
+    ok = n[b0:b0+block] >= max(min_valid, 2)
+    if not ok.any():
+      continue
+    with np.errstate(all='ignore'):
+      sb = np.nanmedian(dy[ok]/dx, axis=1)
+      ib = np.nanmedian(yb[ok] - sb[:,None]*x, axis=1)
+      score = np.nansum(np.sign(dy[ok]), axis=1)
+      nb = n[b0:b0+block][ok]
+      var = nb*(nb-1.0)*(2.0*nb+5.0)/18.0
+      z = (score - np.sign(score))/np.sqrt(var)
+    idx = np.arange(b0, b0+yb.shape[0])[ok]
+    slope[idx] = sb
+    intercept[idx] = ib
+    pvalue[idx] = 2.0*stats.norm.sf(np.abs(z))
+
+  stderr = np.full(npix, np.nan)
+  return slope.reshape(shape), intercept.reshape(shape), stderr.reshape(shape), pvalue.reshape(shape)
+
+def ransac_trend(y, min_valid=2, trials=None, seed=None):
+  """RANSAC line along the last axis of y (x is the year index)
+
+  Every trial draws two years (the same two for all pixels) and counts the
+  years within the residual threshold of the line through them; a pixel
+  keeps the trial with the most inliers.  The result is ols_trend() of
+  the inlier years.  The threshold is the median absolute deviation of
+  the pixel's values, as in sklearn.linear_model.RANSACRegressor.
+  """
+  if trials is None:
+    trials = ransacTrials
+  if seed is None:
+    seed = ransacSeed
+  yf, shape = _flatten(y)
+  npix, ny = yf.shape
+  x = np.arange(ny, dtype=float)
+
+  valid = np.isfinite(yf)
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)   # all-NaN pixels
+    median = np.nanmedian(yf, axis=1)
+    threshold = np.nanmedian(np.abs(yf - median[:,None]), axis=1)
+
+  rng = np.random.default_rng(seed)
+  best_count = np.full(npix, -1)
+  best = np.zeros(yf.shape, dtype=bool)
+  if ny >= 2:
+    for t in range(trials):
+      i, j = rng.choice(ny, 2, replace=False)
+      with np.errstate(all='ignore'):
+        s = (yf[:,j] - yf[:,i])/(x[j] - x[i])
+        resid = np.abs(yf - yf[:,i,None] - s[:,None]*(x - x[i]))
+        inlier = resid <= threshold[:,None]
+      count = np.where(np.isfinite(s), inlier.sum(axis=1), -1)
+      better = count > best_count
+      best_count[better] = count[better]
+      best[better] = inlier[better]
+
+  yin = np.where(best, yf, np.nan)
+  slope, intercept, stderr, pvalue = ols_trend(yin, min_valid=2)
+  few = valid.sum(axis=1) < max(min_valid, 2)
+  for field in (slope, intercept, stderr, pvalue):
+    field[few] = np.nan
+  return slope.reshape(shape), intercept.reshape(shape), stderr.reshape(shape), pvalue.reshape(shape)
+
+def fit_trend(y, method='ols', min_valid=2):
+  """Trend along the last axis of y with one of trendMethods
+
+  Returns slope, intercept, stderr and p-value arrays.
+  """
+  method = method.lower()
+  if method == 'ols':
+    return ols_trend(y, min_valid=min_valid)
+  if method == 'theilsen':
+    return theilsen_trend(y, min_valid=min_valid)
+  if method == 'ransac':
+    return ransac_trend(y, min_valid=min_valid)
+  raise ValueError('unknown trend method ' + method + ', use one of ' + ', '.join(trendMethods))